@@ -8,17 +8,54 @@ from openai import OpenAIError
 
 import aidial_adapter_openai.endpoints as endpoints
 from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.dial_api.storage import close_storage_session
 from aidial_adapter_openai.exception_handlers import adapter_exception_handler
-from aidial_adapter_openai.utils.http_client import get_http_client
+from aidial_adapter_openai.utils.circuit_breaker import (
+    configure_circuit_breakers,
+)
+from aidial_adapter_openai.utils.concurrency_limiter import (
+    configure_concurrency_limiters,
+)
+from aidial_adapter_openai.utils.hedging import configure_hedging
+from aidial_adapter_openai.utils.http_client import (
+    configure_http_client,
+    get_http_client,
+)
+from aidial_adapter_openai.utils.image_executor import shutdown_image_executors
+from aidial_adapter_openai.utils.load_balancer import (
+    configure_upstream_balancers,
+)
 from aidial_adapter_openai.utils.log_config import configure_loggers, logger
-from aidial_adapter_openai.utils.request import set_app_config
+from aidial_adapter_openai.utils.request import get_app_config, set_app_config
+from aidial_adapter_openai.utils.token_budget import configure_token_budgets
+from aidial_adapter_openai.utils.warmup import ConnectionWarmer
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # The application reports readiness only once the connections are warm
+    warmer = ConnectionWarmer.from_config(get_app_config(app))
+    await warmer.start()
     yield
     logger.info("Application shutdown")
+    await warmer.stop()
     await get_http_client().aclose()
+    await close_storage_session()
+    shutdown_image_executors()
+
+
+def configure_app(app: FastAPI, app_config: ApplicationConfig) -> None:
+    """
+    Sets the configuration of the application along with
+    the state of the upstream calls derived from it.
+    """
+
+    set_app_config(app, app_config)
+    configure_concurrency_limiters(app, app_config)
+    configure_token_budgets(app, app_config)
+    configure_circuit_breakers(app, app_config)
+    configure_upstream_balancers(app, app_config)
+    configure_hedging(app, app_config)
 
 
 def create_app(
@@ -26,7 +63,9 @@ def create_app(
     init_telemetry: bool = True,
 ) -> FastAPI:
     app = FastAPI(lifespan=lifespan)
-    set_app_config(app, app_config or ApplicationConfig.from_env())
+    app_config = app_config or ApplicationConfig.from_env()
+    configure_app(app, app_config)
+    configure_http_client(app_config)
 
     if init_telemetry:
         sdk_init_telemetry(app, TelemetryConfig())
@@ -1,6 +1,6 @@
 import json
 import os
-from typing import Callable, Dict, List
+from typing import Any, Callable, Dict, List, Literal, Optional
 
 from pydantic import BaseModel
 
@@ -10,6 +10,106 @@ from aidial_adapter_openai.utils.json import remove_nones
 from aidial_adapter_openai.utils.log_config import logger
 
 
+class ConnectionPoolConfig(BaseModel):
+    """
+    Connection pool dedicated to the given upstream hosts and deployments.
+    The timeouts are given in seconds and
+    cap the timeouts of the requests going through the pool.
+    """
+
+    hosts: List[str] = []
+    deployments: List[str] = []
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 5.0
+    http2: bool = False
+
+    timeout: Optional[float] = None
+    connect_timeout: Optional[float] = None
+    read_timeout: Optional[float] = None
+    pool_timeout: Optional[float] = None
+
+
+class ConcurrencyLimitConfig(BaseModel):
+    """
+    Adaptive limit of the concurrent upstream requests of a deployment.
+    The limit grows while the upstream latency is healthy and
+    is cut on throttling, server errors and rising latency.
+    The requests exceeding the limit wait in a queue.
+    """
+
+    initial_limit: int = 20
+    min_limit: int = 1
+    max_limit: int = 200
+
+    backoff_ratio: float = 0.5
+    latency_tolerance: float = 2.0
+
+    max_queue_size: int = 100
+    queue_timeout: float = 10.0
+
+
+class UpstreamConfig(BaseModel):
+    """
+    Upstream endpoint of a deployment.
+    The upstream is authenticated with the Azure AD token
+    when the key isn't given.
+    """
+
+    endpoint: str
+    key: Optional[str] = None
+
+
+class UpstreamPoolConfig(BaseModel):
+    """
+    Upstream endpoints serving the same model, e.g. in different regions.
+    The requests are balanced by the peak EWMA of the upstream latency
+    or by the number of in-flight requests.
+    A throttling upstream is ejected from the pool at once,
+    a failing one - after the given number of consecutive failures.
+    The ejection time is given in seconds.
+    """
+
+    upstreams: List[UpstreamConfig]
+    strategy: Literal["peak_ewma", "least_requests"] = "peak_ewma"
+
+    max_failures: int = 3
+    ejection_time: float = 30.0
+
+
+class HedgingConfig(BaseModel):
+    """
+    Hedging of the upstream requests of a deployment.
+    When the upstream doesn't respond within the given percentile
+    of its recent response times, a duplicate request is sent
+    to another upstream of the deployment pool (or the same upstream),
+    and the response which comes first is used.
+    The delays are given in seconds.
+    """
+
+    percentile: float = 95.0
+    min_delay: float = 0.5
+    max_delay: float = 10.0
+    min_samples: int = 20
+
+    max_hedge_ratio: float = 0.05
+
+
+class ImageOptimizationConfig(BaseModel):
+    """
+    Optimization of the images attached to the requests of a deployment.
+    The images are scaled down to the size the model processes them at,
+    so that the image tokens stay the same.
+    The images are optionally converted to JPEG or WebP
+    of the given quality (1-100).
+    The animated images are reduced to their first frame.
+    """
+
+    format: Optional[Literal["jpeg", "webp"]] = None
+    quality: int = 85
+
+
 class ApplicationConfig(BaseModel):
     MODEL_ALIASES: Dict[str, str] = {}
     DALLE3_DEPLOYMENTS: List[str] = []
@@ -24,6 +124,28 @@ class ApplicationConfig(BaseModel):
     DALLE3_AZURE_API_VERSION: str = "2024-02-01"
     NON_STREAMING_DEPLOYMENTS: List[str] = []
     ELIMINATE_EMPTY_CHOICES: bool = False
+    HTTP2_UPSTREAM_HOSTS: List[str] = []
+    UPSTREAM_CONNECTION_POOLS: Dict[str, ConnectionPoolConfig] = {}
+    UPSTREAM_WARMUP_URLS: List[str] = []
+    UPSTREAM_WARMUP_CONNECTIONS: int = 0
+    UPSTREAM_WARMUP_REFRESH_INTERVAL: float = 4.0
+    CONCURRENCY_LIMITS: Dict[str, ConcurrencyLimitConfig] = {}
+    TOKEN_BUDGET_DEPLOYMENTS: List[str] = []
+    TOKEN_BUDGET_MAX_WAIT: float = 10.0
+    TENANT_HEADER: Optional[str] = None
+    TENANT_WEIGHTS: Dict[str, float] = {}
+    PRIORITY_HEADER: str = "X-REQUEST-PRIORITY"
+    TENANT_MAX_PRIORITIES: Dict[str, Literal["high", "normal", "low"]] = {}
+    DEPLOYMENT_UPSTREAMS: Dict[str, UpstreamPoolConfig] = {}
+    HEDGING: Dict[str, HedgingConfig] = {}
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 0
+    CIRCUIT_BREAKER_RECOVERY_TIME: float = 30.0
+    CIRCUIT_BREAKER_HALF_OPEN_REQUESTS: int = 1
+    UPSTREAM_FAST_RETRIES: int = 2
+    UPSTREAM_FAST_RETRY_BUDGET: float = 0.1
+    DEADLINE_HEADER: str = "X-REQUEST-DEADLINE"
+    DEPLOYMENT_TIMEOUTS: Dict[str, float] = {}
+    IMAGE_OPTIMIZATION: Dict[str, ImageOptimizationConfig] = {}
 
     DEPLOYMENT_TYPE_MAP: Dict[
         ChatCompletionDeploymentType, Callable[["ApplicationConfig"], List[str]]
@@ -60,7 +182,7 @@ class ApplicationConfig(BaseModel):
                 return None
             return list(map(str.strip, (deployments_value).split(",")))
 
-        def _parse_env_dict(key: str) -> Dict[str, str] | None:
+        def _parse_env_dict(key: str) -> Dict[str, Any] | None:
             value = os.getenv(key)
             return json.loads(value) if value else None
 
@@ -89,6 +211,9 @@ class ApplicationConfig(BaseModel):
                 "GPT4O_MINI_DEPLOYMENTS",
                 "AZURE_AI_VISION_DEPLOYMENTS",
                 "NON_STREAMING_DEPLOYMENTS",
+                "HTTP2_UPSTREAM_HOSTS",
+                "UPSTREAM_WARMUP_URLS",
+                "TOKEN_BUDGET_DEPLOYMENTS",
             )
         }
         dict_fields = {
@@ -97,6 +222,31 @@ class ApplicationConfig(BaseModel):
                 "MODEL_ALIASES",
                 "API_VERSIONS_MAPPING",
                 "COMPLETION_DEPLOYMENTS_PROMPT_TEMPLATES",
+                "UPSTREAM_CONNECTION_POOLS",
+                "CONCURRENCY_LIMITS",
+                "TENANT_WEIGHTS",
+                "TENANT_MAX_PRIORITIES",
+                "DEPLOYMENT_UPSTREAMS",
+                "HEDGING",
+                "DEPLOYMENT_TIMEOUTS",
+                "IMAGE_OPTIMIZATION",
+            )
+        }
+
+        scalar_fields = {
+            key: os.getenv(key)
+            for key in (
+                "UPSTREAM_WARMUP_CONNECTIONS",
+                "UPSTREAM_WARMUP_REFRESH_INTERVAL",
+                "TOKEN_BUDGET_MAX_WAIT",
+                "TENANT_HEADER",
+                "PRIORITY_HEADER",
+                "CIRCUIT_BREAKER_FAILURE_THRESHOLD",
+                "CIRCUIT_BREAKER_RECOVERY_TIME",
+                "CIRCUIT_BREAKER_HALF_OPEN_REQUESTS",
+                "UPSTREAM_FAST_RETRIES",
+                "UPSTREAM_FAST_RETRY_BUDGET",
+                "DEADLINE_HEADER",
             )
         }
 
@@ -105,6 +255,7 @@ class ApplicationConfig(BaseModel):
                 {
                     **deployment_fields,
                     **dict_fields,
+                    **scalar_fields,
                     "DALLE3_AZURE_API_VERSION": os.getenv(
                         "DALLE3_AZURE_API_VERSION"
                     ),
@@ -1,7 +1,6 @@
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Dict
 
 from aidial_sdk.exceptions import RequestValidationError
-from openai import AsyncStream
 from openai.types import Completion
 
 from aidial_adapter_openai.app_config import ApplicationConfig
@@ -16,6 +15,7 @@ from aidial_adapter_openai.utils.streaming import (
     debug_print,
     map_stream,
 )
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 
 def sanitize_text(text: str) -> str:
@@ -69,12 +69,14 @@ async def chat_completion(
 
     del data["messages"]
 
-    response = await call_with_extra_body(
-        client.completions.create,
-        {"prompt": prompt, **data},
+    response = await call_upstream_request(
+        lambda: call_with_extra_body(
+            client.completions.create,
+            {"prompt": prompt, **data},
+        )
     )
 
-    if isinstance(response, AsyncStream):
+    if isinstance(response, AsyncIterator):
         return map_stream(
             lambda item: convert_to_chat_completions_response(
                 item, is_stream=True
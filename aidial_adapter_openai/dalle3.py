@@ -7,7 +7,9 @@ from fastapi.responses import JSONResponse
 
 from aidial_adapter_openai.dial_api.storage import FileStorage
 from aidial_adapter_openai.utils.auth import OpenAICreds, get_auth_headers
+from aidial_adapter_openai.utils.deadline import get_aiohttp_timeout
 from aidial_adapter_openai.utils.streaming import build_chunk, generate_id
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 IMG_USAGE = {
     "prompt_tokens": 0,
@@ -19,7 +21,7 @@ IMG_USAGE = {
 async def generate_image(
     api_url: str, creds: OpenAICreds, user_prompt: str
 ) -> JSONResponse | Any:
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=get_aiohttp_timeout()) as session:
         async with session.post(
             api_url,
             json={"prompt": user_prompt, "response_format": "b64_json"},
@@ -116,7 +118,9 @@ async def chat_completion(
 
     api_url = f"{upstream_endpoint}?api-version={api_version}"
     user_prompt = get_user_prompt(data)
-    model_response = await generate_image(api_url, creds, user_prompt)
+    model_response = await call_upstream_request(
+        lambda: generate_image(api_url, creds, user_prompt)
+    )
 
     if isinstance(model_response, JSONResponse):
         return model_response
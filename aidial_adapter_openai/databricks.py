@@ -1,6 +1,5 @@
-from typing import Any, cast
+from typing import Any, AsyncIterator, cast
 
-from openai import AsyncStream
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 
@@ -11,20 +10,23 @@ from aidial_adapter_openai.utils.parsers import (
 )
 from aidial_adapter_openai.utils.reflection import call_with_extra_body
 from aidial_adapter_openai.utils.streaming import chunk_to_dict, map_stream
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 
 async def chat_completion(
     data: Any, upstream_endpoint: str, creds: OpenAICreds
 ):
-    client = chat_completions_parser.parse(upstream_endpoint).get_client(
-        cast(OpenAIParams, creds)
+    client = chat_completions_parser.get_client(
+        upstream_endpoint, cast(OpenAIParams, creds)
     )
 
-    response: AsyncStream[ChatCompletionChunk] | ChatCompletion = (
-        await call_with_extra_body(client.chat.completions.create, data)
+    response: AsyncIterator[ChatCompletionChunk] | ChatCompletion = (
+        await call_upstream_request(
+            lambda: call_with_extra_body(client.chat.completions.create, data)
+        )
     )
 
-    if isinstance(response, AsyncStream):
+    if isinstance(response, AsyncIterator):
         return map_stream(chunk_to_dict, response)
     else:
         return response
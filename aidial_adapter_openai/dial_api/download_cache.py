@@ -0,0 +1,230 @@
+"""
+Cache of the files downloaded from the DIAL storage and the image URLs.
+
+A conversation resends the same attachments on every turn,
+so the downloaded files are kept in memory, and optionally on disk,
+keyed by the URL. The credentials aren't a part of the key,
+since DIAL Core issues a new key for every request.
+A cached file is revalidated by a conditional request with its ETag
+sent with the credentials of the current request, which checks
+the access to the file, so a repeat turn costs a 304 response
+instead of a download.
+The cached resources, along with the image metadata derived from them,
+are reused only once they are revalidated for the current request.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from aidial_adapter_openai.utils.log_config import logger as log
+from aidial_adapter_openai.utils.resource import Resource
+
+DOWNLOAD_CACHE_SIZE = int(os.getenv("DOWNLOAD_CACHE_SIZE", 256 * 1024 * 1024))
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR")
+DOWNLOAD_CACHE_DISK_SIZE = int(
+    os.getenv("DOWNLOAD_CACHE_DISK_SIZE", 1024 * 1024 * 1024)
+)
+
+# URL of the file
+CacheKey = str
+
+
+@dataclass
+class CachedDownload:
+    # The same instance is reused by the requests
+    resource: Resource
+    etag: str
+
+    @property
+    def size(self) -> int:
+        return len(self.resource.data)
+
+
+class MemoryCache:
+    """
+    LRU cache bounded by the total size of the cached files.
+    """
+
+    max_size: int
+    size: int
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._entries: "OrderedDict[CacheKey, CachedDownload]" = OrderedDict()
+
+    def get(self, key: CacheKey) -> Optional[CachedDownload]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: CacheKey, entry: CachedDownload) -> None:
+        self.pop(key)
+        if entry.size > self.max_size:
+            return
+
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def pop(self, key: CacheKey) -> None:
+        if (entry := self._entries.pop(key, None)) is not None:
+            self.size -= entry.size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    Cache of the files in a local directory bounded by the total file size.
+    Each entry is a data file along with a JSON file with its metadata,
+    both named by the hash of the cache key.
+    """
+
+    directory: Path
+    max_size: int
+    size: int
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.size = 0
+        self._entries: Optional["OrderedDict[str, int]"] = None
+        # The cache is accessed from the worker threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_name(key: CacheKey) -> str:
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        if self._entries is not None:
+            return self._entries
+
+        # The files left by the previous runs, the oldest first
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = sorted(
+            (path.stat().st_mtime, path.stem, path.stat().st_size)
+            for path in self.directory.glob("*.data")
+        )
+        self._entries = OrderedDict((name, size) for _, name, size in files)
+        self.size = sum(self._entries.values())
+        return self._entries
+
+    def get(self, key: CacheKey) -> Optional[CachedDownload]:
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key: CacheKey, entry: CachedDownload) -> None:
+        with self._lock:
+            self._put(key, entry)
+
+    def pop(self, key: CacheKey) -> None:
+        with self._lock:
+            self._remove(self._get_name(key))
+
+    def _get(self, key: CacheKey) -> Optional[CachedDownload]:
+        entries = self._load_index()
+        name = self._get_name(key)
+        if name not in entries:
+            return None
+
+        try:
+            meta = json.loads((self.directory / f"{name}.json").read_text())
+            data = (self.directory / f"{name}.data").read_bytes()
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to read the cached file: {e}")
+            self._remove(name)
+            return None
+
+        entries.move_to_end(name)
+        return CachedDownload(
+            resource=Resource(type=meta["type"], data=data),
+            etag=meta["etag"],
+        )
+
+    def _put(self, key: CacheKey, entry: CachedDownload) -> None:
+        entries = self._load_index()
+        name = self._get_name(key)
+        self._remove(name)
+        if entry.size > self.max_size:
+            return
+
+        try:
+            (self.directory / f"{name}.data").write_bytes(entry.resource.data)
+            (self.directory / f"{name}.json").write_text(
+                json.dumps({"type": entry.resource.type, "etag": entry.etag})
+            )
+        except OSError as e:
+            log.warning(f"Failed to write the cached file: {e}")
+            self._remove(name)
+            return
+
+        entries[name] = entry.size
+        self.size += entry.size
+        while self.size > self.max_size:
+            self._remove(next(iter(entries)))
+
+    def _remove(self, name: str) -> None:
+        entries = self._load_index()
+        if (size := entries.pop(name, None)) is not None:
+            self.size -= size
+        for suffix in ("data", "json"):
+            (self.directory / f"{name}.{suffix}").unlink(missing_ok=True)
+
+
+class DownloadCache:
+    memory: MemoryCache
+    disk: Optional[DiskCache]
+
+    def __init__(self, memory: MemoryCache, disk: Optional[DiskCache]) -> None:
+        self.memory = memory
+        self.disk = disk
+
+    async def get(self, key: CacheKey) -> Optional[CachedDownload]:
+        if (entry := self.memory.get(key)) is not None:
+            return entry
+
+        if self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if entry is not None:
+                self.memory.put(key, entry)
+
+        return entry
+
+    async def put(self, key: CacheKey, entry: CachedDownload) -> None:
+        self.memory.put(key, entry)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, entry)
+
+    async def pop(self, key: CacheKey) -> None:
+        self.memory.pop(key)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.pop, key)
+
+
+def create_download_cache() -> Optional[DownloadCache]:
+    if DOWNLOAD_CACHE_SIZE <= 0:
+        return None
+    return DownloadCache(
+        MemoryCache(DOWNLOAD_CACHE_SIZE),
+        (
+            DiskCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_DISK_SIZE)
+            if DOWNLOAD_CACHE_DIR
+            else None
+        ),
+    )
+
+
+download_cache = create_download_cache()
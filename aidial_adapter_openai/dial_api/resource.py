@@ -1,4 +1,5 @@
 import base64
+import binascii
 import mimetypes
 from abc import ABC, abstractmethod
 from typing import List
@@ -6,7 +7,12 @@ from typing import List
 from aidial_sdk.chat_completion import Attachment
 from pydantic import BaseModel, Field, root_validator
 
-from aidial_adapter_openai.dial_api.storage import FileStorage, download_file
+from aidial_adapter_openai.dial_api.storage import (
+    FileStorage,
+    download_file_prefix,
+    download_resource,
+    get_cached_resource,
+)
 from aidial_adapter_openai.utils.resource import Resource
 from aidial_adapter_openai.utils.text import truncate_string
 
@@ -40,6 +46,23 @@ class DialResource(ABC, BaseModel):
     @abstractmethod
     async def download(self, storage: FileStorage | None) -> Resource: ...
 
+    async def get_cached(self, storage: FileStorage | None) -> Resource | None:
+        """
+        Returns the copy of the resource downloaded earlier, if any,
+        once it's revalidated with the credentials of the current request.
+        """
+        return None
+
+    async def download_prefix(
+        self, storage: FileStorage | None, size: int
+    ) -> bytes | None:
+        """
+        Downloads at least the first `size` bytes of the resource
+        unless the whole resource is shorter.
+        None means that the partial download isn't supported.
+        """
+        return None
+
     @abstractmethod
     async def guess_content_type(self) -> str | None: ...
 
@@ -78,8 +101,17 @@ class URLResource(DialResource):
 
     async def download(self, storage: FileStorage | None) -> Resource:
         type = await self.get_content_type()
-        data = await _download_url(storage, self.url)
-        return Resource(type=type, data=data)
+        return await _download_url(storage, self.url, type)
+
+    async def get_cached(self, storage: FileStorage | None) -> Resource | None:
+        type = await self.get_content_type()
+        return await _get_cached_url(storage, self.url, type)
+
+    async def download_prefix(
+        self, storage: FileStorage | None, size: int
+    ) -> bytes | None:
+        await self.get_content_type()
+        return await _download_url_prefix(storage, self.url, size)
 
     async def guess_content_type(self) -> str | None:
         return (
@@ -129,13 +161,36 @@ class AttachmentResource(DialResource):
         type = await self.get_content_type()
 
         if self.attachment.data:
-            data = base64.b64decode(self.attachment.data)
+            try:
+                return Resource.from_base64(type, self.attachment.data)
+            except ValueError:
+                # Not a canonical base64, e.g. with line breaks
+                data = base64.b64decode(self.attachment.data)
+                return Resource(type=type, data=data)
         elif self.attachment.url:
-            data = await _download_url(storage, self.attachment.url)
+            return await _download_url(storage, self.attachment.url, type)
         else:
             raise ValidationError(f"Invalid {self.entity_name}")
 
-        return Resource(type=type, data=data)
+    async def get_cached(self, storage: FileStorage | None) -> Resource | None:
+        if self.attachment.url:
+            type = await self.get_content_type()
+            return await _get_cached_url(storage, self.attachment.url, type)
+        return None
+
+    async def download_prefix(
+        self, storage: FileStorage | None, size: int
+    ) -> bytes | None:
+        await self.get_content_type()
+
+        if self.attachment.data:
+            return _decode_base64_prefix(self.attachment.data, size)
+        elif self.attachment.url:
+            return await _download_url_prefix(
+                storage, self.attachment.url, size
+            )
+        else:
+            raise ValidationError(f"Invalid {self.entity_name}")
 
     def create_url_resource(self, url: str) -> URLResource:
         return URLResource(
@@ -175,11 +230,48 @@ class AttachmentResource(DialResource):
             raise ValidationError(f"Invalid {self.entity_name}")
 
 
-async def _download_url(file_storage: FileStorage | None, url: str) -> bytes:
+async def _download_url(
+    file_storage: FileStorage | None, url: str, type: str
+) -> Resource:
     if (resource := Resource.from_data_url(url)) is not None:
-        return resource.data
+        return resource.with_type(type)
 
     if file_storage:
-        return await file_storage.download_file(url)
+        return await file_storage.download_resource(url, type)
     else:
-        return await download_file(url)
+        return await download_resource(url, type)
+
+
+async def _get_cached_url(
+    file_storage: FileStorage | None, url: str, type: str
+) -> Resource | None:
+    if Resource.parse_data_url_content_type(url) is not None:
+        return None
+
+    if file_storage:
+        return await file_storage.get_cached_resource(url, type)
+    else:
+        return await get_cached_resource(url, type)
+
+
+async def _download_url_prefix(
+    file_storage: FileStorage | None, url: str, size: int
+) -> bytes | None:
+    if (type := Resource.parse_data_url_content_type(url)) is not None:
+        data_base64 = url.removeprefix(f"data:{type};base64,")
+        return _decode_base64_prefix(data_base64, size)
+
+    if file_storage:
+        return await file_storage.download_file_prefix(url, size)
+    else:
+        return await download_file_prefix(url, size)
+
+
+def _decode_base64_prefix(data_base64: str, size: int) -> bytes | None:
+    # Every 4 base64 characters encode 3 bytes
+    prefix = data_base64[: (size + 2) // 3 * 4]
+    try:
+        return base64.b64decode(prefix, validate=True)
+    except binascii.Error:
+        # Not aligned due to whitespaces, the whole data is decoded then
+        return None
@@ -1,20 +1,37 @@
+import asyncio
 import base64
 import hashlib
 import io
 import mimetypes
 import os
-from typing import Mapping, Optional, TypedDict
+import weakref
+from typing import Mapping, Optional, Tuple, TypedDict
 from urllib.parse import unquote, urljoin
 
 import aiohttp
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
+from aidial_adapter_openai.dial_api.download_cache import (
+    CachedDownload,
+    CacheKey,
+    download_cache,
+)
 from aidial_adapter_openai.utils.auth import Auth
+from aidial_adapter_openai.utils.deadline import get_aiohttp_timeout
 from aidial_adapter_openai.utils.env import get_env, get_env_bool
 from aidial_adapter_openai.utils.log_config import logger as log
+from aidial_adapter_openai.utils.resource import Resource
+from aidial_adapter_openai.utils.single_flight import SingleFlight
 
 CORE_API_VERSION = os.getenv("CORE_API_VERSION")
 
+DIAL_STORAGE_CONNECTION_LIMIT = int(
+    os.getenv("DIAL_STORAGE_CONNECTION_LIMIT", 100)
+)
+DIAL_STORAGE_KEEPALIVE_TIMEOUT = float(
+    os.getenv("DIAL_STORAGE_KEEPALIVE_TIMEOUT", 30)
+)
+
 
 class FileMetadata(TypedDict):
     name: str
@@ -28,27 +45,60 @@ class Bucket(TypedDict):
     appdata: str | None
 
 
+# The aiohttp session is bound to the event loop it was created in,
+# so the adapter keeps a single pooled session per running loop.
+_storage_sessions: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, aiohttp.ClientSession
+] = weakref.WeakKeyDictionary()
+
+
+def get_storage_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = _storage_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=DIAL_STORAGE_CONNECTION_LIMIT,
+                keepalive_timeout=DIAL_STORAGE_KEEPALIVE_TIMEOUT,
+            )
+        )
+        _storage_sessions[loop] = session
+    return session
+
+
+async def close_storage_session() -> None:
+    session = _storage_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
 class FileStorage(BaseModel):
     dial_url: str
     upload_dir: str
     auth: Auth
 
-    bucket: Optional[Bucket] = None
+    # DIAL Core issues new credentials for every request,
+    # so the bucket is only reused within the request
+    _bucket: Optional[Bucket] = PrivateAttr(default=None)
 
-    async def _get_bucket(self, session: aiohttp.ClientSession) -> Bucket:
-        if self.bucket is None:
-            async with session.get(
-                f"{self.dial_url}/v1/bucket",
-                headers=self.auth.headers,
-            ) as response:
-                response.raise_for_status()
-                self.bucket = await response.json()
-                log.debug(f"bucket: {self.bucket}")
+    async def _get_bucket(self) -> Bucket:
+        if self._bucket is not None:
+            return self._bucket
 
-        return self.bucket
+        async with get_storage_session().get(
+            f"{self.dial_url}/v1/bucket",
+            headers=self.auth.headers,
+            timeout=get_aiohttp_timeout(),
+        ) as response:
+            response.raise_for_status()
+            bucket = await response.json()
+            log.debug(f"bucket: {bucket}")
 
-    async def _get_user_bucket(self, session: aiohttp.ClientSession) -> str:
-        bucket = await self._get_bucket(session)
+        self._bucket = bucket
+        return bucket
+
+    async def _get_user_bucket(self) -> str:
+        bucket = await self._get_bucket()
         appdata = bucket.get("appdata")
         if appdata is None:
             raise ValueError(
@@ -72,24 +122,24 @@ class FileStorage(BaseModel):
     async def upload(
         self, filename: str, content_type: str, content: bytes
     ) -> FileMetadata:
-        async with aiohttp.ClientSession() as session:
-            bucket = await self._get_bucket(session)
+        bucket = await self._get_bucket()
 
-            appdata = bucket["appdata"]
-            ext = mimetypes.guess_extension(content_type) or ""
-            url = f"{self.dial_url}/v1/files/{appdata}/{self.upload_dir}/{filename}{ext}"
+        appdata = bucket["appdata"]
+        ext = mimetypes.guess_extension(content_type) or ""
+        url = f"{self.dial_url}/v1/files/{appdata}/{self.upload_dir}/{filename}{ext}"
 
-            data = FileStorage._to_form_data(filename, content_type, content)
+        data = FileStorage._to_form_data(filename, content_type, content)
 
-            async with session.put(
-                url=url,
-                data=data,
-                headers=self.auth.headers,
-            ) as response:
-                response.raise_for_status()
-                meta = await response.json()
-                log.debug(f"Uploaded file: url={url}, metadata={meta}")
-                return meta
+        async with get_storage_session().put(
+            url=url,
+            data=data,
+            headers=self.auth.headers,
+            timeout=get_aiohttp_timeout(),
+        ) as response:
+            response.raise_for_status()
+            meta = await response.json()
+            log.debug(f"Uploaded file: url={url}, metadata={meta}")
+            return meta
 
     async def upload_file_as_base64(
         self, data: str, content_type: str
@@ -112,13 +162,31 @@ class FileStorage(BaseModel):
         else:
             return url.removeprefix(f"{self.dial_url}/v1/")
 
-    async def download_file(self, link: str) -> bytes:
+    def _get_download_request(self, link: str) -> Tuple[str, Mapping[str, str]]:
         url = self.attachment_link_to_url(link)
         headers: Mapping[str, str] = {}
         if url.lower().startswith(self.dial_url.lower()):
             headers = self.auth.headers
+        return url, headers
+
+    async def download_file(self, link: str) -> bytes:
+        url, headers = self._get_download_request(link)
         return await download_file(url, headers)
 
+    async def download_resource(self, link: str, type: str) -> Resource:
+        url, headers = self._get_download_request(link)
+        return await download_resource(url, type, headers)
+
+    async def download_file_prefix(self, link: str, size: int) -> bytes:
+        url, headers = self._get_download_request(link)
+        return await download_file_prefix(url, size, headers)
+
+    async def get_cached_resource(
+        self, link: str, type: str
+    ) -> Optional[Resource]:
+        url, headers = self._get_download_request(link)
+        return await get_cached_resource(url, type, headers)
+
     async def get_human_readable_name(self, link: str) -> str:
         url = self.attachment_link_to_url(link)
         link = self._url_to_attachment_link(url)
@@ -128,8 +196,7 @@ class FileStorage(BaseModel):
         if link.startswith("public/"):
             bucket = "public"
         else:
-            async with aiohttp.ClientSession() as session:
-                bucket = await self._get_user_bucket(session)
+            bucket = await self._get_user_bucket()
 
         link = link.removeprefix(f"{bucket}/")
         decoded_link = unquote(link)
@@ -137,10 +204,100 @@ class FileStorage(BaseModel):
 
 
 async def download_file(url: str, headers: Mapping[str, str] = {}) -> bytes:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            response.raise_for_status()
-            return await response.read()
+    async with get_storage_session().get(
+        url, headers=headers, timeout=get_aiohttp_timeout()
+    ) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+async def download_file_prefix(
+    url: str, size: int, headers: Mapping[str, str] = {}
+) -> bytes:
+    """
+    Downloads the first bytes of the file with a range request.
+    The servers ignoring the range are read up to the requested size.
+    """
+
+    async with get_storage_session().get(
+        url,
+        headers={**headers, "Range": f"bytes=0-{size - 1}"},
+        timeout=get_aiohttp_timeout(),
+    ) as response:
+        response.raise_for_status()
+
+        data = b""
+        while len(data) < size and (
+            chunk := await response.content.read(size - len(data))
+        ):
+            data += chunk
+        return data
+
+
+# The downloads of the same file with the same credentials in flight:
+# DIAL checks the access of every caller to the file
+_downloads: SingleFlight[
+    Tuple[CacheKey, Tuple[Tuple[str, str], ...]], Resource
+] = SingleFlight()
+
+
+async def download_resource(
+    url: str, type: str, headers: Mapping[str, str] = {}
+) -> Resource:
+    """
+    Downloads the file unless its cached copy is still valid.
+    The concurrent downloads of the same file by the same caller
+    share a single transfer.
+    """
+
+    resource = await _downloads.run(
+        (url, tuple(sorted(headers.items()))),
+        lambda: _download_resource(url, type, headers),
+    )
+    return resource.with_type(type)
+
+
+async def get_cached_resource(
+    url: str, type: str, headers: Mapping[str, str] = {}
+) -> Optional[Resource]:
+    """
+    Returns the cached copy of the file, if any, revalidated
+    with the credentials of the caller, which checks its access to the file.
+    """
+
+    if download_cache is None or await download_cache.get(url) is None:
+        return None
+    return await download_resource(url, type, headers)
+
+
+async def _download_resource(
+    url: str, type: str, headers: Mapping[str, str]
+) -> Resource:
+    if download_cache is None:
+        return Resource(type=type, data=await download_file(url, headers))
+
+    cached = await download_cache.get(url)
+
+    request_headers = dict(headers)
+    if cached is not None:
+        request_headers["If-None-Match"] = cached.etag
+
+    async with get_storage_session().get(
+        url, headers=request_headers, timeout=get_aiohttp_timeout()
+    ) as response:
+        if cached is not None and response.status == 304:
+            return cached.resource
+
+        response.raise_for_status()
+        data = await response.read()
+        etag = response.headers.get("ETag")
+
+    resource = Resource(type=type, data=data)
+    if etag is not None:
+        await download_cache.put(url, CachedDownload(resource, etag))
+    elif cached is not None:
+        await download_cache.pop(url)
+    return resource
 
 
 def _compute_hash_digest(file_content: str) -> str:
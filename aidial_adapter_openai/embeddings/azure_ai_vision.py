@@ -46,7 +46,10 @@ from aidial_adapter_openai.dial_api.embedding_inputs import (
 from aidial_adapter_openai.dial_api.resource import AttachmentResource
 from aidial_adapter_openai.dial_api.storage import FileStorage
 from aidial_adapter_openai.utils.auth import OpenAICreds
+from aidial_adapter_openai.utils.deadline import get_aiohttp_timeout
+from aidial_adapter_openai.utils.image_executor import run_in_thread
 from aidial_adapter_openai.utils.resource import Resource
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 # The latest Image Analysis API offers two models:
 # * version 2023-04-15 which supports text search in many languages,
@@ -109,16 +112,19 @@ async def embeddings(
         else:
             assert_never(input)
 
-    async with aiohttp.ClientSession(
-        raise_for_status=_error_handler,
-        headers=_get_auth_headers(creds),
-    ) as session:
-        tasks = [
-            asyncio.create_task(_get_embedding(session, input_))
-            for input_ in inputs
-        ]
+    async def _get_embeddings() -> List[VectorizeResponse]:
+        async with aiohttp.ClientSession(
+            raise_for_status=_error_handler,
+            headers=_get_auth_headers(creds),
+            timeout=get_aiohttp_timeout(),
+        ) as session:
+            tasks = [
+                asyncio.create_task(_get_embedding(session, input_))
+                for input_ in inputs
+            ]
+            return await asyncio.gather(*tasks)
 
-        responses = await asyncio.gather(*tasks)
+    responses = await call_upstream_request(_get_embeddings)
 
     vectors = [
         Embedding(embedding=r.vector, index=idx)
@@ -140,7 +146,9 @@ async def _get_image_embedding(
         url=endpoint.rstrip("/") + "/computervision/retrieval:vectorizeImage",
         params=_VERSION_PARAMS,
         headers={"content-type": resource.type},
-        data=resource.data,
+        data=await run_in_thread(
+            lambda: resource.data, size=resource.data_size
+        ),
     )
 
     return VectorizeResponse.parse_obj(await resp.json())
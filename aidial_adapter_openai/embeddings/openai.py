@@ -3,6 +3,7 @@ from openai.types.create_embedding_response import CreateEmbeddingResponse
 from aidial_adapter_openai.utils.auth import OpenAICreds
 from aidial_adapter_openai.utils.parsers import embeddings_parser
 from aidial_adapter_openai.utils.reflection import call_with_extra_body
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 
 async def embeddings(
@@ -12,8 +13,10 @@ async def embeddings(
     data: dict,
 ) -> CreateEmbeddingResponse:
 
-    client = embeddings_parser.parse(upstream_endpoint).get_client(
-        {**creds, "api_version": api_version}
+    client = embeddings_parser.get_client(
+        upstream_endpoint, {**creds, "api_version": api_version}
     )
 
-    return await call_with_extra_body(client.embeddings.create, data)
+    return await call_upstream_request(
+        lambda: call_with_extra_body(client.embeddings.create, data)
+    )
@@ -2,7 +2,7 @@ from typing import assert_never
 
 from fastapi import Request
 
-from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.app_config import ApplicationConfig, UpstreamConfig
 from aidial_adapter_openai.completions import chat_completion as completion
 from aidial_adapter_openai.constant import ChatCompletionDeploymentType
 from aidial_adapter_openai.dalle3 import (
@@ -20,7 +20,14 @@ from aidial_adapter_openai.gpt4_multi_modal.chat_completion import (
 from aidial_adapter_openai.mistral import (
     chat_completion as mistral_chat_completion,
 )
-from aidial_adapter_openai.utils.auth import get_credentials
+from aidial_adapter_openai.utils.auth import get_upstream_credentials
+from aidial_adapter_openai.utils.concurrency_limiter import limit_concurrency
+from aidial_adapter_openai.utils.deadline import (
+    check_deadline,
+    set_request_deadline,
+)
+from aidial_adapter_openai.utils.fair_queue import Priority, get_queue_ticket
+from aidial_adapter_openai.utils.hedging import call_with_hedging
 from aidial_adapter_openai.utils.image_tokenizer import get_image_tokenizer
 from aidial_adapter_openai.utils.parsers import completions_parser, parse_body
 from aidial_adapter_openai.utils.request import (
@@ -28,6 +35,7 @@ from aidial_adapter_openai.utils.request import (
     get_request_app_config,
 )
 from aidial_adapter_openai.utils.streaming import create_server_response
+from aidial_adapter_openai.utils.token_budget import set_request_token_budgets
 from aidial_adapter_openai.utils.tokenizer import (
     MultiModalTokenizer,
     PlainTextTokenizer,
@@ -40,7 +48,10 @@ async def call_chat_completion(
     is_stream: bool,
     request: Request,
     app_config: ApplicationConfig,
+    upstream: UpstreamConfig,
 ):
+    # The request may have been waiting in the queue past its deadline
+    check_deadline("calling the upstream")
 
     # Azure OpenAI deployments ignore "model" request field,
     # since the deployment id is already encoded in the endpoint path.
@@ -52,10 +63,10 @@ async def call_chat_completion(
     # The same goes for /embeddings endpoint.
     data["model"] = deployment_id
 
-    creds = await get_credentials(request)
+    creds = await get_upstream_credentials(upstream.key)
     api_version = get_api_version(request)
 
-    upstream_endpoint = request.headers["X-UPSTREAM-ENDPOINT"]
+    upstream_endpoint = upstream.endpoint
 
     if completions_endpoint := completions_parser.parse(upstream_endpoint):
         return await completion(
@@ -101,6 +112,7 @@ async def call_chat_completion(
                 api_version,
                 tokenizer,
                 app_config.ELIMINATE_EMPTY_CHOICES,
+                app_config.IMAGE_OPTIMIZATION.get(deployment_id),
             )
         case (
             ChatCompletionDeploymentType.GPT4O
@@ -121,6 +133,7 @@ async def call_chat_completion(
                 api_version,
                 tokenizer,
                 app_config.ELIMINATE_EMPTY_CHOICES,
+                app_config.IMAGE_OPTIMIZATION.get(deployment_id),
             )
         case ChatCompletionDeploymentType.GPT_TEXT_ONLY:
             tokenizer = PlainTextTokenizer(
@@ -141,6 +154,8 @@ async def call_chat_completion(
 
 async def chat_completion(deployment_id: str, request: Request):
     app_config = get_request_app_config(request)
+    set_request_deadline(request, app_config, deployment_id)
+    set_request_token_budgets(request)
     data = await parse_body(request)
 
     is_stream = bool(data.get("stream"))
@@ -154,7 +169,27 @@ async def chat_completion(deployment_id: str, request: Request):
 
     return create_server_response(
         emulate_streaming,
-        await call_chat_completion(
-            deployment_id, data, is_stream, request, app_config
+        await limit_concurrency(
+            deployment_id,
+            request,
+            lambda: call_with_hedging(
+                deployment_id,
+                request,
+                data,
+                lambda upstream, data: call_chat_completion(
+                    deployment_id,
+                    data,
+                    is_stream,
+                    request,
+                    app_config,
+                    upstream,
+                ),
+            ),
+            # Streaming responses are watched by the users in real time
+            get_queue_ticket(
+                request,
+                app_config,
+                Priority.HIGH if is_stream else Priority.NORMAL,
+            ),
         ),
     )
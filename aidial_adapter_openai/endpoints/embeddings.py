@@ -1,5 +1,6 @@
 from fastapi import Request
 
+from aidial_adapter_openai.app_config import ApplicationConfig, UpstreamConfig
 from aidial_adapter_openai.dial_api.storage import create_file_storage
 from aidial_adapter_openai.embeddings.azure_ai_vision import (
     embeddings as azure_ai_vision_embeddings,
@@ -7,29 +8,70 @@ from aidial_adapter_openai.embeddings.azure_ai_vision import (
 from aidial_adapter_openai.embeddings.openai import (
     embeddings as openai_embeddings,
 )
-from aidial_adapter_openai.utils.auth import get_credentials
+from aidial_adapter_openai.utils.auth import (
+    AZURE_AI_VISION_SCOPE,
+    get_upstream_credentials,
+)
+from aidial_adapter_openai.utils.concurrency_limiter import limit_concurrency
+from aidial_adapter_openai.utils.deadline import (
+    check_deadline,
+    set_request_deadline,
+)
+from aidial_adapter_openai.utils.fair_queue import Priority, get_queue_ticket
+from aidial_adapter_openai.utils.hedging import call_with_hedging
 from aidial_adapter_openai.utils.parsers import parse_body
 from aidial_adapter_openai.utils.request import (
     get_api_version,
     get_request_app_config,
 )
+from aidial_adapter_openai.utils.token_budget import set_request_token_budgets
 
 
-async def embedding(deployment_id: str, request: Request):
-    app_config = get_request_app_config(request)
-    data = await parse_body(request)
+async def call_embedding(
+    deployment_id: str,
+    data: dict,
+    request: Request,
+    app_config: ApplicationConfig,
+    upstream: UpstreamConfig,
+):
+    # The request may have been waiting in the queue past its deadline
+    check_deadline("calling the upstream")
 
     # See note for /chat/completions endpoint
     data["model"] = deployment_id
 
-    creds = await get_credentials(request)
     api_version = get_api_version(request)
-    upstream_endpoint = request.headers["X-UPSTREAM-ENDPOINT"]
+    upstream_endpoint = upstream.endpoint
 
     if deployment_id in app_config.AZURE_AI_VISION_DEPLOYMENTS:
+        creds = await get_upstream_credentials(
+            upstream.key, AZURE_AI_VISION_SCOPE
+        )
         storage = create_file_storage("images", request.headers)
         return await azure_ai_vision_embeddings(
             creds, deployment_id, upstream_endpoint, storage, data
         )
 
+    creds = await get_upstream_credentials(upstream.key)
     return await openai_embeddings(creds, upstream_endpoint, api_version, data)
+
+
+async def embedding(deployment_id: str, request: Request):
+    app_config = get_request_app_config(request)
+    set_request_deadline(request, app_config, deployment_id)
+    set_request_token_budgets(request)
+    data = await parse_body(request)
+
+    return await limit_concurrency(
+        deployment_id,
+        request,
+        lambda: call_with_hedging(
+            deployment_id,
+            request,
+            data,
+            lambda upstream, data: call_embedding(
+                deployment_id, data, request, app_config, upstream
+            ),
+        ),
+        get_queue_ticket(request, app_config, Priority.LOW),
+    )
@@ -1,2 +1,10 @@
-def health():
-    return {"status": "ok"}
+from fastapi import Request
+
+from aidial_adapter_openai.utils.circuit_breaker import get_circuit_breakers
+
+
+def health(request: Request):
+    return {
+        "status": "ok",
+        "circuit_breakers": get_circuit_breakers(request.app).get_states(),
+    }
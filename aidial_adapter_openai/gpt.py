@@ -1,11 +1,11 @@
 from typing import AsyncIterator, List, Tuple, cast
 
 from aidial_sdk.exceptions import InvalidRequestError
-from openai import AsyncStream
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 
 from aidial_adapter_openai.utils.auth import OpenAICreds
+from aidial_adapter_openai.utils.deadline import check_deadline
 from aidial_adapter_openai.utils.parsers import chat_completions_parser
 from aidial_adapter_openai.utils.reflection import call_with_extra_body
 from aidial_adapter_openai.utils.streaming import (
@@ -14,12 +14,14 @@ from aidial_adapter_openai.utils.streaming import (
     generate_stream,
     map_stream,
 )
+from aidial_adapter_openai.utils.token_budget import admit_request
 from aidial_adapter_openai.utils.tokenizer import PlainTextTokenizer
 from aidial_adapter_openai.utils.truncate_prompt import (
     DiscardedMessages,
     TruncatedTokens,
     truncate_prompt,
 )
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 
 def plain_text_truncate_prompt(
@@ -46,6 +48,8 @@ async def gpt_chat_completion(
     tokenizer: PlainTextTokenizer,
     eliminate_empty_choices: bool,
 ):
+    check_deadline("tokenization")
+
     discarded_messages = None
     estimated_prompt_tokens = None
     if "max_prompt_tokens" in request:
@@ -69,18 +73,35 @@ async def gpt_chat_completion(
             )
         )
 
-    client = chat_completions_parser.parse(upstream_endpoint).get_client(
-        {**creds, "api_version": api_version}
+    def get_prompt_tokens() -> int:
+        nonlocal estimated_prompt_tokens
+        if estimated_prompt_tokens is None:
+            estimated_prompt_tokens = tokenizer.tokenize_request(
+                request, request["messages"]
+            )
+        return estimated_prompt_tokens
+
+    await admit_request(
+        deployment_id,
+        upstream_endpoint,
+        lambda: get_prompt_tokens() + (request.get("max_tokens") or 0),
     )
-    response: AsyncStream[ChatCompletionChunk] | ChatCompletion = (
-        await call_with_extra_body(client.chat.completions.create, request)
+
+    client = chat_completions_parser.get_client(
+        upstream_endpoint, {**creds, "api_version": api_version}
+    )
+    response: AsyncIterator[ChatCompletionChunk] | ChatCompletion = (
+        await call_upstream_request(
+            lambda: call_with_extra_body(
+                client.chat.completions.create, request
+            )
+        )
     )
 
     if isinstance(response, AsyncIterator):
         return generate_stream(
             stream=map_stream(chunk_to_dict, response),
-            get_prompt_tokens=lambda: estimated_prompt_tokens
-            or tokenizer.tokenize_request(request, request["messages"]),
+            get_prompt_tokens=get_prompt_tokens,
             tokenize_response=tokenizer.tokenize_response,
             deployment=deployment_id,
             discarded_messages=discarded_messages,
@@ -16,6 +16,7 @@ from aidial_sdk.exceptions import HTTPException as DialException
 from aidial_sdk.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse, Response
 
+from aidial_adapter_openai.app_config import ImageOptimizationConfig
 from aidial_adapter_openai.dial_api.storage import FileStorage
 from aidial_adapter_openai.gpt4_multi_modal.gpt4_vision import (
     convert_gpt4v_to_gpt4_chunk,
@@ -28,6 +29,11 @@ from aidial_adapter_openai.utils.auth import OpenAICreds, get_auth_headers
 from aidial_adapter_openai.utils.chat_completion_response import (
     ChatCompletionBlock,
 )
+from aidial_adapter_openai.utils.deadline import (
+    check_deadline,
+    get_aiohttp_timeout,
+)
+from aidial_adapter_openai.utils.json_body import JSONBody
 from aidial_adapter_openai.utils.log_config import logger
 from aidial_adapter_openai.utils.multi_modal_message import MultiModalMessage
 from aidial_adapter_openai.utils.sse_stream import parse_openai_sse_stream
@@ -38,12 +44,17 @@ from aidial_adapter_openai.utils.streaming import (
     map_stream,
     prepend_to_stream,
 )
+from aidial_adapter_openai.utils.token_budget import (
+    admit_request,
+    observe_rate_limit_headers,
+)
 from aidial_adapter_openai.utils.tokenizer import MultiModalTokenizer
 from aidial_adapter_openai.utils.truncate_prompt import (
     DiscardedMessages,
     TruncatedTokens,
     truncate_prompt,
 )
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 # The built-in default max_tokens is 16 tokens,
 # which is too small for most image-to-text use cases.
@@ -90,10 +101,12 @@ async def predict_stream(
 async def predict_stream_raw(
     api_url: str, headers: Dict[str, str], request: Any
 ) -> AsyncIterator[bytes | Response]:
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=get_aiohttp_timeout()) as session:
+        body = JSONBody(request)
         async with session.post(
-            api_url, json=request, headers=headers
+            api_url, data=body, headers={**headers, **body.headers}
         ) as response:
+            observe_rate_limit_headers(api_url, response.headers)
             if response.status != 200:
                 yield JSONResponse(
                     status_code=response.status, content=await response.json()
@@ -107,10 +120,12 @@ async def predict_stream_raw(
 async def predict_non_stream(
     api_url: str, headers: Dict[str, str], request: Any
 ) -> dict | JSONResponse:
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=get_aiohttp_timeout()) as session:
+        body = JSONBody(request)
         async with session.post(
-            api_url, json=request, headers=headers
+            api_url, data=body, headers={**headers, **body.headers}
         ) as response:
+            observe_rate_limit_headers(api_url, response.headers)
             if response.status != 200:
                 return JSONResponse(
                     status_code=response.status, content=await response.json()
@@ -118,12 +133,15 @@ async def predict_non_stream(
             return await response.json()
 
 
+_M = TypeVar("_M", bound=MultiModalMessage)
+
+
 def multi_modal_truncate_prompt(
     request: dict,
-    messages: List[MultiModalMessage],
+    messages: List[_M],
     max_prompt_tokens: int,
     tokenizer: MultiModalTokenizer,
-) -> Tuple[List[MultiModalMessage], DiscardedMessages, TruncatedTokens]:
+) -> Tuple[List[_M], DiscardedMessages, TruncatedTokens]:
     return truncate_prompt(
         messages=messages,
         message_tokens=tokenizer.tokenize_request_message,
@@ -144,6 +162,7 @@ async def gpt4o_chat_completion(
     api_version: str,
     tokenizer: MultiModalTokenizer,
     eliminate_empty_choices: bool,
+    image_optimization: Optional[ImageOptimizationConfig],
 ):
     return await chat_completion(
         request,
@@ -157,6 +176,7 @@ async def gpt4o_chat_completion(
         lambda x: x,
         None,
         eliminate_empty_choices,
+        image_optimization,
     )
 
 
@@ -170,6 +190,7 @@ async def gpt4_vision_chat_completion(
     api_version: str,
     tokenizer: MultiModalTokenizer,
     eliminate_empty_choices: bool,
+    image_optimization: Optional[ImageOptimizationConfig],
 ):
     return await chat_completion(
         request,
@@ -183,9 +204,16 @@ async def gpt4_vision_chat_completion(
         convert_gpt4v_to_gpt4_chunk,
         GPT4V_DEFAULT_MAX_TOKENS,
         eliminate_empty_choices,
+        image_optimization,
     )
 
 
+def _create_transformation_error(error: DialException, is_stream: bool):
+    logger.error(f"Failed to prepare request: {error.message}")
+    chunk = create_stage_chunk("Usage", USAGE, is_stream)
+    return create_response_from_chunk(chunk, error, is_stream)
+
+
 async def chat_completion(
     request: Any,
     deployment: str,
@@ -198,6 +226,7 @@ async def chat_completion(
     response_transformer: Callable[[dict], dict | None],
     default_max_tokens: Optional[int],
     eliminate_empty_choices: bool,
+    image_optimization: Optional[ImageOptimizationConfig],
 ):
     if request.get("n", 1) > 1:
         raise RequestValidationError("The deployment doesn't support n > 1")
@@ -208,23 +237,24 @@ async def chat_completion(
 
     api_url = f"{upstream_endpoint}?api-version={api_version}"
 
-    transform_result = await ResourceProcessor(
-        file_storage=file_storage
-    ).transform_messages(messages)
+    # The images are downloaded only for the messages kept after truncation
+    processor = ResourceProcessor(
+        file_storage=file_storage, image_optimization=image_optimization
+    )
+    probe_result = await processor.probe_messages(messages)
+    if isinstance(probe_result, DialException):
+        return _create_transformation_error(probe_result, is_stream)
 
-    if isinstance(transform_result, DialException):
-        logger.error(f"Failed to prepare request: {transform_result.message}")
-        chunk = create_stage_chunk("Usage", USAGE, is_stream)
-        return create_response_from_chunk(chunk, transform_result, is_stream)
+    check_deadline("tokenization")
 
-    multi_modal_messages = transform_result
+    lazy_messages = probe_result
     discarded_messages = None
     max_prompt_tokens = request.pop("max_prompt_tokens", None)
     if max_prompt_tokens is not None:
-        multi_modal_messages, discarded_messages, estimated_prompt_tokens = (
+        lazy_messages, discarded_messages, estimated_prompt_tokens = (
             multi_modal_truncate_prompt(
                 request=request,
-                messages=multi_modal_messages,
+                messages=lazy_messages,
                 max_prompt_tokens=max_prompt_tokens,
                 tokenizer=tokenizer,
             )
@@ -234,22 +264,41 @@ async def chat_completion(
         )
     else:
         estimated_prompt_tokens = tokenizer.tokenize_request(
-            request, multi_modal_messages
+            request, lazy_messages
         )
         logger.debug(
             f"prompt tokens without truncation: {estimated_prompt_tokens}"
         )
 
+    check_deadline("loading the images")
+    transform_result = await processor.load_messages(lazy_messages)
+    if isinstance(transform_result, DialException):
+        return _create_transformation_error(transform_result, is_stream)
+
+    if processor.images_changed:
+        # The images changed since they were probed are tokenized anew
+        estimated_prompt_tokens = tokenizer.tokenize_request(
+            request, transform_result
+        )
+
     request = {
         **request,
         "max_tokens": request.get("max_tokens") or default_max_tokens,
-        "messages": [m.raw_message for m in multi_modal_messages],
+        "messages": [m.raw_message for m in transform_result],
     }
 
     headers = get_auth_headers(creds)
 
+    await admit_request(
+        deployment,
+        upstream_endpoint,
+        lambda: estimated_prompt_tokens + (request["max_tokens"] or 0),
+    )
+
     if is_stream:
-        response = await predict_stream(api_url, headers, request)
+        response = await call_upstream_request(
+            lambda: predict_stream(api_url, headers, request)
+        )
         if isinstance(response, Response):
             return response
 
@@ -274,7 +323,9 @@ async def chat_completion(
             ),
         )
     else:
-        response = await predict_non_stream(api_url, headers, request)
+        response = await call_upstream_request(
+            lambda: predict_non_stream(api_url, headers, request)
+        )
         if isinstance(response, Response):
             return response
 
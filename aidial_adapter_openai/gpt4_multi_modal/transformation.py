@@ -1,10 +1,27 @@
+import asyncio
+import hashlib
+import json
+import os
+import weakref
 from dataclasses import dataclass
-from typing import List, Optional, Set, cast
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    cast,
+)
 
 from aidial_sdk.exceptions import HTTPException as DialException
 from aidial_sdk.exceptions import InvalidRequestError
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
+from aidial_adapter_openai.app_config import ImageOptimizationConfig
 from aidial_adapter_openai.dial_api.resource import (
     AttachmentResource,
     DialResource,
@@ -13,7 +30,20 @@ from aidial_adapter_openai.dial_api.resource import (
     parse_attachment,
 )
 from aidial_adapter_openai.dial_api.storage import FileStorage
-from aidial_adapter_openai.utils.image import ImageDetail, ImageMetadata
+from aidial_adapter_openai.utils.cache import LRUCache
+from aidial_adapter_openai.utils.deadline import check_deadline
+from aidial_adapter_openai.utils.image import (
+    ImageDetail,
+    ImageMetadata,
+    get_image_size,
+    optimize_image,
+)
+from aidial_adapter_openai.utils.image_executor import (
+    run_in_process,
+    run_in_thread,
+)
+from aidial_adapter_openai.utils.image_size import parse_image_size
+from aidial_adapter_openai.utils.image_tokenizer import get_processed_size
 from aidial_adapter_openai.utils.log_config import logger
 from aidial_adapter_openai.utils.multi_modal_message import (
     MultiModalMessage,
@@ -27,6 +57,78 @@ from aidial_adapter_openai.utils.text import decapitalize
 SUPPORTED_IMAGE_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif"]
 SUPPORTED_FILE_EXTS = ["jpg", "jpeg", "png", "webp", "gif"]
 
+# Limits of the images downloaded at once by a request and by all requests
+IMAGE_DOWNLOAD_CONCURRENCY_PER_REQUEST = int(
+    os.getenv("IMAGE_DOWNLOAD_CONCURRENCY_PER_REQUEST", 8)
+)
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", 64))
+
+# The number of the first bytes of an image to read its size from
+IMAGE_PROBE_SIZE = int(os.getenv("IMAGE_PROBE_SIZE", 64 * 1024))
+
+# The number of the probed messages cached per worker and for how long
+TRANSFORMED_MESSAGE_CACHE_SIZE = int(
+    os.getenv("TRANSFORMED_MESSAGE_CACHE_SIZE", 4096)
+)
+TRANSFORMED_MESSAGE_CACHE_TTL = float(
+    os.getenv("TRANSFORMED_MESSAGE_CACHE_TTL", 3600)
+)
+
+T = TypeVar("T")
+
+# The semaphore is bound to the event loop it's used in
+_download_semaphores: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, asyncio.Semaphore
+] = weakref.WeakKeyDictionary()
+
+
+def _get_download_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _download_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _download_semaphores[loop] = asyncio.Semaphore(
+            IMAGE_DOWNLOAD_CONCURRENCY
+        )
+    return semaphore
+
+
+@dataclass
+class _ProbedMessage:
+    """
+    The image sizes and the token counts of a message,
+    which are reused when the message is resent as a part of the history.
+    The images themselves aren't kept.
+    """
+
+    image_metadatas: List[ImageMetadata]
+    tokens: Dict[Hashable, int]
+
+
+def _create_message_cache() -> LRUCache[str, _ProbedMessage] | None:
+    if TRANSFORMED_MESSAGE_CACHE_SIZE <= 0:
+        return None
+    return LRUCache(
+        maxsize=TRANSFORMED_MESSAGE_CACHE_SIZE,
+        ttl=TRANSFORMED_MESSAGE_CACHE_TTL,
+    )
+
+
+message_cache = _create_message_cache()
+
+
+def _get_message_cache_key(
+    message: dict, file_storage: FileStorage | None, has_images: bool
+) -> str:
+    # The sizes of the images are restored only for the same credentials,
+    # which DIAL has checked the access to the images with
+    dial_url = credentials = None
+    if file_storage is not None:
+        dial_url = file_storage.dial_url
+        if has_images:
+            credentials = [file_storage.auth.name, file_storage.auth.value]
+    data = json.dumps([dial_url, credentials, message], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
 
 @dataclass(order=True, frozen=True)
 class TransformationError:
@@ -34,70 +136,166 @@ class TransformationError:
     message: str
 
 
+class ImageReference(BaseModel):
+    """
+    The image attached to a message, which is downloaded
+    only if the message survives the prompt truncation.
+    """
+
+    resource: DialResource
+    metadata: ImageMetadata
+    detail: Optional[ImageDetail] = None
+
+
+class LazyMultiModalMessage(MultiModalMessage):
+    """
+    The message with the image sizes required for the tokenization,
+    but without the attached images inlined into its content yet.
+    """
+
+    attachments: List[ImageReference] = Field(default_factory=list)
+    cache_key: Optional[str] = None
+
+
 class ResourceProcessor(BaseModel):
+    """
+    Transforms the messages in two phases:
+    1. the sizes of the images are retrieved to tokenize the messages,
+    2. the attached images are inlined into the messages which are kept
+    after the prompt truncation.
+    """
+
     class Config:
         arbitrary_types_allowed = True  # for errors
 
     file_storage: FileStorage | None
+    image_optimization: Optional[ImageOptimizationConfig] = None
     errors: Set[TransformationError] = Field(default_factory=set)
+    # Whether any image differs in size from the one probed before
+    images_changed: bool = False
 
-    def collect_resource(
+    _semaphore: asyncio.Semaphore = PrivateAttr(
+        default_factory=lambda: asyncio.Semaphore(
+            IMAGE_DOWNLOAD_CONCURRENCY_PER_REQUEST
+        )
+    )
+
+    async def _try_download(
         self,
-        meta: List[ImageMetadata],
-        result: Resource | TransformationError,
-        detail: Optional[ImageDetail],
-    ):
-        if isinstance(result, TransformationError):
-            self.errors.add(result)
-        else:
-            meta.append(ImageMetadata.from_resource(result, detail))
+        dial_resource: DialResource,
+        download: Callable[[], Awaitable[T]],
+    ) -> T | TransformationError:
+        async with self._semaphore, _get_download_semaphore():
+            check_deadline(f"downloading the {dial_resource.entity_name}")
+            try:
+                return await download()
+            except Exception as e:
+                logger.error(
+                    f"Failed to download {dial_resource.entity_name}: {str(e)}"
+                )
+
+                name = await dial_resource.get_resource_name(self.file_storage)
+                message = (
+                    e.message
+                    if isinstance(e, ValidationError)
+                    else f"Failed to download the {dial_resource.entity_name}"
+                )
+                return TransformationError(name=name, message=message)
 
     async def try_download_resource(
         self, dial_resource: DialResource
     ) -> Resource | TransformationError:
-        try:
-            resource = await dial_resource.download(self.file_storage)
-        except Exception as e:
-            logger.error(
-                f"Failed to download {dial_resource.entity_name}: {str(e)}"
-            )
+        return await self._try_download(
+            dial_resource, lambda: dial_resource.download(self.file_storage)
+        )
+
+    async def _get_image_size(
+        self, dial_resource: DialResource
+    ) -> Tuple[int, int] | None:
+        if (
+            cached := await dial_resource.get_cached(self.file_storage)
+        ) is not None:
+            return get_image_size(cached)
+
+        header = await dial_resource.download_prefix(
+            self.file_storage, IMAGE_PROBE_SIZE
+        )
+        return None if header is None else parse_image_size(header)
+
+    async def try_probe_resource(
+        self, dial_resource: DialResource, detail: Optional[ImageDetail]
+    ) -> ImageReference | TransformationError:
+        """
+        Retrieves the image size from the earlier downloaded copy
+        of the image or from the beginning of the image.
+        The whole image is downloaded only if both fail.
+        """
 
-            name = await dial_resource.get_resource_name(self.file_storage)
-            message = (
-                e.message
-                if isinstance(e, ValidationError)
-                else f"Failed to download the {dial_resource.entity_name}"
+        size = await self._try_download(
+            dial_resource, lambda: self._get_image_size(dial_resource)
+        )
+        if isinstance(size, TransformationError):
+            return size
+
+        if size is not None:
+            # The image is downloaded or revalidated if it's needed
+            metadata = ImageMetadata.from_size(*size, detail)
+        else:
+            result = await self.try_download_resource(dial_resource)
+            if isinstance(result, TransformationError):
+                return result
+            metadata = await run_in_thread(
+                ImageMetadata.from_resource,
+                result,
+                detail,
+                size=result.data_size,
             )
-            return TransformationError(name=name, message=message)
 
-        return resource
+        return ImageReference(
+            resource=dial_resource, metadata=metadata, detail=detail
+        )
 
-    async def download_attachment_images(
-        self, attachments: List[dict]
-    ) -> List[ImageMetadata]:
-        if attachments:
-            logger.debug(f"original attachments: {attachments}")
+    async def probe_resources(
+        self, resources: List[Tuple[DialResource, Optional[ImageDetail]]]
+    ) -> List[ImageReference]:
+        """
+        Probes the resources at once, keeping the order of their metadata.
+        """
 
-        ret: List[ImageMetadata] = []
+        results = await asyncio.gather(
+            *(
+                self.try_probe_resource(resource, detail)
+                for resource, detail in resources
+            )
+        )
+
+        ret: List[ImageReference] = []
+        for result in results:
+            if isinstance(result, TransformationError):
+                self.errors.add(result)
+            else:
+                ret.append(result)
+        return ret
 
-        for attachment in attachments:
-            dial_resource = AttachmentResource(
+    def _get_attachment_resources(
+        self, attachments: List[dict]
+    ) -> List[AttachmentResource]:
+        return [
+            AttachmentResource(
                 attachment=parse_attachment(attachment),
                 entity_name="image attachment",
                 supported_types=SUPPORTED_IMAGE_TYPES,
             )
-            result = await self.try_download_resource(dial_resource)
-            self.collect_resource(ret, result, None)
-
-        return ret
+            for attachment in attachments
+        ]
 
-    async def download_content_images(
+    def _get_content_resources(
         self, content: str | list
-    ) -> List[ImageMetadata]:
+    ) -> List[Tuple[DialResource, Optional[ImageDetail]]]:
         if isinstance(content, str):
             return []
 
-        ret: List[ImageMetadata] = []
+        resources: List[Tuple[DialResource, Optional[ImageDetail]]] = []
 
         for content_part in content:
             image_url = content_part.get("image_url")
@@ -111,54 +309,264 @@ class ResourceProcessor(BaseModel):
                     entity_name="image",
                     supported_types=SUPPORTED_IMAGE_TYPES,
                 )
-                result = await self.try_download_resource(dial_resource)
-                self.collect_resource(ret, result, detail)
+                resources.append((dial_resource, detail))
 
-        return ret
+        return resources
 
-    async def transform_message(self, message: dict) -> MultiModalMessage:
+    async def probe_message(self, message: dict) -> LazyMultiModalMessage:
+        original_message = message
         message = message.copy()
 
         content = message.get("content") or ""
         custom_content = message.pop("custom_content", None) or {}
         attachments = custom_content.get("attachments") or []
+        if attachments:
+            logger.debug(f"original attachments: {attachments}")
+
+        attachment_resources = self._get_attachment_resources(attachments)
+        content_resources = self._get_content_resources(content)
+
+        cache_key = None
+        if message_cache is not None:
+            cache_key = _get_message_cache_key(
+                original_message,
+                self.file_storage,
+                has_images=bool(attachment_resources or content_resources),
+            )
+            if (probed := message_cache.get(cache_key)) is not None:
+                return self._restore_message(
+                    message, attachment_resources, probed, cache_key
+                )
+
+        attachment_refs, content_refs = await asyncio.gather(
+            self.probe_resources(
+                [(resource, None) for resource in attachment_resources]
+            ),
+            self.probe_resources(content_resources),
+        )
+
+        result = LazyMultiModalMessage(
+            image_metadatas=[
+                ref.metadata for ref in [*content_refs, *attachment_refs]
+            ],
+            raw_message=message,
+            attachments=attachment_refs,
+            cache_key=cache_key,
+        )
+
+        # The messages with the images failed to process aren't cached
+        if (
+            cache_key is not None
+            and message_cache is not None
+            and len(attachment_refs) == len(attachment_resources)
+            and len(content_refs) == len(content_resources)
+        ):
+            message_cache.put(
+                cache_key,
+                _ProbedMessage(
+                    image_metadatas=[
+                        meta.copy(update={"image": None})
+                        for meta in result.image_metadatas
+                    ],
+                    tokens=result._tokens,
+                ),
+            )
+
+        return result
+
+    def _restore_message(
+        self,
+        message: dict,
+        attachment_resources: List[AttachmentResource],
+        probed: "_ProbedMessage",
+        cache_key: str,
+    ) -> LazyMultiModalMessage:
+        """
+        Restores the message sent before from the cache,
+        so that its images aren't probed again.
+        The attached images are still downloaded, or revalidated
+        in the download cache, if the message is kept after truncation.
+        """
+
+        metadatas = probed.image_metadatas
+        attachment_metas = metadatas[
+            len(metadatas) - len(attachment_resources) :
+        ]
+
+        result = LazyMultiModalMessage(
+            image_metadatas=metadatas,
+            raw_message=message,
+            attachments=[
+                ImageReference(resource=resource, metadata=metadata)
+                for resource, metadata in zip(
+                    attachment_resources, attachment_metas
+                )
+            ],
+            cache_key=cache_key,
+        )
+        # The token counts of the cached message aren't modified by the request
+        result._tokens = dict(probed.tokens)
+        return result
+
+    async def try_load_image(
+        self, ref: ImageReference
+    ) -> ImageMetadata | TransformationError:
+        metadata = ref.metadata
+        image = metadata.image
+        if image is None:
+            result = await self.try_download_resource(ref.resource)
+            if isinstance(result, TransformationError):
+                return result
+            image = result
+            metadata = await self._get_loaded_metadata(ref, image)
+
+        if self.image_optimization is not None:
+            image = await self.optimize_image(image, metadata)
+
+        # The image size is known already, so a base64 image isn't decoded
+        return metadata.copy(update={"image": image})
+
+    async def _get_loaded_metadata(
+        self, ref: ImageReference, image: Resource
+    ) -> ImageMetadata:
+        """
+        The image restored from the message cache may have changed by the time it's downloaded, so the size of
+        the downloaded image is read again. The base64 images are
+        a part of the message itself, so they can't change.
+        """
+
+        if image._data is None:
+            return ref.metadata
+
+        size = image._image_size or parse_image_size(
+            image.data[:IMAGE_PROBE_SIZE]
+        )
+        if size is None:
+            try:
+                size = await run_in_thread(
+                    get_image_size, image, size=image.data_size
+                )
+            except Exception as e:
+                logger.warning(f"Failed to read the image size: {str(e)}")
+                return ref.metadata
+        image._image_size = size
+
+        if size == (ref.metadata.width, ref.metadata.height):
+            return ref.metadata
+
+        logger.warning(
+            f"The {ref.resource.entity_name} has changed since it was probed"
+        )
+        return ImageMetadata.from_size(*size, ref.detail)
+
+    async def optimize_image(
+        self, image: Resource, metadata: ImageMetadata
+    ) -> Resource:
+        """
+        Scales the image down to the size the model processes it at
+        for the resolved detail level, so the image tokens stay the same.
+        """
+
+        config = cast(ImageOptimizationConfig, self.image_optimization)
+        size = get_processed_size(
+            metadata.width, metadata.height, metadata.detail
+        )
+        try:
+            optimized = await run_in_process(
+                optimize_image,
+                image,
+                size,
+                config.format,
+                config.quality,
+                size=image.data_size,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to optimize the image: {str(e)}")
+            return image
+        return optimized or image
+
+    async def load_message(
+        self, message: LazyMultiModalMessage
+    ) -> MultiModalMessage:
+        if not message.attachments:
+            return MultiModalMessage(
+                image_metadatas=message.image_metadatas,
+                raw_message=message.raw_message,
+            )
+
+        results = await asyncio.gather(
+            *(self.try_load_image(ref) for ref in message.attachments)
+        )
 
-        attachment_meta = await self.download_attachment_images(attachments)
-        content_meta = await self.download_content_images(content)
-        meta = [*content_meta, *attachment_meta]
+        attachment_meta: List[ImageMetadata] = []
+        for ref, result in zip(message.attachments, results):
+            if isinstance(result, TransformationError):
+                self.errors.add(result)
+                continue
 
-        if not meta:
-            return MultiModalMessage(image_metadatas=[], raw_message=message)
+            attachment_meta.append(result)
+            if (result.width, result.height) != (
+                ref.metadata.width,
+                ref.metadata.height,
+            ):
+                self.images_changed = True
+                # The stale sizes aren't reused on the next turn
+                if message.cache_key is not None and message_cache is not None:
+                    message_cache.pop(message.cache_key)
 
+        # The content images are passed to the upstream as they are
+        content_meta = message.image_metadatas[: -len(message.attachments)]
+        content = message.raw_message.get("content") or ""
         content_parts = (
             [create_text_content_part(content)]
             if isinstance(content, str)
             else content
         ) + [
-            create_image_content_part(meta.image, meta.detail)
+            create_image_content_part(cast(Resource, meta.image), meta.detail)
             for meta in attachment_meta
         ]
 
         return MultiModalMessage(
-            image_metadatas=meta,
-            raw_message={**message, "content": content_parts},
+            image_metadatas=[*content_meta, *attachment_meta],
+            raw_message={**message.raw_message, "content": content_parts},
         )
 
-    async def transform_messages(
+    async def transform_message(self, message: dict) -> MultiModalMessage:
+        return await self.load_message(await self.probe_message(message))
+
+    def _get_error(self) -> DialException | None:
+        if not self.errors:
+            return None
+
+        image_fails = sorted(list(self.errors))
+        msg = "The following files failed to process:\n"
+        msg += "\n".join(
+            f"{idx}. {error.name}: {decapitalize(error.message)}"
+            for idx, error in enumerate(image_fails, start=1)
+        )
+        return InvalidRequestError(message=msg, display_message=msg)
+
+    async def probe_messages(
         self, messages: List[dict]
-    ) -> List[MultiModalMessage] | DialException:
-        transformations = [
-            await self.transform_message(message) for message in messages
-        ]
+    ) -> List[LazyMultiModalMessage] | DialException:
+        # The resources of all the messages are probed at once
+        transformations = await asyncio.gather(
+            *(self.probe_message(message) for message in messages)
+        )
+        return self._get_error() or transformations
 
-        if self.errors:
-            image_fails = sorted(list(self.errors))
-            msg = "The following files failed to process:\n"
-            msg += "\n".join(
-                f"{idx}. {error.name}: {decapitalize(error.message)}"
-                for idx, error in enumerate(image_fails, start=1)
-            )
-            return InvalidRequestError(message=msg, display_message=msg)
+    async def load_messages(
+        self, messages: List[LazyMultiModalMessage]
+    ) -> List[MultiModalMessage] | DialException:
+        transformations = await asyncio.gather(
+            *(self.load_message(message) for message in messages)
+        )
+        return self._get_error() or transformations
 
-        transformations = cast(List[MultiModalMessage], transformations)
-        return transformations
+    async def transform_messages(
+        self, messages: List[dict]
+    ) -> List[MultiModalMessage] | DialException:
+        result = await self.probe_messages(messages)
+        if isinstance(result, DialException):
+            return result
+        return await self.load_messages(result)
@@ -1,29 +1,37 @@
-from typing import Any
+from typing import Any, AsyncIterator
 
-from openai import AsyncOpenAI, AsyncStream
+from openai import AsyncOpenAI
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 
 from aidial_adapter_openai.utils.auth import OpenAICreds
+from aidial_adapter_openai.utils.client_cache import get_cached_client
 from aidial_adapter_openai.utils.http_client import get_http_client
 from aidial_adapter_openai.utils.reflection import call_with_extra_body
 from aidial_adapter_openai.utils.streaming import chunk_to_dict, map_stream
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
 
 
 async def chat_completion(
     data: Any, upstream_endpoint: str, creds: OpenAICreds
 ):
-    client = AsyncOpenAI(
-        base_url=upstream_endpoint,
-        api_key=creds.get("api_key"),
-        http_client=get_http_client(),
+    client = get_cached_client(
+        ("mistral", upstream_endpoint),
+        creds,
+        lambda: AsyncOpenAI(
+            base_url=upstream_endpoint,
+            api_key=creds.get("api_key"),
+            http_client=get_http_client(),
+        ),
     )
 
-    response: AsyncStream[ChatCompletionChunk] | ChatCompletion = (
-        await call_with_extra_body(client.chat.completions.create, data)
+    response: AsyncIterator[ChatCompletionChunk] | ChatCompletion = (
+        await call_upstream_request(
+            lambda: call_with_extra_body(client.chat.completions.create, data)
+        )
     )
 
-    if isinstance(response, AsyncStream):
+    if isinstance(response, AsyncIterator):
         return map_stream(chunk_to_dict, response)
     else:
         return response
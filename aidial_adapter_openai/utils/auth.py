@@ -1,46 +1,101 @@
+import asyncio
 import os
 import time
-from typing import Mapping, Optional, TypedDict
+from typing import Dict, Mapping, Optional, Protocol, TypedDict
 
 from aidial_sdk.exceptions import HTTPException as DialException
 from azure.core.credentials import AccessToken
 from azure.core.exceptions import ClientAuthenticationError
 from azure.identity.aio import DefaultAzureCredential
-from fastapi import Request
 from pydantic import BaseModel
 
 from aidial_adapter_openai.utils.log_config import logger
 
 default_credential = DefaultAzureCredential()
-access_token: AccessToken | None = None
 
 EXPIRATION_WINDOW_IN_SEC: int = int(
     os.getenv("ACCESS_TOKEN_EXPIRATION_WINDOW", 10)
 )
+REFRESH_WINDOW_IN_SEC: int = max(
+    int(os.getenv("ACCESS_TOKEN_REFRESH_WINDOW", 300)),
+    EXPIRATION_WINDOW_IN_SEC,
+)
 AZURE_OPEN_AI_SCOPE: str = os.getenv(
     "AZURE_OPEN_AI_SCOPE", "https://cognitiveservices.azure.com/.default"
 )
+AZURE_AI_VISION_SCOPE: str = os.getenv(
+    "AZURE_AI_VISION_SCOPE", AZURE_OPEN_AI_SCOPE
+)
+
+
+class AsyncTokenCredential(Protocol):
+    async def get_token(self, *scopes: str) -> AccessToken: ...
+
+
+class AccessTokenManager:
+    """
+    Cache of the access tokens per scope.
+
+    Concurrent requests for a token share a single in-flight refresh.
+    A token is refreshed in the background once it enters the refresh window,
+    while the requests keep getting the cached token until it enters
+    the expiration window.
+    """
+
+    def __init__(self, credential: AsyncTokenCredential) -> None:
+        self._credential = credential
+        self._tokens: Dict[str, AccessToken] = {}
+        self._refreshes: Dict[str, asyncio.Task[AccessToken]] = {}
+
+    async def get_token(self, scope: str) -> str:
+        now = int(time.time())
+        token = self._tokens.get(scope)
 
+        if token is None or now + EXPIRATION_WINDOW_IN_SEC > token.expires_on:
+            # The request can't proceed without a fresh token.
+            # Shielding keeps the shared refresh going
+            # when one of the waiting requests is cancelled.
+            token = await asyncio.shield(self._refresh(scope))
+        elif now + REFRESH_WINDOW_IN_SEC > token.expires_on:
+            self._refresh(scope)
 
-async def get_api_key() -> str:
-    now = int(time.time())
-    global access_token
+        return token.token
 
-    if (
-        access_token is None
-        or now + EXPIRATION_WINDOW_IN_SEC > access_token.expires_on
-    ):
+    def _refresh(self, scope: str) -> asyncio.Task[AccessToken]:
+        task = self._refreshes.get(scope)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.create_task(self._fetch_token(scope))
+            task.add_done_callback(lambda task: self._on_refreshed(scope, task))
+            self._refreshes[scope] = task
+        return task
+
+    async def _fetch_token(self, scope: str) -> AccessToken:
         try:
-            access_token = await default_credential.get_token(
-                AZURE_OPEN_AI_SCOPE
-            )
+            token = await self._credential.get_token(scope)
         except ClientAuthenticationError as e:
             logger.error(
                 f"Default Azure credential failed with the error: {e.message}"
             )
             raise DialException("Authentication failed", 401, "Unauthorized")
 
-    return access_token.token
+        self._tokens[scope] = token
+        return token
+
+    def _on_refreshed(self, scope: str, task: asyncio.Task) -> None:
+        if self._refreshes.get(scope) is task:
+            del self._refreshes[scope]
+
+        # Retrieve the exception of a background refresh nobody awaited,
+        # the cached token is still valid and the refresh will be retried
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Failed to refresh the access token for {scope}")
+
+
+token_manager = AccessTokenManager(default_credential)
+
+
+async def get_api_key(scope: str = AZURE_OPEN_AI_SCOPE) -> str:
+    return await token_manager.get_token(scope)
 
 
 class OpenAICreds(TypedDict, total=False):
@@ -48,10 +103,11 @@ class OpenAICreds(TypedDict, total=False):
     azure_ad_token: str
 
 
-async def get_credentials(request: Request) -> OpenAICreds:
-    api_key = request.headers.get("X-UPSTREAM-KEY")
+async def get_upstream_credentials(
+    api_key: Optional[str], scope: str = AZURE_OPEN_AI_SCOPE
+) -> OpenAICreds:
     if api_key is None:
-        return {"azure_ad_token": await get_api_key()}
+        return {"azure_ad_token": await get_api_key(scope)}
     else:
         return {"api_key": api_key}
 
@@ -0,0 +1,265 @@
+"""
+Circuit breakers of the upstream deployments.
+
+When an upstream fails a number of times in a row (connection errors,
+timeouts or 5xx responses), its breaker opens and the requests to it
+fail immediately with 503 instead of waiting for the timeouts.
+After the recovery time a limited number of probe requests is let through:
+the breaker closes once a probe succeeds and opens again once it fails.
+"""
+
+import time
+import weakref
+from enum import IntEnum
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    NoReturn,
+    Optional,
+    TypeVar,
+)
+
+from aidial_sdk.exceptions import HTTPException as DialException
+from fastapi import FastAPI
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.log_config import logger
+from aidial_adapter_openai.utils.metrics import meter
+from aidial_adapter_openai.utils.outcome import Outcome, OutcomeCallback
+from aidial_adapter_openai.utils.token_budget import get_upstream_key
+from aidial_adapter_openai.utils.upstream_request import guard_upstream_requests
+
+T = TypeVar("T")
+
+_openings = meter.create_counter(
+    "upstream.circuit_breaker.openings",
+    description="Number of times the circuit breaker of the upstream has opened",
+)
+_rejections = meter.create_counter(
+    "upstream.circuit_breaker.rejections",
+    description="Number of requests rejected by the open circuit breaker of the upstream",
+)
+
+
+class CircuitState(IntEnum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreaker:
+    upstream: str
+    failure_threshold: int
+    recovery_time: float
+    half_open_requests: int
+
+    consecutive_failures: int
+    opened_at: Optional[float]
+    probes: int
+
+    def __init__(
+        self,
+        upstream: str,
+        failure_threshold: int,
+        recovery_time: float,
+        half_open_requests: int,
+    ) -> None:
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_requests = half_open_requests
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probes = 0
+
+    def get_state(self, now: float) -> CircuitState:
+        if self.opened_at is None:
+            return CircuitState.CLOSED
+        if now < self.opened_at + self.recovery_time:
+            return CircuitState.OPEN
+        return CircuitState.HALF_OPEN
+
+    @property
+    def state(self) -> CircuitState:
+        return self.get_state(time.monotonic())
+
+    def acquire(self) -> OutcomeCallback:
+        """
+        Lets the request through or fails it with 503
+        when the breaker is open or all the probes are in flight.
+        """
+
+        state = self.state
+        if state == CircuitState.HALF_OPEN:
+            if self.probes >= self.half_open_requests:
+                self._reject()
+            self.probes += 1
+        elif state == CircuitState.OPEN:
+            self._reject()
+
+        def _on_done(outcome: Outcome, latency: float) -> None:
+            if state == CircuitState.HALF_OPEN:
+                self.probes -= 1
+            self._on_outcome(outcome)
+
+        return _on_done
+
+    def _on_outcome(self, outcome: Outcome) -> None:
+        match outcome:
+            case Outcome.OVERLOAD:
+                self.consecutive_failures += 1
+                if (
+                    self.opened_at is not None
+                    or self.consecutive_failures >= self.failure_threshold
+                ):
+                    self._open()
+            case Outcome.SUCCESS | Outcome.THROTTLED:
+                # The throttled upstream is still reachable
+                self.consecutive_failures = 0
+                if self.opened_at is not None:
+                    self.opened_at = None
+                    logger.info(f"Circuit breaker of {self.upstream!r} closed")
+            case Outcome.IGNORE:
+                pass
+
+    def _open(self) -> None:
+        now = time.monotonic()
+        if self.get_state(now) == CircuitState.OPEN:
+            return
+        self.opened_at = now
+        _openings.add(1, {"upstream": self.upstream})
+        logger.warning(
+            f"Circuit breaker of {self.upstream!r} opened "
+            f"for {self.recovery_time}s after "
+            f"{self.consecutive_failures} consecutive failures"
+        )
+
+    def _reject(self) -> NoReturn:
+        _rejections.add(1, {"upstream": self.upstream})
+        raise DialException(
+            status_code=503,
+            type="service_unavailable",
+            message=f"The upstream {self.upstream!r} is unavailable",
+            display_message="The model is unavailable. Please try again later.",
+            headers={"Retry-After": str(self._get_retry_after())},
+        )
+
+    def _get_retry_after(self) -> int:
+        if self.opened_at is None:
+            return 1
+        remaining = self.opened_at + self.recovery_time - time.monotonic()
+        return max(1, int(remaining + 0.5))
+
+
+class CircuitBreakers:
+    """
+    The circuit breakers of the upstreams created on their first call.
+    """
+
+    failure_threshold: int
+    recovery_time: float
+    half_open_requests: int
+
+    def __init__(
+        self,
+        failure_threshold: int,
+        recovery_time: float,
+        half_open_requests: int,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_requests = half_open_requests
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def from_config(cls, app_config: ApplicationConfig) -> "CircuitBreakers":
+        return cls(
+            app_config.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            app_config.CIRCUIT_BREAKER_RECOVERY_TIME,
+            app_config.CIRCUIT_BREAKER_HALF_OPEN_REQUESTS,
+        )
+
+    def get(self, upstream_url: str) -> Optional[CircuitBreaker]:
+        if self.failure_threshold <= 0:
+            return None
+
+        key = get_upstream_key(upstream_url)
+        if (breaker := self._breakers.get(key)) is None:
+            breaker = self._breakers[key] = CircuitBreaker(
+                key,
+                self.failure_threshold,
+                self.recovery_time,
+                self.half_open_requests,
+            )
+        return breaker
+
+    def is_open(self, upstream_url: str) -> bool:
+        breaker = self.get(upstream_url)
+        return breaker is not None and breaker.state == CircuitState.OPEN
+
+    async def call(
+        self, upstream_url: str, call: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        Runs the handling of the request with its upstream request
+        guarded by the breaker, so that the errors raised by the adapter,
+        including the rejections of the breaker, don't count as failures.
+        """
+
+        if (breaker := self.get(upstream_url)) is None:
+            return await call()
+
+        # The request to the open circuit isn't prepared in vain
+        if breaker.state == CircuitState.OPEN:
+            breaker._reject()
+
+        async def _acquire() -> OutcomeCallback:
+            return breaker.acquire()
+
+        return await guard_upstream_requests(_acquire, call)
+
+    def get_states(self) -> Dict[str, str]:
+        now = time.monotonic()
+        return {
+            upstream: breaker.get_state(now).name.lower()
+            for upstream, breaker in list(self._breakers.items())
+        }
+
+    def __iter__(self) -> Iterator[CircuitBreaker]:
+        return iter(list(self._breakers.values()))
+
+
+# The circuit breakers of all the applications for the metrics
+_circuit_breakers: "weakref.WeakSet[CircuitBreakers]" = weakref.WeakSet()
+
+
+def configure_circuit_breakers(
+    app: FastAPI, app_config: ApplicationConfig
+) -> None:
+    breakers = CircuitBreakers.from_config(app_config)
+    _circuit_breakers.add(breakers)
+    app.state.circuit_breakers = breakers
+
+
+def get_circuit_breakers(app: FastAPI) -> CircuitBreakers:
+    return app.state.circuit_breakers
+
+
+def _observe_state(options: CallbackOptions) -> Iterable[Observation]:
+    now = time.monotonic()
+    for breakers in list(_circuit_breakers):
+        for breaker in breakers:
+            yield Observation(
+                breaker.get_state(now), {"upstream": breaker.upstream}
+            )
+
+
+meter.create_observable_gauge(
+    "upstream.circuit_breaker.state",
+    callbacks=[_observe_state],
+    description="State of the circuit breaker of the upstream: 0 - closed, 1 - half-open, 2 - open",
+)
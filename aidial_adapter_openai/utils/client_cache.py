@@ -0,0 +1,63 @@
+"""
+Cache of OpenAI SDK clients.
+
+Constructing `AsyncOpenAI`/`AsyncAzureOpenAI` validates the configuration and
+builds default headers on every call, so the clients are reused across
+requests to the same upstream with the same credentials.
+"""
+
+import hashlib
+import os
+from typing import Callable, Hashable, Tuple, TypeVar
+
+from openai import AsyncOpenAI
+
+from aidial_adapter_openai.utils.auth import OpenAICreds
+from aidial_adapter_openai.utils.cache import LRUCache
+
+OPENAI_CLIENT_CACHE_SIZE = int(os.getenv("OPENAI_CLIENT_CACHE_SIZE", 256))
+
+ClientKey = Tuple[Hashable, ...]
+
+_C = TypeVar("_C", bound=AsyncOpenAI)
+
+# The cached clients share the global HTTP client,
+# so evicted clients are simply dropped and never closed.
+_clients: LRUCache[ClientKey, AsyncOpenAI] = LRUCache(
+    maxsize=OPENAI_CLIENT_CACHE_SIZE
+)
+
+
+def credential_fingerprint(secret: str) -> str:
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def get_cached_client(
+    key: ClientKey, creds: OpenAICreds, create: Callable[[], _C]
+) -> _C:
+    """
+    Returns a client for the upstream identified by the `key`
+    and the given credentials, creating it with `create` on a cache miss.
+
+    The credentials are part of the cache key, since the requests
+    to the same upstream may come with different API keys or Azure AD tokens
+    at the same time. The clients of the rotated tokens
+    are evicted from the cache as they stop being used.
+    """
+
+    if (token := creds.get("azure_ad_token")) is not None:
+        cache_key = (*key, "azure_ad_token", credential_fingerprint(token))
+    else:
+        api_key = creds.get("api_key") or ""
+        cache_key = (*key, "api_key", credential_fingerprint(api_key))
+
+    if (client := _clients.get(cache_key)) is not None:
+        return client  # type: ignore
+
+    client = create()
+    _clients.put(cache_key, client)
+    return client
+
+
+def clear_client_cache() -> None:
+    _clients.clear()
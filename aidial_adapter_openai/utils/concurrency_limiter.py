@@ -0,0 +1,281 @@
+"""
+Adaptive limit of the concurrent upstream requests per deployment.
+
+The limit follows the AIMD scheme: it grows additively
+while the upstream responds in time and is cut multiplicatively
+when the upstream throttles the requests, fails or slows down.
+The requests exceeding the limit wait in a queue for a bounded time.
+"""
+
+import asyncio
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, Iterable, Optional, TypeVar
+
+from aidial_sdk.exceptions import HTTPException as DialException
+from fastapi import FastAPI, Request
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from aidial_adapter_openai.app_config import (
+    ApplicationConfig,
+    ConcurrencyLimitConfig,
+)
+from aidial_adapter_openai.utils.fair_queue import FairQueue, QueueTicket
+from aidial_adapter_openai.utils.log_config import logger
+from aidial_adapter_openai.utils.metrics import meter
+from aidial_adapter_openai.utils.outcome import Outcome, OutcomeCallback
+from aidial_adapter_openai.utils.upstream_request import guard_upstream_requests
+
+T = TypeVar("T")
+
+# Smoothing factors of the short-term and long-term latency averages
+_SHORT_LATENCY_WEIGHT = 0.3
+_LONG_LATENCY_WEIGHT = 0.05
+
+# The limit is cut gently when the latency grows
+_LATENCY_BACKOFF_RATIO = 0.9
+
+_queue_wait = meter.create_histogram(
+    "upstream.concurrency.queue_wait",
+    unit="s",
+    description="Time a request waits for the concurrency limit of the deployment",
+)
+
+
+class Permit:
+    epoch: int
+    saturated: bool
+    latency: Optional[float] = None
+
+    def __init__(self, epoch: int, saturated: bool) -> None:
+        self.epoch = epoch
+        self.saturated = saturated
+
+
+class AdaptiveConcurrencyLimiter:
+    name: str
+    config: ConcurrencyLimitConfig
+
+    limit: float
+    in_flight: int
+
+    def __init__(self, name: str, config: ConcurrencyLimitConfig) -> None:
+        self.name = name
+        self.config = config
+        self.limit = float(config.initial_limit)
+        self.in_flight = 0
+
+        self._waiters: FairQueue[asyncio.Future[Permit]] = FairQueue()
+        # Every cut of the limit starts a new epoch.
+        # The requests started in an earlier epoch don't cut the limit again,
+        # so that a burst of errors results in a single cut.
+        self._epoch = 0
+        self._short_latency: Optional[float] = None
+        self._long_latency: Optional[float] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _grant(self) -> Permit:
+        self.in_flight += 1
+        return Permit(
+            epoch=self._epoch,
+            saturated=2 * self.in_flight >= self.limit,
+        )
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._has_capacity():
+            waiter = self._waiters.pop()
+            if not waiter.done():
+                waiter.set_result(self._grant())
+
+    async def acquire(self, ticket: QueueTicket = QueueTicket()) -> Permit:
+        started_at = time.perf_counter()
+        try:
+            return await self._acquire(ticket)
+        finally:
+            _queue_wait.record(
+                time.perf_counter() - started_at,
+                {
+                    "deployment": self.name,
+                    "tenant": ticket.label,
+                    "priority": ticket.priority.name,
+                },
+            )
+
+    async def _acquire(self, ticket: QueueTicket) -> Permit:
+        if self._has_capacity() and not self._waiters:
+            return self._grant()
+
+        if len(self._waiters) >= self.config.max_queue_size:
+            raise _too_many_requests()
+
+        waiter: asyncio.Future[Permit] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self._waiters.push(waiter, ticket)
+
+        try:
+            await asyncio.wait([waiter], timeout=self.config.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result(), Outcome.IGNORE)
+            else:
+                self._discard_waiter(waiter)
+            raise
+
+        if not waiter.done():
+            self._discard_waiter(waiter)
+            raise _too_many_requests()
+
+        return waiter.result()
+
+    def _discard_waiter(self, waiter: asyncio.Future[Permit]) -> None:
+        waiter.cancel()
+        self._waiters.remove(waiter)
+
+    def release(self, permit: Permit, outcome: Outcome) -> None:
+        self.in_flight -= 1
+
+        match outcome:
+            case Outcome.THROTTLED | Outcome.OVERLOAD:
+                self._decrease(permit, self.config.backoff_ratio)
+            case Outcome.SUCCESS:
+                if permit.latency is not None and self._is_slow(permit.latency):
+                    self._decrease(permit, _LATENCY_BACKOFF_RATIO)
+                elif permit.saturated:
+                    self._increase()
+            case Outcome.IGNORE:
+                pass
+
+        self._wake_waiters()
+
+    def _is_slow(self, latency: float) -> bool:
+        if self._short_latency is None or self._long_latency is None:
+            self._short_latency = self._long_latency = latency
+            return False
+
+        self._short_latency += _SHORT_LATENCY_WEIGHT * (
+            latency - self._short_latency
+        )
+        self._long_latency += _LONG_LATENCY_WEIGHT * (
+            latency - self._long_latency
+        )
+        return (
+            self._short_latency
+            > self._long_latency * self.config.latency_tolerance
+        )
+
+    def _increase(self) -> None:
+        # Grows by one per window of the limit size
+        self.limit = min(
+            self.limit + 1 / self.limit, float(self.config.max_limit)
+        )
+
+    def _decrease(self, permit: Permit, ratio: float) -> None:
+        if permit.epoch != self._epoch:
+            return
+        self._epoch += 1
+        self.limit = max(self.limit * ratio, float(self.config.min_limit))
+        logger.warning(
+            f"Concurrency limit of {self.name!r} is cut to {int(self.limit)}"
+        )
+
+
+def _too_many_requests() -> DialException:
+    return DialException(
+        status_code=429,
+        type="rate_limit_exceeded",
+        message="Too many concurrent requests to the deployment",
+        display_message="The model is overloaded. Please try again later.",
+    )
+
+
+async def call_with_limiter(
+    limiter: AdaptiveConcurrencyLimiter,
+    call: Callable[[], Awaitable[T]],
+    ticket: QueueTicket = QueueTicket(),
+) -> T:
+    """
+    Runs the handling of the request with its upstream request
+    under the limiter, so that neither the errors nor the time
+    of the preparation of the request affect the limit.
+    The permit of a streaming response is held until the stream is over.
+    """
+
+    async def _acquire() -> OutcomeCallback:
+        permit = await limiter.acquire(ticket)
+
+        def _on_done(outcome: Outcome, latency: float) -> None:
+            permit.latency = latency
+            limiter.release(permit, outcome)
+
+        return _on_done
+
+    return await guard_upstream_requests(_acquire, call)
+
+
+# The limiters of all the applications for the metrics
+_limiters: "weakref.WeakSet[AdaptiveConcurrencyLimiter]" = weakref.WeakSet()
+
+
+def configure_concurrency_limiters(
+    app: FastAPI, app_config: ApplicationConfig
+) -> None:
+    limiters = {
+        deployment: AdaptiveConcurrencyLimiter(deployment, config)
+        for deployment, config in app_config.CONCURRENCY_LIMITS.items()
+    }
+    _limiters.update(limiters.values())
+    app.state.concurrency_limiters = limiters
+
+
+def get_concurrency_limiter(
+    request: Request, deployment: str
+) -> Optional[AdaptiveConcurrencyLimiter]:
+    limiters: Dict[str, AdaptiveConcurrencyLimiter] = (
+        request.app.state.concurrency_limiters
+    )
+    return limiters.get(deployment)
+
+
+async def limit_concurrency(
+    deployment: str,
+    request: Request,
+    call: Callable[[], Awaitable[T]],
+    ticket: QueueTicket = QueueTicket(),
+) -> T:
+    if (limiter := get_concurrency_limiter(request, deployment)) is None:
+        return await call()
+    return await call_with_limiter(limiter, call, ticket)
+
+
+def _observe(
+    get_value: Callable[[AdaptiveConcurrencyLimiter], float]
+) -> Callable[[CallbackOptions], Iterable[Observation]]:
+    def _callback(options: CallbackOptions) -> Iterable[Observation]:
+        for limiter in list(_limiters):
+            yield Observation(get_value(limiter), {"deployment": limiter.name})
+
+    return _callback
+
+
+meter.create_observable_gauge(
+    "upstream.concurrency.limit",
+    callbacks=[_observe(lambda limiter: int(limiter.limit))],
+    description="Current limit of the concurrent upstream requests of the deployment",
+)
+meter.create_observable_gauge(
+    "upstream.concurrency.in_flight",
+    callbacks=[_observe(lambda limiter: limiter.in_flight)],
+    description="Number of the in-flight upstream requests of the deployment",
+)
+meter.create_observable_gauge(
+    "upstream.concurrency.queue_depth",
+    callbacks=[_observe(lambda limiter: limiter.queue_depth)],
+    description="Number of the requests waiting for the concurrency limit of the deployment",
+)
@@ -0,0 +1,124 @@
+"""
+Deadlines of the requests.
+
+The deadline comes either from the request header set by DIAL Core
+or from the default timeout of the deployment.
+It caps the timeouts of the upstream calls made on behalf of the request,
+and the work which is pointless once the deadline has passed,
+e.g. downloading images or tokenizing the prompt, is skipped.
+
+The deadline is kept in a context variable, since it applies to all the work
+done on behalf of the request, however deep in the call stack.
+"""
+
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+import aiohttp
+import httpx
+from aidial_sdk.exceptions import HTTPException as DialException
+from aiohttp.client import DEFAULT_TIMEOUT
+from fastapi import Request
+
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.log_config import logger
+
+# Upper bound of the connect timeout within the deadline
+_CONNECT_TIMEOUT = 10.0
+
+
+class Deadline:
+    expires_at: float
+
+    def __init__(self, expires_at: float) -> None:
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, timeout: float) -> "Deadline":
+        return cls(time.monotonic() + timeout)
+
+    @classmethod
+    def at(cls, timestamp: float) -> "Deadline":
+        """
+        Deadline given by the Unix timestamp.
+        """
+
+        return cls.after(timestamp - time.time())
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def get_timeout(self) -> httpx.Timeout:
+        remaining = self.remaining()
+        return httpx.Timeout(
+            remaining, connect=min(remaining, _CONNECT_TIMEOUT)
+        )
+
+    def get_aiohttp_timeout(self) -> aiohttp.ClientTimeout:
+        remaining = self.remaining()
+        return aiohttp.ClientTimeout(
+            total=remaining, connect=min(remaining, _CONNECT_TIMEOUT)
+        )
+
+
+_deadline: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def get_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def set_request_deadline(
+    request: Request, app_config: ApplicationConfig, deployment_id: str
+) -> Optional[Deadline]:
+    deadline: Optional[Deadline] = None
+
+    if value := request.headers.get(app_config.DEADLINE_HEADER):
+        try:
+            deadline = Deadline.at(float(value))
+        except ValueError:
+            logger.warning(
+                f"Invalid {app_config.DEADLINE_HEADER} header: {value!r}"
+            )
+
+    if deadline is None and (
+        timeout := app_config.DEPLOYMENT_TIMEOUTS.get(deployment_id)
+    ):
+        deadline = Deadline.after(timeout)
+
+    _deadline.set(deadline)
+    return deadline
+
+
+def check_deadline(stage: str) -> None:
+    """
+    Fails the request with 504 if its deadline has passed.
+    """
+
+    deadline = get_deadline()
+    if deadline is not None and deadline.expired:
+        logger.warning(f"The request deadline has passed before {stage}")
+        raise DialException(
+            status_code=504,
+            type="timeout",
+            message="Request timed out",
+            display_message="Request timed out. Please try again later.",
+        )
+
+
+def get_aiohttp_timeout() -> aiohttp.ClientTimeout:
+    """
+    The timeout of an aiohttp call made on behalf of the request.
+    The default one is returned without a deadline, since the timeout
+    of a single call can't be None, which disables it.
+    """
+
+    deadline = get_deadline()
+    if deadline is None:
+        return DEFAULT_TIMEOUT
+    return deadline.get_aiohttp_timeout()
@@ -0,0 +1,132 @@
+"""
+Weighted fair queuing of the requests waiting for an upstream.
+
+The waiting requests are split into priority lanes,
+which are served strictly in the order of priority.
+Within a lane, every tenant has its own queue and the queues are served
+by weighted fair queuing, so that a tenant flooding the deployment
+doesn't delay the requests of the others.
+The tenants are identified by the configured tenant header,
+without it all the requests belong to a single tenant.
+
+The queue is the waiter queue of the concurrency limiter, so the requests
+are only queued, and the fairness and the priorities only take effect,
+for the deployments with a concurrency limit.
+
+The priority comes from a request header, which any caller may set.
+So the header may only lower the priority of the request below
+the default one, unless the tenant is allowed a higher priority
+in the configuration.
+"""
+
+import heapq
+from enum import IntEnum
+from typing import Dict, Generic, List, NamedTuple, Optional, Tuple, TypeVar
+
+from fastapi import Request
+
+from aidial_adapter_openai.app_config import ApplicationConfig
+
+T = TypeVar("T")
+
+DEFAULT_TENANT = "default"
+
+# The metrics label of the tenants missing in the configuration
+OTHER_TENANT = "other"
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class QueueTicket(NamedTuple):
+    tenant: str = DEFAULT_TENANT
+    weight: float = 1.0
+    priority: Priority = Priority.NORMAL
+    # The tenant in the metrics, which is bounded by the configured tenants
+    label: str = DEFAULT_TENANT
+
+
+class FairQueue(Generic[T]):
+    def __init__(self) -> None:
+        self._heap: List[Tuple[Priority, float, int, T]] = []
+        self._counter = 0
+        # Virtual time of every lane is the finish tag of the last served item
+        self._virtual_time: Dict[Priority, float] = {}
+        self._finish_tags: Dict[Tuple[Priority, str], float] = {}
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, item: T, ticket: QueueTicket) -> None:
+        lane = ticket.priority
+        key = (lane, ticket.tenant)
+        start = max(
+            self._virtual_time.get(lane, 0.0), self._finish_tags.get(key, 0.0)
+        )
+        finish = start + 1.0 / ticket.weight
+        self._finish_tags[key] = finish
+
+        self._counter += 1
+        heapq.heappush(self._heap, (lane, finish, self._counter, item))
+
+    def pop(self) -> T:
+        lane, finish, _, item = heapq.heappop(self._heap)
+        self._virtual_time[lane] = finish
+
+        if not self._heap:
+            # Nobody is waiting, so the history doesn't matter anymore
+            self._virtual_time.clear()
+            self._finish_tags.clear()
+
+        return item
+
+    def remove(self, item: T) -> None:
+        for idx, entry in enumerate(self._heap):
+            if entry[3] is item:
+                self._heap[idx] = self._heap[-1]
+                self._heap.pop()
+                heapq.heapify(self._heap)
+                return
+
+
+def get_tenant(request: Request, app_config: ApplicationConfig) -> str:
+    # The api-key can't tell the tenants apart,
+    # since DIAL Core issues a new one for every request
+    if app_config.TENANT_HEADER is None:
+        return DEFAULT_TENANT
+    return request.headers.get(app_config.TENANT_HEADER) or DEFAULT_TENANT
+
+
+def get_tenant_label(tenant: str, app_config: ApplicationConfig) -> str:
+    if tenant == DEFAULT_TENANT or tenant in app_config.TENANT_WEIGHTS:
+        return tenant
+    return OTHER_TENANT
+
+
+def get_queue_ticket(
+    request: Request,
+    app_config: ApplicationConfig,
+    default_priority: Priority,
+) -> QueueTicket:
+    tenant = get_tenant(request, app_config)
+
+    max_priority = default_priority
+    if (value := app_config.TENANT_MAX_PRIORITIES.get(tenant)) is not None:
+        max_priority = Priority[value.upper()]
+
+    priority: Optional[Priority] = None
+    if value := request.headers.get(app_config.PRIORITY_HEADER):
+        priority = Priority.__members__.get(value.upper())
+    if priority is None:
+        priority = default_priority
+
+    return QueueTicket(
+        tenant=tenant,
+        weight=app_config.TENANT_WEIGHTS.get(tenant, 1.0),
+        # The lower value is the higher priority
+        priority=max(priority, max_priority),
+        label=get_tenant_label(tenant, app_config),
+    )
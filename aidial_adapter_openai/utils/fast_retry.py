@@ -0,0 +1,79 @@
+"""
+Retries of the upstream requests which failed before reaching the upstream.
+
+Retries are generally left to DIAL Core, but a request failing to connect
+or hitting a stale keep-alive connection is known not to have got any
+response, so it's cheaper to retry it right away on a fresh connection.
+The retries are capped by a budget, which is replenished
+by a fraction of every request, so that an unreachable upstream
+doesn't multiply the load.
+"""
+
+import random
+from typing import Optional
+
+import httpx
+
+from aidial_adapter_openai.app_config import ApplicationConfig
+
+# The budget accumulated for the retries during a quiet period
+_MAX_RETRY_BUDGET = 10.0
+
+_BASE_BACKOFF = 0.05
+_MAX_BACKOFF = 0.5
+
+# The errors raised before any byte of the response is received
+_RETRYABLE_ERRORS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    # The server has closed the pooled keep-alive connection
+    httpx.RemoteProtocolError,
+)
+
+
+class FastRetryPolicy:
+    max_retries: int
+    budget_ratio: float
+
+    def __init__(self, max_retries: int, budget_ratio: float) -> None:
+        self.max_retries = max_retries
+        self.budget_ratio = budget_ratio
+        self._budget = _MAX_RETRY_BUDGET
+
+    @classmethod
+    def from_config(
+        cls, app_config: ApplicationConfig
+    ) -> Optional["FastRetryPolicy"]:
+        if app_config.UPSTREAM_FAST_RETRIES <= 0:
+            return None
+        return cls(
+            app_config.UPSTREAM_FAST_RETRIES,
+            app_config.UPSTREAM_FAST_RETRY_BUDGET,
+        )
+
+    def on_request(self) -> None:
+        self._budget = min(self._budget + self.budget_ratio, _MAX_RETRY_BUDGET)
+
+    def should_retry(
+        self, request: httpx.Request, error: Exception, attempt: int
+    ) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if not isinstance(error, _RETRYABLE_ERRORS):
+            return False
+        if isinstance(
+            error, httpx.RemoteProtocolError
+        ) and "without sending a response" not in str(error):
+            return False
+        # A streamed request body can't be sent again
+        if not isinstance(request.stream, httpx.ByteStream):
+            return False
+        if self._budget < 1:
+            return False
+        self._budget -= 1
+        return True
+
+    @staticmethod
+    def get_backoff(attempt: int) -> float:
+        # Full jitter spreads the retries of the requests failed together
+        return random.uniform(0, min(_MAX_BACKOFF, _BASE_BACKOFF * 2**attempt))
@@ -0,0 +1,300 @@
+"""
+Hedging of the upstream requests against the tail latency.
+
+When the upstream doesn't respond within a high percentile
+of its recent response times, the adapter sends a duplicate request,
+takes whichever response comes first and cancels the other request.
+The number of hedges is capped by a budget,
+which is replenished by a fraction of every request,
+so that the hedging doesn't overload a slow upstream even further.
+
+A streaming response counts as arrived with its first chunk
+rather than its headers, since an upstream may send the headers
+and stall before the content.
+"""
+
+import asyncio
+import copy
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    TypeVar,
+    cast,
+)
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from aidial_adapter_openai.app_config import (
+    ApplicationConfig,
+    HedgingConfig,
+    UpstreamConfig,
+)
+from aidial_adapter_openai.utils.load_balancer import call_upstream
+from aidial_adapter_openai.utils.log_config import logger
+from aidial_adapter_openai.utils.metrics import meter
+
+T = TypeVar("T")
+
+# Number of the recent response times the hedging delay is computed from
+_LATENCY_WINDOW = 1000
+
+# The delay is recomputed after this many new response times
+_DELAY_UPDATE_INTERVAL = 20
+
+# The budget accumulated for the hedges during a quiet period
+_MAX_HEDGE_BUDGET = 10.0
+
+_hedges = meter.create_counter(
+    "upstream.hedging.hedges",
+    description="Number of hedged requests by the winner: the original request, the hedge or none when both failed",
+)
+
+
+class HedgingPolicy:
+    deployment: str
+    config: HedgingConfig
+
+    def __init__(self, deployment: str, config: HedgingConfig) -> None:
+        self.deployment = deployment
+        self.config = config
+        self._latencies: Deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self._new_latencies = 0
+        self._delay: Optional[float] = None
+        self._budget = 0.0
+
+    @property
+    def delay(self) -> Optional[float]:
+        """
+        Time to wait for the upstream response before sending the hedge,
+        unknown until enough response times are collected.
+        """
+
+        if self._new_latencies >= _DELAY_UPDATE_INTERVAL:
+            self._new_latencies = 0
+            if len(self._latencies) >= self.config.min_samples:
+                latencies = sorted(self._latencies)
+                idx = int(len(latencies) * self.config.percentile / 100)
+                self._delay = min(
+                    max(
+                        latencies[min(idx, len(latencies) - 1)],
+                        self.config.min_delay,
+                    ),
+                    self.config.max_delay,
+                )
+        return self._delay
+
+    def record_latency(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._new_latencies += 1
+
+    def on_request(self) -> None:
+        self._budget = min(
+            self._budget + self.config.max_hedge_ratio, _MAX_HEDGE_BUDGET
+        )
+
+    def try_hedge(self) -> bool:
+        if self._budget < 1:
+            return False
+        self._budget -= 1
+        return True
+
+    def _count(self, winner: str) -> None:
+        _hedges.add(1, {"deployment": self.deployment, "winner": winner})
+
+    async def run(
+        self,
+        primary: Callable[[], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]],
+    ) -> T:
+        self.on_request()
+        started_at = time.perf_counter()
+        primary_task = asyncio.create_task(_wait_first_chunk(primary))
+
+        try:
+            delay = self.delay
+            if delay is not None:
+                await asyncio.wait([primary_task], timeout=delay)
+
+            if primary_task.done() or delay is None or not self.try_hedge():
+                result = await primary_task
+                if not _is_failure(result):
+                    self.record_latency(time.perf_counter() - started_at)
+                return result
+
+            logger.debug(
+                f"Hedging the request to {self.deployment!r} after {delay:.2f}s"
+            )
+            hedge_task = asyncio.create_task(_wait_first_chunk(hedge))
+            winner = await _race([primary_task, hedge_task])
+        finally:
+            if not primary_task.done():
+                primary_task.cancel()
+
+        if winner is None:
+            self._count("none")
+            return primary_task.result()
+
+        self._count("hedge" if winner is hedge_task else "primary")
+        # The original request cancelled in favour of the hedge
+        # would have taken at least as long, and leaving it out
+        # would bias the delay towards the fast responses
+        if winner is primary_task or primary_task.cancelled():
+            self.record_latency(time.perf_counter() - started_at)
+        return winner.result()
+
+
+class _PeekedStream(AsyncIterator[T]):
+    """
+    The stream with its first chunk read ahead.
+    """
+
+    def __init__(self, first: T, stream: AsyncIterator[T]) -> None:
+        self._first: Optional[T] = first
+        self._peeked = True
+        self._stream = stream
+
+    async def __anext__(self) -> T:
+        if self._peeked:
+            self._peeked = False
+            first, self._first = self._first, None
+            return cast(T, first)
+        return await self._stream.__anext__()
+
+    async def aclose(self) -> None:
+        await _aclose(self._stream)
+
+
+async def _wait_first_chunk(call: Callable[[], Awaitable[T]]) -> T:
+    """
+    Calls the upstream and waits for the first chunk of a streaming response.
+    """
+
+    result = await call()
+    if not isinstance(result, AsyncIterator):
+        return result
+
+    stream = cast(AsyncIterator[Any], result)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        return result
+    except BaseException:
+        # The stream of the cancelled call releases the upstream connection
+        await _aclose(stream)
+        raise
+    return cast(T, _PeekedStream(first, stream))
+
+
+async def _aclose(result: Any) -> None:
+    if (aclose := getattr(result, "aclose", None)) is not None:
+        await aclose()
+
+
+async def _race(tasks: List[asyncio.Task[T]]) -> Optional[asyncio.Task[T]]:
+    """
+    Waits for the first successful task and cancels the rest.
+    Returns None when all the tasks fail.
+    """
+
+    pending = set(tasks)
+    winner: Optional[asyncio.Task[T]] = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            # Prefer the original task when both complete at once
+            for task in tasks:
+                if task in done and not _is_failed_task(task):
+                    winner = task
+                    break
+    finally:
+        for task in tasks:
+            if task is not winner:
+                await _discard(task)
+
+    return winner
+
+
+def _is_failure(result: Any) -> bool:
+    return isinstance(result, Response) and result.status_code >= 400
+
+
+def _is_failed_task(task: asyncio.Task) -> bool:
+    return (
+        task.cancelled()
+        or task.exception() is not None
+        or _is_failure(task.result())
+    )
+
+
+async def _discard(task: asyncio.Task) -> None:
+    if not task.done():
+        # The cancelled call closes its stream before the winner goes on
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return
+
+    if task.cancelled() or task.exception() is not None:
+        return
+
+    # The losing stream must be closed to release the upstream connection
+    await _aclose(task.result())
+
+
+def configure_hedging(app: FastAPI, app_config: ApplicationConfig) -> None:
+    app.state.hedging_policies = {
+        deployment: HedgingPolicy(deployment, config)
+        for deployment, config in app_config.HEDGING.items()
+    }
+
+
+def get_hedging_policy(
+    request: Request, deployment: str
+) -> Optional[HedgingPolicy]:
+    policies: Dict[str, HedgingPolicy] = request.app.state.hedging_policies
+    return policies.get(deployment)
+
+
+async def call_with_hedging(
+    deployment: str,
+    request: Request,
+    data: dict,
+    call: Callable[[UpstreamConfig, dict], Awaitable[T]],
+) -> T:
+    """
+    Calls the upstream of the deployment, hedging the call if configured.
+    The hedge goes to another upstream of the deployment pool, if any.
+    """
+
+    if (policy := get_hedging_policy(request, deployment)) is None:
+        return await call_upstream(
+            deployment, request, lambda upstream: call(upstream, data)
+        )
+
+    # The request handlers modify the request body
+    hedge_data = copy.deepcopy(data)
+    primary_endpoints: List[str] = []
+
+    def _call_primary(upstream: UpstreamConfig) -> Awaitable[T]:
+        primary_endpoints.append(upstream.endpoint)
+        return call(upstream, data)
+
+    return await policy.run(
+        lambda: call_upstream(deployment, request, _call_primary),
+        lambda: call_upstream(
+            deployment,
+            request,
+            lambda upstream: call(upstream, hedge_data),
+            exclude=primary_endpoints,
+        ),
+    )
@@ -1,6 +1,36 @@
+import asyncio
+import contextlib
 import functools
+import re
+import time
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Type,
+)
 
+import httpcore
 import httpx
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from aidial_adapter_openai.app_config import (
+    ApplicationConfig,
+    ConnectionPoolConfig,
+)
+from aidial_adapter_openai.utils.client_cache import clear_client_cache
+from aidial_adapter_openai.utils.deadline import Deadline, get_deadline
+from aidial_adapter_openai.utils.fast_retry import FastRetryPolicy
+from aidial_adapter_openai.utils.log_config import logger
+from aidial_adapter_openai.utils.metrics import meter
+from aidial_adapter_openai.utils.token_budget import observe_httpx_response
 
 # connect timeout and total timeout
 DEFAULT_TIMEOUT = httpx.Timeout(600, connect=10)
@@ -10,11 +40,647 @@ DEFAULT_CONNECTION_LIMITS = httpx.Limits(
     max_connections=1000, max_keepalive_connections=100
 )
 
+# A handful of HTTP/2 connections is enough to multiplex
+# all concurrent streams to a single host
+DEFAULT_HTTP2_CONNECTION_LIMITS = httpx.Limits(
+    max_connections=10, max_keepalive_connections=10
+)
+
+_connections_opened = meter.create_counter(
+    "upstream.http.connections.opened",
+    description="Number of TCP connections opened to the upstreams",
+)
+_streams_per_connection = meter.create_histogram(
+    "upstream.http.streams_per_connection",
+    description="Number of in-flight requests per open connection, sampled when a request is sent",
+)
+_retries = meter.create_counter(
+    "upstream.http.retries",
+    description="Number of upstream requests retried after failing before any response",
+)
+_queue_wait = meter.create_histogram(
+    "upstream.http.pool.queue_wait",
+    unit="s",
+    description="Time a request waits for a connection from the upstream connection pool",
+)
+
+# Trace events which signal that the request has got a connection
+_CONNECTION_ACQUIRED_EVENTS = {
+    "connection.connect_tcp.started",
+    "http11.send_request_headers.started",
+    "http2.send_request_headers.started",
+}
+
+# Request extension which marks the connection warm-up probes
+WARMUP_EXTENSION = "dial_warmup"
+
+TraceCallback = Callable[[str, dict], Awaitable[None]]
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    def __init__(
+        self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]
+    ) -> None:
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+
+class _DeadlineStream(httpx.AsyncByteStream):
+    """
+    Fails the reading of the response once the request deadline has passed.
+    The timeouts of httpx only limit every read of the response,
+    so without it a streaming response which keeps sending chunks
+    would outlive the deadline.
+    """
+
+    def __init__(
+        self, stream: httpx.AsyncByteStream, deadline: Deadline
+    ) -> None:
+        self._stream = stream
+        self._deadline = deadline
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        iterator = aiter(self._stream)
+        while True:
+            try:
+                async with asyncio.timeout(self._deadline.remaining()):
+                    chunk = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                raise httpx.ReadTimeout(
+                    "The request deadline has passed while reading the response"
+                )
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+
+def _get_httpx_error(error: Exception) -> Optional[Type[Exception]]:
+    # httpx raises the httpcore errors as its own errors of the same name
+    if not type(error).__module__.startswith("httpcore"):
+        return None
+    for cls in type(error).__mro__:
+        httpx_error = getattr(httpx, cls.__name__, None)
+        if isinstance(httpx_error, type) and issubclass(
+            httpx_error, httpx.TransportError
+        ):
+            return httpx_error
+    return None
+
+
+@contextlib.contextmanager
+def _map_httpcore_errors() -> Iterator[None]:
+    try:
+        yield
+    except Exception as e:
+        if (httpx_error := _get_httpx_error(e)) is None:
+            raise
+        raise httpx_error(str(e)) from e
+
+
+class _ResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream: AsyncIterable[bytes]) -> None:
+        self._stream = stream
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        with _map_httpcore_errors():
+            async for chunk in self._stream:
+                yield chunk
+
+    async def aclose(self) -> None:
+        if hasattr(self._stream, "aclose"):
+            with _map_httpcore_errors():
+                await self._stream.aclose()  # type: ignore
+
+
+class _CountedStream(httpcore.AsyncNetworkStream):
+    """
+    Connection of the pool, which reports when it's closed.
+    """
+
+    def __init__(
+        self, stream: httpcore.AsyncNetworkStream, on_close: Callable[[], None]
+    ) -> None:
+        self._stream = stream
+        self._on_close = on_close
+
+    async def read(self, max_bytes: int, timeout: Optional[float] = None):
+        return await self._stream.read(max_bytes, timeout)
+
+    async def write(self, buffer: bytes, timeout: Optional[float] = None):
+        await self._stream.write(buffer, timeout)
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+    async def start_tls(self, *args, **kwargs) -> httpcore.AsyncNetworkStream:
+        try:
+            stream = await self._stream.start_tls(*args, **kwargs)
+        except BaseException:
+            # The failed connection is dropped without being closed
+            self._on_close()
+            raise
+        # The TLS stream takes over the connection
+        return _CountedStream(stream, self._on_close)
+
+    def get_extra_info(self, info: str) -> Any:
+        return self._stream.get_extra_info(info)
+
+
+class _CountingBackend(httpcore.AsyncNetworkBackend):
+    """
+    Network backend of the pool, which keeps count of its open connections,
+    since httpcore doesn't report the closed connections to the trace callbacks.
+    """
+
+    def __init__(self, pool: "UpstreamTransport") -> None:
+        self._pool = pool
+        self._backend = httpcore.AnyIOBackend()
+
+    def _count(
+        self, stream: httpcore.AsyncNetworkStream
+    ) -> httpcore.AsyncNetworkStream:
+        closed = False
+
+        def _on_close() -> None:
+            nonlocal closed
+            if not closed:
+                closed = True
+                self._pool._on_connection_closed()
+
+        self._pool._on_connection_opened()
+        return _CountedStream(stream, _on_close)
+
+    async def connect_tcp(self, *args, **kwargs) -> httpcore.AsyncNetworkStream:
+        return self._count(await self._backend.connect_tcp(*args, **kwargs))
+
+    async def connect_unix_socket(
+        self, *args, **kwargs
+    ) -> httpcore.AsyncNetworkStream:
+        return self._count(
+            await self._backend.connect_unix_socket(*args, **kwargs)
+        )
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+class UpstreamTransport(httpx.AsyncBaseTransport):
+    """
+    Connection pool to a group of upstream hosts,
+    which keeps track of its connections and in-flight streams.
+    """
+
+    name: str
+    http2: bool
+    timeout: Optional[httpx.Timeout]
+    retry_policy: Optional[FastRetryPolicy]
+
+    active_streams: int
+    waiting_requests: int
+    connections_opened: int
+    open_connections: int
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        limits: httpx.Limits,
+        http2: bool = False,
+        http2_prior_knowledge: bool = False,
+        timeout: Optional[httpx.Timeout] = None,
+        retry_policy: Optional[FastRetryPolicy] = None,
+    ) -> None:
+        self.name = name
+        self.http2 = http2
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+        self.active_streams = 0
+        self.waiting_requests = 0
+        self.connections_opened = 0
+        self.open_connections = 0
+        # The httpcore pool is used directly instead of httpx.AsyncHTTPTransport
+        # to count its connections in the network backend
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http1=not http2_prior_knowledge,
+            http2=http2,
+            network_backend=_CountingBackend(self),
+        )
+
+    @classmethod
+    def from_config(
+        cls,
+        name: str,
+        config: ConnectionPoolConfig,
+        retry_policy: Optional[FastRetryPolicy] = None,
+    ) -> "UpstreamTransport":
+        timeout = None
+        if any(
+            value is not None
+            for value in (
+                config.timeout,
+                config.connect_timeout,
+                config.read_timeout,
+                config.pool_timeout,
+            )
+        ):
+            timeout = httpx.Timeout(
+                config.timeout,
+                connect=config.connect_timeout or config.timeout,
+                read=config.read_timeout or config.timeout,
+                pool=config.pool_timeout or config.timeout,
+            )
+
+        return cls(
+            name,
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            http2=config.http2,
+            http2_prior_knowledge=config.http2
+            and any(
+                _HostPattern(host).http2_prior_knowledge
+                for host in config.hosts
+            ),
+            timeout=timeout,
+            retry_policy=retry_policy,
+        )
+
+    @property
+    def _attributes(self) -> Dict[str, Any]:
+        return {"pool": self.name, "http2": self.http2}
+
+    def _on_connection_opened(self) -> None:
+        self.connections_opened += 1
+        self.open_connections += 1
+        _connections_opened.add(1, self._attributes)
+
+    def _on_connection_closed(self) -> None:
+        self.open_connections -= 1
+
+    def _on_connection_acquired(self, queue_wait: float) -> None:
+        self.waiting_requests -= 1
+        _queue_wait.record(queue_wait, self._attributes)
+
+    def _apply_timeout(self, request: httpx.Request) -> None:
+        deadline = get_deadline()
+        # The request deadline caps the timeouts along with the pool ones
+        for limits in (self.timeout, deadline and deadline.get_timeout()):
+            if limits is None:
+                continue
+
+            timeout = dict(request.extensions.get("timeout") or {})
+            for phase, limit in limits.as_dict().items():
+                if limit is not None:
+                    current = timeout.get(phase)
+                    timeout[phase] = (
+                        limit if current is None else min(current, limit)
+                    )
+            request.extensions["timeout"] = timeout
+
+    def _on_stream_closed(self) -> None:
+        self.active_streams -= 1
+
+    async def handle_async_request(
+        self, request: httpx.Request
+    ) -> httpx.Response:
+        trace = request.extensions.get("trace")
+        self._apply_timeout(request)
+
+        if request.extensions.get(WARMUP_EXTENSION):
+            return await self._warm_up(request)
+
+        if self.retry_policy is not None:
+            self.retry_policy.on_request()
+
+        attempt = 0
+        while True:
+            try:
+                return await self._send(request, trace)
+            except Exception as e:
+                if (
+                    self.retry_policy is None
+                    or not self.retry_policy.should_retry(request, e, attempt)
+                    or ((deadline := get_deadline()) and deadline.expired)
+                ):
+                    raise
+                _retries.add(1, {**self._attributes, "error": type(e).__name__})
+                backoff = self.retry_policy.get_backoff(attempt)
+                logger.warning(
+                    f"Retrying the request to {request.url.host!r} "
+                    f"in {backoff:.2f}s: {type(e).__name__}: {e}"
+                )
+                await asyncio.sleep(backoff)
+                attempt += 1
+
+    async def _warm_up(self, request: httpx.Request) -> httpx.Response:
+        """
+        Sends the warm-up probe without retries,
+        so that it neither replenishes the retry budget
+        nor shows up in the request metrics.
+        """
+        return await self._send_to_pool(request)
+
+    async def _send_to_pool(self, request: httpx.Request) -> httpx.Response:
+        assert isinstance(request.stream, httpx.AsyncByteStream)
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _map_httpcore_errors():
+            response = await self._pool.handle_async_request(core_request)
+
+        assert isinstance(response.stream, AsyncIterable)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=_ResponseStream(response.stream),
+            extensions=response.extensions,
+        )
+
+    async def _send(
+        self, request: httpx.Request, trace: Optional[TraceCallback]
+    ) -> httpx.Response:
+        tracer = _RequestTracer(self)
+        request.extensions = {
+            **request.extensions,
+            "trace": _chain_trace(trace, tracer),
+        }
+
+        self.active_streams += 1
+        _streams_per_connection.record(
+            self.active_streams / max(self.open_connections, 1),
+            self._attributes,
+        )
+
+        try:
+            response = await self._send_to_pool(request)
+        except BaseException:
+            self.active_streams -= 1
+            raise
+        finally:
+            tracer.finish()
+
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        stream: httpx.AsyncByteStream = response.stream
+        if (deadline := get_deadline()) is not None:
+            stream = _DeadlineStream(stream, deadline)
+        response.stream = _TrackedStream(stream, self._on_stream_closed)
+        return response
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
+
+
+class _RequestTracer:
+    """
+    Callback of the httpcore `trace` extension which tracks
+    how long the request waits for a connection from the pool.
+    """
+
+    def __init__(self, pool: UpstreamTransport) -> None:
+        self._pool = pool
+        self._started_at = time.perf_counter()
+        self._waiting = True
+        pool.waiting_requests += 1
+
+    async def __call__(self, event: str, info: dict) -> None:
+        if self._waiting and event in _CONNECTION_ACQUIRED_EVENTS:
+            self._waiting = False
+            self._pool._on_connection_acquired(
+                time.perf_counter() - self._started_at
+            )
+
+    def finish(self) -> None:
+        if self._waiting:
+            self._waiting = False
+            self._pool.waiting_requests -= 1
+
+
+def _chain_trace(trace: Any, own_trace: TraceCallback) -> TraceCallback:
+    if trace is None:
+        return own_trace
+
+    async def _trace(event: str, info: dict) -> None:
+        await own_trace(event, info)
+        await trace(event, info)
+
+    return _trace
+
+
+_DEPLOYMENT_PATH_PATTERN = re.compile(r"/openai/deployments/([^/]+)/")
+
+
+class _HostPattern:
+    """
+    Host of the pool configuration: `host`, `host:port` or `*.domain`,
+    optionally prefixed with a scheme.
+    """
+
+    def __init__(self, pattern: str) -> None:
+        self.scheme: Optional[str] = None
+        if "://" in pattern:
+            self.scheme, pattern = pattern.split("://", 1)
+        self.host, _, port = pattern.partition(":")
+        self.port = int(port) if port else None
+
+    @property
+    def http2_prior_knowledge(self) -> bool:
+        # There is no TLS to negotiate HTTP/2 over plain HTTP
+        return self.scheme == "http"
+
+    def matches(self, url: httpx.URL) -> bool:
+        if self.scheme is not None and self.scheme != url.scheme:
+            return False
+        if self.port is not None and self.port != url.port:
+            return False
+        if self.host.startswith("*."):
+            return url.host.endswith(self.host[1:])
+        return self.host == url.host
+
+
+class UpstreamRouter(httpx.AsyncBaseTransport):
+    """
+    Routes requests to the connection pool of their deployment,
+    then to the pool of their host, and finally to the default pool.
+    """
+
+    default_pool: UpstreamTransport
+    named_pools: Dict[str, UpstreamTransport]
+    deployment_pools: Dict[str, UpstreamTransport]
+    host_pools: List[tuple[_HostPattern, UpstreamTransport]]
+
+    def __init__(
+        self,
+        default_pool: UpstreamTransport,
+        pool_configs: Dict[str, ConnectionPoolConfig],
+        retry_policy: Optional[FastRetryPolicy] = None,
+    ) -> None:
+        self.default_pool = default_pool
+        self.named_pools = {
+            name: UpstreamTransport.from_config(name, config, retry_policy)
+            for name, config in pool_configs.items()
+        }
+        self.deployment_pools = {
+            deployment: self.named_pools[name]
+            for name, config in pool_configs.items()
+            for deployment in config.deployments
+        }
+        self.host_pools = [
+            (_HostPattern(host), self.named_pools[name])
+            for name, config in pool_configs.items()
+            for host in config.hosts
+        ]
+
+    @property
+    def pools(self) -> List[UpstreamTransport]:
+        return [self.default_pool, *self.named_pools.values()]
+
+    def get_pool(self, url: httpx.URL) -> UpstreamTransport:
+        if self.deployment_pools and (
+            match := _DEPLOYMENT_PATH_PATTERN.search(url.path)
+        ):
+            if pool := self.deployment_pools.get(match[1]):
+                return pool
+
+        for pattern, pool in self.host_pools:
+            if pattern.matches(url):
+                return pool
+
+        return self.default_pool
+
+    async def handle_async_request(
+        self, request: httpx.Request
+    ) -> httpx.Response:
+        pool = self.get_pool(request.url)
+        return await pool.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        for pool in self.pools:
+            await pool.aclose()
+
+
+def _get_pool_configs(
+    app_config: ApplicationConfig,
+) -> Dict[str, ConnectionPoolConfig]:
+    limits = DEFAULT_HTTP2_CONNECTION_LIMITS
+    http2_pools = {
+        host: ConnectionPoolConfig(
+            hosts=[host],
+            max_connections=limits.max_connections or 10,
+            max_keepalive_connections=limits.max_keepalive_connections or 10,
+            http2=True,
+        )
+        for host in app_config.HTTP2_UPSTREAM_HOSTS
+    }
+    return {**http2_pools, **app_config.UPSTREAM_CONNECTION_POOLS}
+
+
+_app_config: ApplicationConfig = ApplicationConfig()
+_router: Optional[UpstreamRouter] = None
+
+
+def configure_http_client(app_config: ApplicationConfig) -> None:
+    global _app_config
+    _app_config = app_config
+    get_http_client.cache_clear()
+    # The cached OpenAI clients hold a reference to the previous HTTP client
+    clear_client_cache()
+
 
 @functools.cache
 def get_http_client() -> httpx.AsyncClient:
+    global _router
+
+    # The retry budget is shared by all the pools
+    retry_policy = FastRetryPolicy.from_config(_app_config)
+    _router = UpstreamRouter(
+        UpstreamTransport(
+            "default",
+            limits=DEFAULT_CONNECTION_LIMITS,
+            retry_policy=retry_policy,
+        ),
+        _get_pool_configs(_app_config),
+        retry_policy,
+    )
+
     return httpx.AsyncClient(
         timeout=DEFAULT_TIMEOUT,
-        limits=DEFAULT_CONNECTION_LIMITS,
         follow_redirects=True,
+        transport=_router,
+        event_hooks={"response": [observe_httpx_response]},
     )
+
+
+def get_upstream_pools() -> List[UpstreamTransport]:
+    return [] if _router is None else _router.pools
+
+
+def _observe_open_connections(
+    options: CallbackOptions,
+) -> Iterable[Observation]:
+    for pool in get_upstream_pools():
+        yield Observation(pool.open_connections, pool._attributes)
+
+
+def _observe_active_streams(
+    options: CallbackOptions,
+) -> Iterable[Observation]:
+    for pool in get_upstream_pools():
+        yield Observation(pool.active_streams, pool._attributes)
+
+
+def _observe_waiting_requests(
+    options: CallbackOptions,
+) -> Iterable[Observation]:
+    for pool in get_upstream_pools():
+        yield Observation(pool.waiting_requests, pool._attributes)
+
+
+meter.create_observable_gauge(
+    "upstream.http.open_connections",
+    callbacks=[_observe_open_connections],
+    description="Number of connections in the upstream connection pool",
+)
+meter.create_observable_gauge(
+    "upstream.http.active_streams",
+    callbacks=[_observe_active_streams],
+    description="Number of in-flight requests in the upstream connection pool",
+)
+meter.create_observable_gauge(
+    "upstream.http.pool.waiting_requests",
+    callbacks=[_observe_waiting_requests],
+    description="Number of requests waiting for a connection from the upstream connection pool",
+)
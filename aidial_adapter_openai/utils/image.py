@@ -1,5 +1,5 @@
 from io import BytesIO
-from typing import Literal, Optional, assert_never
+from typing import Literal, Optional, Tuple, assert_never
 
 from PIL import Image
 from pydantic import BaseModel
@@ -25,26 +25,94 @@ def resolve_detail_level(
             assert_never(detail)
 
 
+def optimize_image(
+    image: Resource,
+    size: Tuple[int, int],
+    format: Optional[str] = None,
+    quality: int = 85,
+) -> Optional[Resource]:
+    """
+    Scales the image down to the given size, converts it to the given format
+    and drops all the frames of an animated image, except for the first one.
+    None is returned if the image can't be made smaller this way.
+    """
+
+    with Image.open(BytesIO(image.data)) as img:
+        source_format = img.format or ""
+        target_format = (format or source_format).upper()
+
+        width, height = max(size[0], 1), max(size[1], 1)
+        resize = width < img.width and height < img.height
+        animated = getattr(img, "n_frames", 1) > 1
+        if not (resize or animated or target_format != source_format):
+            return None
+
+        if resize and source_format == "JPEG":
+            # Decoding the image at a reduced scale
+            img.draft("RGB", (width, height))
+
+        frame = img.convert("RGBA" if img.mode in ("P", "LA", "PA") else None)
+        if target_format == "JPEG" and frame.mode not in ("RGB", "L"):
+            frame = _flatten_alpha(frame)
+        if resize:
+            frame = frame.resize((width, height), Image.Resampling.LANCZOS)
+
+        buffer = BytesIO()
+        frame.save(
+            buffer,
+            target_format,
+            quality=quality,
+            exif=img.getexif(),
+        )
+
+    if buffer.tell() >= len(image.data):
+        return None
+    return Resource(type=Image.MIME[target_format], data=buffer.getvalue())
+
+
+def _flatten_alpha(image: Image.Image) -> Image.Image:
+    image = image.convert("RGBA")
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+
+def get_image_size(image: Resource) -> Tuple[int, int]:
+    if image._image_size is None:
+        with Image.open(BytesIO(image.data)) as img:
+            image._image_size = img.size
+    return image._image_size
+
+
 class ImageMetadata(BaseModel):
     """
     Image metadata extracted from the image data URL.
+    The image itself is missing when only its size is known.
     """
 
-    image: Resource
+    image: Optional[Resource] = None
     width: int
     height: int
     detail: DetailLevel
 
     @classmethod
-    def from_resource(
-        cls, image: Resource, detail: Optional[ImageDetail]
+    def from_size(
+        cls,
+        width: int,
+        height: int,
+        detail: Optional[ImageDetail],
+        image: Optional[Resource] = None,
     ) -> "ImageMetadata":
-        with Image.open(BytesIO(image.data)) as img:
-            width, height = img.size
-
         return cls(
             image=image,
             width=width,
             height=height,
             detail=resolve_detail_level(width, height, detail or "auto"),
         )
+
+    @classmethod
+    def from_resource(
+        cls, image: Resource, detail: Optional[ImageDetail]
+    ) -> "ImageMetadata":
+        width, height = get_image_size(image)
+        return cls.from_size(width, height, detail, image)
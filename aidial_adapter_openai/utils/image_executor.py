@@ -0,0 +1,166 @@
+"""
+Executors of the CPU-bound image work, so that it doesn't block
+the event loop and the concurrent requests with it.
+
+Decoding, scaling and encoding of the images run on a process pool.
+Base64 encoding and decoding, which aren't worth sending the data
+to another process, run on threads and convert the data in chunks,
+so that the event loop thread gets the GIL in between.
+The work on small images is cheaper to do in place,
+so it stays on the event loop.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterable, Optional, Tuple, TypeVar
+
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from aidial_adapter_openai.utils.metrics import meter
+
+T = TypeVar("T")
+
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", 2))
+IMAGE_THREAD_WORKERS = int(os.getenv("IMAGE_THREAD_WORKERS", 4))
+
+# The data size in bytes starting from which the work leaves the event loop
+IMAGE_INLINE_SIZE_LIMIT = int(os.getenv("IMAGE_INLINE_SIZE_LIMIT", 256 * 1024))
+
+_queue_wait = meter.create_histogram(
+    "image.executor.queue_wait",
+    unit="s",
+    description="Time an image task waits for a free worker of the executor",
+)
+
+
+def _run_timed(func: Callable[..., T], *args) -> Tuple[float, T]:
+    # The wall clock is shared with the worker processes
+    return time.time(), func(*args)
+
+
+class ImageExecutor:
+    """
+    Pool of the workers of the given kind with the number of
+    the tasks submitted to it, which shows how saturated the pool is.
+    """
+
+    name: str
+    workers: int
+    in_flight: int
+
+    def __init__(
+        self, name: str, workers: int, create: Callable[[int], Executor]
+    ) -> None:
+        self.name = name
+        self.workers = workers
+        self.in_flight = 0
+        self._create = create
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = self._create(self.workers)
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        loop = asyncio.get_running_loop()
+        submitted_at = time.time()
+        self.in_flight += 1
+        try:
+            started_at, result = await loop.run_in_executor(
+                self._get_executor(), _run_timed, func, *args
+            )
+        except BrokenProcessPool:
+            # A crashed worker breaks the pool, so it's created anew
+            self.shutdown(wait=False)
+            raise
+        finally:
+            self.in_flight -= 1
+
+        _queue_wait.record(
+            max(started_at - submitted_at, 0.0), {"executor": self.name}
+        )
+        return result
+
+    def shutdown(self, wait: bool = True) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_process_executor = ImageExecutor(
+    "process",
+    IMAGE_PROCESS_WORKERS,
+    lambda workers: ProcessPoolExecutor(
+        max_workers=workers,
+        # Forking a process with running threads isn't safe
+        mp_context=multiprocessing.get_context("spawn"),
+    ),
+)
+
+_thread_executor = ImageExecutor(
+    "thread",
+    IMAGE_THREAD_WORKERS,
+    lambda workers: ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="image"
+    ),
+)
+
+_executors: Dict[str, ImageExecutor] = {
+    executor.name: executor
+    for executor in (_process_executor, _thread_executor)
+}
+
+
+async def run_in_process(func: Callable[..., T], *args, size: int) -> T:
+    """
+    Runs the image processing on the process pool,
+    unless the data of the given size is small enough.
+    The function and its arguments must be picklable.
+    """
+
+    if size < IMAGE_INLINE_SIZE_LIMIT or IMAGE_PROCESS_WORKERS <= 0:
+        return func(*args)
+    return await _process_executor.run(func, *args)
+
+
+async def run_in_thread(func: Callable[..., T], *args, size: int) -> T:
+    """
+    Runs the work on the thread pool, e.g. base64 encoding and decoding,
+    unless the data of the given size is small enough.
+    """
+
+    if size < IMAGE_INLINE_SIZE_LIMIT or IMAGE_THREAD_WORKERS <= 0:
+        return func(*args)
+    return await _thread_executor.run(func, *args)
+
+
+def shutdown_image_executors() -> None:
+    for executor in _executors.values():
+        executor.shutdown()
+
+
+def _observe(
+    get_value: Callable[[ImageExecutor], float]
+) -> Callable[[CallbackOptions], Iterable[Observation]]:
+    def _callback(options: CallbackOptions) -> Iterable[Observation]:
+        for executor in _executors.values():
+            yield Observation(get_value(executor), {"executor": executor.name})
+
+    return _callback
+
+
+meter.create_observable_gauge(
+    "image.executor.in_flight",
+    callbacks=[_observe(lambda executor: executor.in_flight)],
+    description="Number of the image tasks submitted to the executor, either running or waiting",
+)
+meter.create_observable_gauge(
+    "image.executor.workers",
+    callbacks=[_observe(lambda executor: executor.workers)],
+    description="Number of the workers of the image executor",
+)
@@ -0,0 +1,107 @@
+"""
+Reading the image size from the beginning of PNG, JPEG, GIF and WebP files,
+so that the image tokens are estimated without downloading the whole image.
+"""
+
+import struct
+from typing import Optional, Tuple
+
+# JPEG start of frame markers, which carry the image size
+_JPEG_SOF_MARKERS = {
+    *range(0xC0, 0xC4),
+    *range(0xC5, 0xC8),
+    *range(0xC9, 0xCC),
+    *range(0xCD, 0xD0),
+}
+
+# JPEG markers without a segment length
+_JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xDA)}
+
+
+def parse_image_size(header: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Returns the width and height of the image given the first bytes of it
+    or None if the format isn't recognized or the header is incomplete.
+    """
+
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return _parse_png_size(header)
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return _parse_gif_size(header)
+    if header.startswith(b"\xff\xd8"):
+        return _parse_jpeg_size(header)
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return _parse_webp_size(header)
+    return None
+
+
+def _parse_png_size(header: bytes) -> Optional[Tuple[int, int]]:
+    if len(header) < 24 or header[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", header[16:24])
+    return width, height
+
+
+def _parse_gif_size(header: bytes) -> Optional[Tuple[int, int]]:
+    if len(header) < 10:
+        return None
+    width, height = struct.unpack("<HH", header[6:10])
+    return width, height
+
+
+def _parse_jpeg_size(header: bytes) -> Optional[Tuple[int, int]]:
+    offset = 2
+    while offset + 4 <= len(header):
+        if header[offset] != 0xFF:
+            return None
+
+        marker = header[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+
+        if marker in _JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+
+        if marker in _JPEG_SOF_MARKERS:
+            if offset + 9 > len(header):
+                return None
+            height, width = struct.unpack(
+                ">HH", header[offset + 5 : offset + 9]
+            )
+            return width, height
+
+        (length,) = struct.unpack(">H", header[offset + 2 : offset + 4])
+        offset += 2 + length
+
+    return None
+
+
+def _parse_webp_size(header: bytes) -> Optional[Tuple[int, int]]:
+    chunk = header[12:16]
+
+    if chunk == b"VP8 ":
+        # Lossy bitstream: the frame tag followed by the start code
+        if len(header) < 30 or header[23:26] != b"\x9d\x01\x2a":
+            return None
+        width, height = struct.unpack("<HH", header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+
+    if chunk == b"VP8L":
+        # Lossless bitstream: the signature followed by 14-bit sizes
+        if len(header) < 25 or header[20] != 0x2F:
+            return None
+        (bits,) = struct.unpack("<I", header[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+
+    if chunk == b"VP8X":
+        # Extended format: 24-bit canvas sizes
+        if len(header) < 30:
+            return None
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return width, height
+
+    return None
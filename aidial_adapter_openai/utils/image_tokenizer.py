@@ -9,7 +9,11 @@ from typing import Literal, assert_never
 from pydantic import BaseModel
 
 from aidial_adapter_openai.constant import ChatCompletionDeploymentType
-from aidial_adapter_openai.utils.image import ImageDetail, resolve_detail_level
+from aidial_adapter_openai.utils.image import (
+    DetailLevel,
+    ImageDetail,
+    resolve_detail_level,
+)
 
 
 class ImageTokenizer(BaseModel):
@@ -34,11 +38,7 @@ class ImageTokenizer(BaseModel):
                 assert_never(concrete_detail)
 
     def _compute_high_detail_tokens(self, width: int, height: int) -> int:
-        # Fit into 2048x2048 box
-        width, height = _fit_longest(width, height, 2048)
-
-        # Scale down so the shortest side is 768 pixels
-        width, height = _fit_shortest(width, height, 768)
+        width, height = get_processed_size(width, height, "high")
 
         # Calculate the number of 512-pixel tiles required
         cols = math.ceil(width / 512)
@@ -75,6 +75,27 @@ def get_image_tokenizer(
             assert_never(deployment_type)
 
 
+def get_processed_size(
+    width: int, height: int, detail: DetailLevel
+) -> tuple[int, int]:
+    """
+    The size the image is scaled down to by the model
+    for the given detail level.
+    """
+    match detail:
+        case "low":
+            # Fit into 512x512 box
+            return _fit_longest(width, height, 512)
+        case "high":
+            # Fit into 2048x2048 box
+            width, height = _fit_longest(width, height, 2048)
+
+            # Scale down so the shortest side is 768 pixels
+            return _fit_shortest(width, height, 768)
+        case _:
+            assert_never(detail)
+
+
 def _fit_longest(width: int, height: int, size: int) -> tuple[int, int]:
     ratio = width / height
     if width > height:
@@ -0,0 +1,76 @@
+import json
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from aidial_adapter_openai.utils.resource import Resource
+
+# The size of the chunks the images are written in
+_CHUNK_SIZE = 64 * 1024
+
+
+class JSONBody:
+    """
+    JSON request body which is encoded while it's being sent.
+
+    The resources found in the object are written as data URLs
+    in chunks straight from their data, so neither the data URLs
+    nor the whole body are held in memory at once.
+    """
+
+    def __init__(self, obj: Any) -> None:
+        # The JSON apart from the resources is encoded beforehand
+        self._parts: List[bytes | Resource] = []
+        pending: List[bytes] = []
+        for part in _iter_json_parts(obj):
+            if isinstance(part, bytes):
+                pending.append(part)
+            else:
+                self._parts += [b"".join(pending), part]
+                pending = []
+        self._parts.append(b"".join(pending))
+
+    @property
+    def size(self) -> int:
+        return sum(
+            (len(part) if isinstance(part, bytes) else part.data_url_size)
+            for part in self._parts
+        )
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        # The explicit length spares the chunked transfer encoding
+        return {
+            "Content-Type": "application/json",
+            "Content-Length": str(self.size),
+        }
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                for chunk in part.iter_data_url(_CHUNK_SIZE):
+                    yield chunk
+
+
+def _iter_json_parts(obj: Any) -> Iterator[bytes | Resource]:
+    if isinstance(obj, Resource):
+        yield b'"'
+        yield obj
+        yield b'"'
+    elif isinstance(obj, dict):
+        yield b"{"
+        for idx, (key, value) in enumerate(obj.items()):
+            if idx > 0:
+                yield b", "
+            yield json.dumps(str(key)).encode() + b": "
+            yield from _iter_json_parts(value)
+        yield b"}"
+    elif isinstance(obj, (list, tuple)):
+        yield b"["
+        for idx, value in enumerate(obj):
+            if idx > 0:
+                yield b", "
+            yield from _iter_json_parts(value)
+        yield b"]"
+    else:
+        yield json.dumps(obj).encode()
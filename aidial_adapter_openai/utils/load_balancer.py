@@ -0,0 +1,278 @@
+"""
+Load balancing across the upstream endpoints of a deployment.
+
+By default, a request goes to the upstream endpoint given by
+the `X-UPSTREAM-ENDPOINT` header. A deployment may be configured
+with a pool of upstream endpoints instead, which the adapter balances itself.
+
+An upstream is picked by the power of two choices:
+of two random healthy upstreams the one with the lower load is chosen.
+The load is either the number of in-flight requests or its product
+with the peak EWMA of the upstream latency, which reacts to a slowdown
+at once and forgets it gradually.
+"""
+
+import math
+import random
+import time
+import weakref
+from typing import (
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    TypeVar,
+)
+
+from fastapi import FastAPI, Request
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from aidial_adapter_openai.app_config import (
+    ApplicationConfig,
+    UpstreamConfig,
+    UpstreamPoolConfig,
+)
+from aidial_adapter_openai.utils.circuit_breaker import get_circuit_breakers
+from aidial_adapter_openai.utils.log_config import logger
+from aidial_adapter_openai.utils.metrics import meter
+from aidial_adapter_openai.utils.outcome import Outcome, OutcomeCallback
+from aidial_adapter_openai.utils.upstream_request import guard_upstream_requests
+
+T = TypeVar("T")
+
+# Time in seconds over which a latency spike is forgotten
+_EWMA_DECAY_TIME = 10.0
+
+_selections = meter.create_counter(
+    "upstream.balancer.selections",
+    description="Number of requests sent to the upstream endpoint of the deployment pool",
+)
+_ejections = meter.create_counter(
+    "upstream.balancer.ejections",
+    description="Number of times the upstream endpoint was ejected from the deployment pool",
+)
+
+
+def get_request_upstream(request: Request) -> UpstreamConfig:
+    return UpstreamConfig(
+        endpoint=request.headers["X-UPSTREAM-ENDPOINT"],
+        key=request.headers.get("X-UPSTREAM-KEY"),
+    )
+
+
+class UpstreamMember:
+    config: UpstreamConfig
+
+    in_flight: int
+    latency: float
+    consecutive_failures: int
+    ejected_until: float
+
+    def __init__(self, config: UpstreamConfig) -> None:
+        self.config = config
+        self.in_flight = 0
+        self.latency = 0.0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self._latency_updated_at = time.monotonic()
+
+    @property
+    def endpoint(self) -> str:
+        return self.config.endpoint
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def get_latency(self, now: float) -> float:
+        elapsed = now - self._latency_updated_at
+        return self.latency * math.exp(-elapsed / _EWMA_DECAY_TIME)
+
+    def record_latency(self, latency: float) -> None:
+        now = time.monotonic()
+        current = self.get_latency(now)
+        if latency > current:
+            # Peak sensitive: a slowdown is taken into account at once
+            self.latency = latency
+        else:
+            weight = math.exp(
+                -(now - self._latency_updated_at) / _EWMA_DECAY_TIME
+            )
+            self.latency = current * weight + latency * (1 - weight)
+        self._latency_updated_at = now
+
+
+class UpstreamBalancer:
+    deployment: str
+    config: UpstreamPoolConfig
+    members: List[UpstreamMember]
+
+    def __init__(self, deployment: str, config: UpstreamPoolConfig) -> None:
+        self.deployment = deployment
+        self.config = config
+        self.members = [
+            UpstreamMember(upstream) for upstream in config.upstreams
+        ]
+
+    def _get_load(self, member: UpstreamMember, now: float) -> float:
+        if self.config.strategy == "least_requests":
+            return member.in_flight
+        return (member.in_flight + 1) * member.get_latency(now)
+
+    def select(self, exclude: Collection[str] = ()) -> UpstreamMember:
+        """
+        Picks an upstream other than the excluded ones, if possible.
+        """
+
+        now = time.monotonic()
+        healthy = [
+            member for member in self.members if not member.is_ejected(now)
+        ]
+        candidates = [
+            member for member in healthy if member.endpoint not in exclude
+        ] or healthy
+
+        if not candidates:
+            # Rather try an ejected upstream than fail the request
+            return min(self.members, key=lambda member: member.ejected_until)
+
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda member: self._get_load(member, now))
+
+    def acquire(self, member: UpstreamMember) -> OutcomeCallback:
+        member.in_flight += 1
+        _selections.add(1, self._attributes(member))
+
+        def _on_done(outcome: Outcome, latency: float) -> None:
+            member.in_flight -= 1
+            self._on_outcome(member, outcome, latency)
+
+        return _on_done
+
+    def _on_outcome(
+        self, member: UpstreamMember, outcome: Outcome, latency: float
+    ) -> None:
+        match outcome:
+            case Outcome.SUCCESS:
+                member.consecutive_failures = 0
+                member.record_latency(latency)
+            case Outcome.THROTTLED:
+                self._eject(member)
+            case Outcome.OVERLOAD:
+                member.consecutive_failures += 1
+                if member.consecutive_failures >= self.config.max_failures:
+                    self._eject(member)
+            case Outcome.IGNORE:
+                pass
+
+    def _eject(self, member: UpstreamMember) -> None:
+        now = time.monotonic()
+        if member.is_ejected(now):
+            return
+        member.ejected_until = now + self.config.ejection_time
+        member.consecutive_failures = 0
+        _ejections.add(1, self._attributes(member))
+        logger.warning(
+            f"Upstream {member.endpoint!r} of {self.deployment!r} is ejected "
+            f"for {self.config.ejection_time}s"
+        )
+
+    def _attributes(self, member: UpstreamMember) -> Dict[str, str]:
+        return {"deployment": self.deployment, "upstream": member.endpoint}
+
+
+# The balancers of all the applications for the metrics
+_balancers: "weakref.WeakSet[UpstreamBalancer]" = weakref.WeakSet()
+
+
+def configure_upstream_balancers(
+    app: FastAPI, app_config: ApplicationConfig
+) -> None:
+    balancers = {
+        deployment: UpstreamBalancer(deployment, config)
+        for deployment, config in app_config.DEPLOYMENT_UPSTREAMS.items()
+    }
+    _balancers.update(balancers.values())
+    app.state.upstream_balancers = balancers
+
+
+def get_upstream_balancer(
+    request: Request, deployment: str
+) -> Optional[UpstreamBalancer]:
+    balancers: Dict[str, UpstreamBalancer] = (
+        request.app.state.upstream_balancers
+    )
+    return balancers.get(deployment)
+
+
+async def call_upstream(
+    deployment: str,
+    request: Request,
+    call: Callable[[UpstreamConfig], Awaitable[T]],
+    exclude: Collection[str] = (),
+) -> T:
+    """
+    Calls the upstream endpoint picked from the pool of the deployment,
+    or the one given in the request when there is no pool.
+    """
+
+    breakers = get_circuit_breakers(request.app)
+
+    if (balancer := get_upstream_balancer(request, deployment)) is None:
+        upstream = get_request_upstream(request)
+        return await breakers.call(upstream.endpoint, lambda: call(upstream))
+
+    # The upstreams with the open circuit are avoided while there are others
+    exclude = [
+        *exclude,
+        *(
+            member.endpoint
+            for member in balancer.members
+            if breakers.is_open(member.endpoint)
+        ),
+    ]
+    member = balancer.select(exclude)
+
+    # The outcome and the latency are taken from the upstream request only
+    async def _acquire() -> OutcomeCallback:
+        return balancer.acquire(member)
+
+    return await breakers.call(
+        member.endpoint,
+        lambda: guard_upstream_requests(_acquire, lambda: call(member.config)),
+    )
+
+
+def _observe(
+    get_value: Callable[[UpstreamMember, float], float]
+) -> Callable[[CallbackOptions], Iterable[Observation]]:
+    def _callback(options: CallbackOptions) -> Iterable[Observation]:
+        now = time.monotonic()
+        for balancer in list(_balancers):
+            for member in balancer.members:
+                yield Observation(
+                    get_value(member, now), balancer._attributes(member)
+                )
+
+    return _callback
+
+
+meter.create_observable_gauge(
+    "upstream.balancer.in_flight",
+    callbacks=[_observe(lambda member, now: member.in_flight)],
+    description="Number of in-flight requests to the upstream endpoint of the deployment pool",
+)
+meter.create_observable_gauge(
+    "upstream.balancer.latency",
+    unit="s",
+    callbacks=[_observe(lambda member, now: member.get_latency(now))],
+    description="Peak EWMA of the latency of the upstream endpoint of the deployment pool",
+)
+meter.create_observable_gauge(
+    "upstream.balancer.ejected",
+    callbacks=[_observe(lambda member, now: int(member.is_ejected(now)))],
+    description="Whether the upstream endpoint is ejected from the deployment pool",
+)
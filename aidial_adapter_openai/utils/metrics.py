@@ -0,0 +1,10 @@
+"""
+OpenTelemetry instruments of the adapter.
+
+The meter provider and the exporters are configured by DIAL SDK
+in `init_telemetry`. When telemetry isn't enabled, the instruments are no-op.
+"""
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter("aidial_adapter_openai")
@@ -1,16 +1,20 @@
-from typing import List
+from typing import Dict, Hashable, List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from aidial_adapter_openai.utils.image import ImageDetail, ImageMetadata
 from aidial_adapter_openai.utils.resource import Resource
 
 
 def create_image_content_part(image: Resource, detail: ImageDetail) -> dict:
+    """
+    The image is encoded to a data URL when the request is sent,
+    see `JSONBody`.
+    """
     return {
         "type": "image_url",
         "image_url": {
-            "url": image.to_data_url(),
+            "url": image,
             "detail": detail,
         },
     }
@@ -26,3 +30,7 @@ def create_text_content_part(text: str) -> dict:
 class MultiModalMessage(BaseModel):
     image_metadatas: List[ImageMetadata]
     raw_message: dict
+
+    # The token counts by the tokenizers which counted them.
+    # The copies of a message restored from the cache share them.
+    _tokens: Dict[Hashable, int] = PrivateAttr(default_factory=dict)
@@ -0,0 +1,126 @@
+"""
+Classification of the outcomes of the upstream calls.
+
+The outcome of a streaming response is only known once the stream is over,
+so the callback is invoked when the stream is exhausted or closed.
+"""
+
+import time
+from enum import StrEnum
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+import aiohttp
+from aidial_sdk.exceptions import HTTPException as DialException
+from fastapi.responses import Response
+from openai import APIConnectionError, APIError
+
+from aidial_adapter_openai.exception_handlers import to_adapter_exception
+from aidial_adapter_openai.utils.adapter_exception import ResponseWrapper
+
+T = TypeVar("T")
+
+
+class Outcome(StrEnum):
+    SUCCESS = "SUCCESS"
+    # The upstream is throttling the requests
+    THROTTLED = "THROTTLED"
+    # The upstream is failing or unreachable
+    OVERLOAD = "OVERLOAD"
+    # The outcome says nothing about the upstream health, e.g. a client error
+    IGNORE = "IGNORE"
+
+
+def get_status_outcome(status_code: int) -> Outcome:
+    if status_code == 429:
+        return Outcome.THROTTLED
+    if status_code >= 500:
+        return Outcome.OVERLOAD
+    if status_code >= 400:
+        return Outcome.IGNORE
+    return Outcome.SUCCESS
+
+
+def get_error_outcome(exc: BaseException) -> Outcome:
+    if isinstance(
+        exc, (APIConnectionError, aiohttp.ClientConnectionError, TimeoutError)
+    ):
+        return Outcome.OVERLOAD
+    if isinstance(exc, (APIError, DialException, ResponseWrapper)):
+        return get_status_outcome(to_adapter_exception(exc).status_code)
+    return Outcome.IGNORE
+
+
+OutcomeCallback = Callable[[Outcome, float], None]
+
+
+class _ObservedStream(AsyncIterator[T]):
+    """
+    Stream which reports its outcome once it's exhausted, fails or is closed.
+    Unlike an async generator, it reports the outcome
+    even when it's closed before the iteration has started.
+    """
+
+    def __init__(
+        self, stream: AsyncIterator[T], on_done: Callable[[Outcome], None]
+    ) -> None:
+        self._stream = stream
+        self._on_done: Optional[Callable[[Outcome], None]] = on_done
+
+    def _finish(self, outcome: Outcome) -> None:
+        if self._on_done is not None:
+            on_done, self._on_done = self._on_done, None
+            on_done(outcome)
+
+    def __aiter__(self) -> AsyncIterator[T]:
+        return self
+
+    async def __anext__(self) -> T:
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._finish(Outcome.SUCCESS)
+            raise
+        except Exception as e:
+            self._finish(get_error_outcome(e))
+            raise
+
+    async def aclose(self) -> None:
+        try:
+            if (aclose := getattr(self._stream, "aclose", None)) is not None:
+                await aclose()
+        finally:
+            self._finish(Outcome.IGNORE)
+
+    def __del__(self) -> None:
+        # The stream is abandoned, e.g. the client has disconnected
+        self._finish(Outcome.IGNORE)
+
+
+async def observe_call(
+    call: Callable[[], Awaitable[T]], on_done: OutcomeCallback
+) -> T:
+    """
+    Runs the upstream call and reports its outcome along with the latency
+    of the upstream response, i.e. the time to the first chunk for streams.
+    """
+
+    started_at = time.perf_counter()
+    try:
+        result = await call()
+    except BaseException as e:
+        on_done(get_error_outcome(e), time.perf_counter() - started_at)
+        raise
+
+    latency = time.perf_counter() - started_at
+
+    if isinstance(result, AsyncIterator):
+        return _ObservedStream(  # type: ignore
+            result, lambda outcome: on_done(outcome, latency)
+        )
+
+    if isinstance(result, Response):
+        on_done(get_status_outcome(result.status_code), latency)
+    else:
+        on_done(Outcome.SUCCESS, latency)
+
+    return result
@@ -1,13 +1,15 @@
+import functools
 import re
 from abc import ABC, abstractmethod
 from json import JSONDecodeError
-from typing import Any, Dict, TypedDict
+from typing import Any, Dict, Tuple, TypedDict
 
 from aidial_sdk.exceptions import InvalidRequestError
 from fastapi import Request
 from openai import AsyncAzureOpenAI, AsyncOpenAI, Timeout
 from pydantic import BaseModel
 
+from aidial_adapter_openai.utils.client_cache import get_cached_client
 from aidial_adapter_openai.utils.http_client import get_http_client
 
 
@@ -24,7 +26,8 @@ class Endpoint(ABC):
         pass
 
 
-# Retries are handled on the DIAL Core side
+# Retries are handled on the DIAL Core side,
+# except for the connection failures retried by the HTTP client
 _MAX_RETRIES = 0
 
 
@@ -33,15 +36,26 @@ class AzureOpenAIEndpoint(BaseModel):
     azure_deployment: str
 
     def get_client(self, params: OpenAIParams) -> AsyncAzureOpenAI:
-        return AsyncAzureOpenAI(
-            azure_endpoint=self.azure_endpoint,
-            azure_deployment=self.azure_deployment,
-            api_key=params.get("api_key"),
-            azure_ad_token=params.get("azure_ad_token"),
-            api_version=params.get("api_version"),
-            timeout=params.get("timeout"),
-            max_retries=_MAX_RETRIES,
-            http_client=get_http_client(),
+        key = (
+            "azure",
+            self.azure_endpoint,
+            self.azure_deployment,
+            params.get("api_version"),
+            str(params.get("timeout")),
+        )
+        return get_cached_client(
+            key,
+            params,
+            lambda: AsyncAzureOpenAI(
+                azure_endpoint=self.azure_endpoint,
+                azure_deployment=self.azure_deployment,
+                api_key=params.get("api_key"),
+                azure_ad_token=params.get("azure_ad_token"),
+                api_version=params.get("api_version"),
+                timeout=params.get("timeout"),
+                max_retries=_MAX_RETRIES,
+                http_client=get_http_client(),
+            ),
         )
 
 
@@ -49,26 +63,42 @@ class OpenAIEndpoint(BaseModel):
     base_url: str
 
     def get_client(self, params: OpenAIParams) -> AsyncOpenAI:
-        return AsyncOpenAI(
-            base_url=self.base_url,
-            api_key=params.get("api_key"),
-            timeout=params.get("timeout"),
-            max_retries=_MAX_RETRIES,
-            http_client=get_http_client(),
+        key = ("openai", self.base_url, str(params.get("timeout")))
+        return get_cached_client(
+            key,
+            params,
+            lambda: AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=params.get("api_key"),
+                timeout=params.get("timeout"),
+                max_retries=_MAX_RETRIES,
+                http_client=get_http_client(),
+            ),
         )
 
 
+@functools.cache
+def _get_endpoint_patterns(name: str) -> Tuple[re.Pattern, re.Pattern]:
+    return (
+        re.compile(f"(.+?)/openai/deployments/(.+?)/{name}"),
+        re.compile(f"(.+?)/{name}"),
+    )
+
+
+# The upstream endpoints are fixed by the DIAL Core configuration,
+# so the set of distinct endpoints is small.
+# The parsed endpoints are shared and must not be mutated.
+@functools.lru_cache(maxsize=1024)
 def _parse_endpoint(
-    name, endpoint
+    name: str, endpoint: str
 ) -> AzureOpenAIEndpoint | OpenAIEndpoint | None:
-    if azure_match := re.search(
-        f"(.+?)/openai/deployments/(.+?)/{name}", endpoint
-    ):
+    azure_pattern, openai_pattern = _get_endpoint_patterns(name)
+    if azure_match := azure_pattern.search(endpoint):
         return AzureOpenAIEndpoint(
             azure_endpoint=azure_match[1],
             azure_deployment=azure_match[2],
         )
-    elif openai_match := re.search(f"(.+?)/{name}", endpoint):
+    elif openai_match := openai_pattern.search(endpoint):
         return OpenAIEndpoint(base_url=openai_match[1])
     else:
         return None
@@ -82,6 +112,9 @@ class EndpointParser(BaseModel):
             return result
         raise InvalidRequestError("Invalid upstream endpoint format")
 
+    def get_client(self, endpoint: str, params: OpenAIParams) -> AsyncOpenAI:
+        return self.parse(endpoint).get_client(params)
+
 
 class CompletionsParser(BaseModel):
     def parse(
@@ -1,22 +1,56 @@
 import base64
 import re
-from typing import Optional
+from typing import Any, Dict, Iterator, Optional, Tuple, cast
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+
+_BASE64_PATTERN = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+# The large data is converted in chunks, so that the thread doing it
+# lets the other threads run in between
+_BASE64_CHUNK_SIZE = 1024 * 1024
 
 
 class Resource(BaseModel):
+    """
+    The resource keeps its data in the form it was created with,
+    either raw bytes or base64, and converts it only on demand.
+    So the base64 images, which aren't modified, are passed to the upstream
+    without being decoded and encoded back.
+    """
+
     type: str
-    data: bytes
+
+    _data: Optional[bytes] = PrivateAttr(default=None)
+    _data_base64: Optional[str] = PrivateAttr(default=None)
+
+    # Memoized by the image metadata, since the cached resources are reused
+    _image_size: Optional[Tuple[int, int]] = PrivateAttr(default=None)
+
+    def __init__(
+        self,
+        *,
+        type: str,
+        data: Optional[bytes] = None,
+        data_base64: Optional[str] = None,
+    ):
+        if data is None and data_base64 is None:
+            raise ValueError("Either data or base64 data is expected")
+
+        super().__init__(type=type)
+        self._data = data
+        self._data_base64 = data_base64
 
     @classmethod
     def from_base64(cls, type: str, data_base64: str) -> "Resource":
-        try:
-            data = base64.b64decode(data_base64, validate=True)
-        except Exception:
+        # Validating the data without decoding it
+        if (
+            len(data_base64) % 4 != 0
+            or _BASE64_PATTERN.fullmatch(data_base64) is None
+        ):
             raise ValueError("Invalid base64 data")
 
-        return cls(type=type, data=data)
+        return cls(type=type, data_base64=data_base64)
 
     @classmethod
     def from_data_url(cls, data_url: str) -> Optional["Resource"]:
@@ -33,13 +67,62 @@ class Resource(BaseModel):
 
         return cls.from_base64(type, data_base64)
 
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = _decode_base64(cast(str, self._data_base64))
+        return self._data
+
     @property
     def data_base64(self) -> str:
-        return base64.b64encode(self.data).decode()
+        if self._data_base64 is not None:
+            return self._data_base64
+        return _encode_base64(self.data)
+
+    @property
+    def data_size(self) -> int:
+        """
+        The size of the data, estimated without decoding it.
+        """
+        if self._data is not None:
+            return len(self._data)
+        return len(cast(str, self._data_base64)) // 4 * 3
+
+    def with_type(self, type: str) -> "Resource":
+        if type == self.type:
+            return self
+        return Resource(
+            type=type, data=self._data, data_base64=self._data_base64
+        )
 
     def to_data_url(self) -> str:
         return f"{self._to_data_url_prefix(self.type)}{self.data_base64}"
 
+    @property
+    def data_url_size(self) -> int:
+        size = len(self._to_data_url_prefix(self.type))
+        if self._data_base64 is not None:
+            return size + len(self._data_base64)
+        return size + (len(self.data) + 2) // 3 * 4
+
+    def iter_data_url(self, chunk_size: int) -> Iterator[bytes]:
+        """
+        Encodes the data URL in chunks of about the given size.
+        """
+
+        yield self._to_data_url_prefix(self.type).encode()
+
+        if (data_base64 := self._data_base64) is not None:
+            for start in range(0, len(data_base64), chunk_size):
+                yield data_base64[start : start + chunk_size].encode()
+        else:
+            # Every 3 bytes are encoded to 4 base64 characters
+            raw_chunk_size = max(chunk_size // 4 * 3, 3)
+            for start in range(0, len(self.data), raw_chunk_size):
+                yield base64.b64encode(
+                    self.data[start : start + raw_chunk_size]
+                )
+
     @staticmethod
     def parse_data_url_content_type(data_url: str) -> Optional[str]:
         pattern = r"^data:([^;]+);base64,"
@@ -50,5 +133,28 @@ class Resource(BaseModel):
     def _to_data_url_prefix(content_type: str) -> str:
         return f"data:{content_type};base64,"
 
+    def dict(self, **kwargs) -> Dict[str, Any]:
+        # The data isn't a field to keep it in the original form
+        return {**super().dict(**kwargs), "data": self.data}
+
     def __str__(self) -> str:
-        return self.to_data_url()[:100] + "..."
+        prefix = self._to_data_url_prefix(self.type)
+        return prefix + self.data_base64[: 100 - len(prefix)] + "..."
+
+
+def _decode_base64(data_base64: str) -> bytes:
+    # The chunks of the valid base64 are multiples of 4 characters
+    chunk_size = _BASE64_CHUNK_SIZE // 3 * 4
+    return b"".join(
+        base64.b64decode(data_base64[start : start + chunk_size])
+        for start in range(0, len(data_base64), chunk_size)
+    )
+
+
+def _encode_base64(data: bytes) -> str:
+    # Every 3 bytes are encoded to 4 base64 characters
+    chunk_size = _BASE64_CHUNK_SIZE // 3 * 3
+    return b"".join(
+        base64.b64encode(data[start : start + chunk_size])
+        for start in range(0, len(data), chunk_size)
+    ).decode()
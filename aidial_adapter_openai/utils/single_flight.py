@@ -0,0 +1,51 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class _Flight(Generic[V]):
+    def __init__(self, task: asyncio.Task[V]) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Deduplicates concurrent calls with the same key:
+    the calls made while the first one is in flight share its result.
+
+    The shared call is cancelled once all of its callers are cancelled.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[K, _Flight[V]] = {}
+
+    async def run(self, key: K, call: Callable[[], Awaitable[V]]) -> V:
+        flight = self._flights.get(key)
+        if (
+            flight is None
+            or flight.task.get_loop() is not asyncio.get_running_loop()
+        ):
+            flight = self._flights[key] = _Flight(asyncio.create_task(call()))
+            flight.task.add_done_callback(
+                lambda task, flight=flight: self._on_done(key, flight)
+            )
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _on_done(self, key: K, flight: _Flight[V]) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def __len__(self) -> int:
+        return len(self._flights)
@@ -0,0 +1,282 @@
+"""
+Admission of the upstream requests by the remaining rate limit budget.
+
+Azure OpenAI throttles deployments by tokens and requests per minute and
+reports the remaining budget in the `x-ratelimit-remaining-tokens` and
+`x-ratelimit-remaining-requests` response headers.
+The adapter tracks the budget of each upstream deployment from these headers
+and delays the requests which would exceed it,
+instead of sending them upstream only to get 429 back.
+"""
+
+import asyncio
+import re
+import time
+import weakref
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Optional, Set
+
+import httpx
+from aidial_sdk.exceptions import HTTPException as DialException
+from fastapi import FastAPI, Request
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.log_config import logger
+from aidial_adapter_openai.utils.metrics import meter
+
+REMAINING_TOKENS_HEADER = "x-ratelimit-remaining-tokens"
+REMAINING_REQUESTS_HEADER = "x-ratelimit-remaining-requests"
+
+# The rate limits are defined per minute
+_REPLENISH_PERIOD = 60.0
+
+_DEPLOYMENT_PATTERN = re.compile(r"/deployments/([^/]+)")
+
+_admission_wait = meter.create_histogram(
+    "upstream.ratelimit.admission_wait",
+    unit="s",
+    description="Time a request is delayed to stay within the upstream rate limit",
+)
+
+
+class _Bucket:
+    """
+    Budget reported by the upstream, which is replenished
+    at the rate of its per-minute limit between the reports.
+    The limit is estimated as the largest budget reported so far.
+    """
+
+    remaining: Optional[float]
+    capacity: Optional[float]
+
+    def __init__(self) -> None:
+        self.remaining = None
+        self.capacity = None
+        self._updated_at = self._reported_at = time.monotonic()
+
+    def _replenish(self, now: float) -> None:
+        if self.remaining is not None and self.capacity is not None:
+            rate = self.capacity / _REPLENISH_PERIOD
+            self.remaining = min(
+                self.capacity,
+                self.remaining + rate * (now - self._updated_at),
+            )
+        self._updated_at = now
+
+    def update(self, remaining: float) -> None:
+        self._reported_at = now = time.monotonic()
+        self._replenish(now)
+        self.remaining = remaining
+        self.capacity = max(self.capacity or 0.0, remaining)
+
+    def get_wait_time(self, cost: float) -> float:
+        now = time.monotonic()
+        self._replenish(now)
+        if self.remaining is None or self.capacity is None:
+            return 0.0
+
+        if self.capacity == 0:
+            # The replenishment rate is unknown until the next report,
+            # but the whole budget is restored in a period
+            return max(0.0, self._reported_at + _REPLENISH_PERIOD - now)
+
+        # A request larger than the whole budget waits for the full budget
+        cost = min(cost, self.capacity)
+        if self.remaining >= cost:
+            return 0.0
+
+        rate = self.capacity / _REPLENISH_PERIOD
+        return (cost - self.remaining) / rate
+
+    def charge(self, cost: float) -> None:
+        if self.remaining is not None:
+            self.remaining -= cost
+
+
+class TokenBudget:
+    key: str
+    tokens: _Bucket
+    requests: _Bucket
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.tokens = _Bucket()
+        self.requests = _Bucket()
+        # Guards the check of the budget along with its charge
+        self._lock = asyncio.Lock()
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        if (
+            tokens := _parse_number(headers.get(REMAINING_TOKENS_HEADER))
+        ) is not None:
+            self.tokens.update(tokens)
+        if (
+            requests := _parse_number(headers.get(REMAINING_REQUESTS_HEADER))
+        ) is not None:
+            self.requests.update(requests)
+
+    def _get_wait_time(self, tokens: int) -> float:
+        return max(
+            self.tokens.get_wait_time(tokens),
+            self.requests.get_wait_time(1),
+        )
+
+    async def admit(self, tokens: int, max_wait: float) -> None:
+        started_at = time.monotonic()
+
+        while True:
+            async with self._lock:
+                wait = self._get_wait_time(tokens)
+                if wait == 0:
+                    self.tokens.charge(tokens)
+                    self.requests.charge(1)
+                    break
+
+            waited = time.monotonic() - started_at
+            if waited + wait > max_wait:
+                _admission_wait.record(waited, {"upstream": self.key})
+                raise DialException(
+                    status_code=429,
+                    type="rate_limit_exceeded",
+                    message="The request exceeds the remaining rate limit of the deployment",
+                    display_message="The model is overloaded. Please try again later.",
+                    headers={"Retry-After": str(int(wait) + 1)},
+                )
+
+            # The smaller requests may be admitted in the meantime
+            await asyncio.sleep(wait)
+
+        waited = time.monotonic() - started_at
+        _admission_wait.record(waited, {"upstream": self.key})
+        if waited > 0.1:
+            logger.debug(
+                f"The request to {self.key} was delayed by {waited:.2f}s"
+            )
+
+
+def _parse_number(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def get_upstream_key(url: str | httpx.URL) -> str:
+    url = httpx.URL(url)
+    if match := _DEPLOYMENT_PATTERN.search(url.path):
+        return f"{url.host}/{match[1]}"
+    return url.host
+
+
+class TokenBudgets:
+    """
+    The budgets of the upstream deployments created on their first report.
+    """
+
+    admission_deployments: Set[str]
+    max_wait: float
+
+    def __init__(self, admission_deployments: Set[str], max_wait: float):
+        self.admission_deployments = admission_deployments
+        self.max_wait = max_wait
+        self._budgets: Dict[str, TokenBudget] = {}
+
+    @classmethod
+    def from_config(cls, app_config: ApplicationConfig) -> "TokenBudgets":
+        return cls(
+            set(app_config.TOKEN_BUDGET_DEPLOYMENTS),
+            app_config.TOKEN_BUDGET_MAX_WAIT,
+        )
+
+    def get(self, upstream_url: str | httpx.URL) -> TokenBudget:
+        key = get_upstream_key(upstream_url)
+        if (budget := self._budgets.get(key)) is None:
+            budget = self._budgets[key] = TokenBudget(key)
+        return budget
+
+    def __iter__(self) -> Iterator[TokenBudget]:
+        return iter(list(self._budgets.values()))
+
+
+# The budgets of all the applications for the metrics
+_token_budgets: "weakref.WeakSet[TokenBudgets]" = weakref.WeakSet()
+
+# The budgets of the application serving the current request,
+# since the responses are observed deep in the upstream clients
+_request_token_budgets: ContextVar[Optional[TokenBudgets]] = ContextVar(
+    "token_budgets", default=None
+)
+
+
+def configure_token_budgets(
+    app: FastAPI, app_config: ApplicationConfig
+) -> None:
+    budgets = TokenBudgets.from_config(app_config)
+    _token_budgets.add(budgets)
+    app.state.token_budgets = budgets
+
+
+def get_token_budgets(app: FastAPI) -> TokenBudgets:
+    return app.state.token_budgets
+
+
+def set_request_token_budgets(request: Request) -> None:
+    _request_token_budgets.set(get_token_budgets(request.app))
+
+
+def observe_rate_limit_headers(
+    upstream_url: str | httpx.URL, headers: Mapping[str, str]
+) -> None:
+    if (budgets := _request_token_budgets.get()) is not None and (
+        REMAINING_TOKENS_HEADER in headers
+        or REMAINING_REQUESTS_HEADER in headers
+    ):
+        budgets.get(upstream_url).update(headers)
+
+
+async def observe_httpx_response(response: httpx.Response) -> None:
+    observe_rate_limit_headers(response.request.url, response.headers)
+
+
+async def admit_request(
+    deployment_id: str,
+    upstream_url: str,
+    get_tokens: Callable[[], int],
+) -> None:
+    """
+    Waits until the upstream budget allows the request of the given cost.
+    The cost is only computed when the admission is enabled for the deployment.
+    """
+
+    budgets = _request_token_budgets.get()
+    if budgets is None or deployment_id not in budgets.admission_deployments:
+        return
+    await budgets.get(upstream_url).admit(get_tokens(), budgets.max_wait)
+
+
+def _observe(
+    get_bucket: Callable[[TokenBudget], _Bucket]
+) -> Callable[[CallbackOptions], Iterable[Observation]]:
+    def _callback(options: CallbackOptions) -> Iterable[Observation]:
+        for budgets in list(_token_budgets):
+            for budget in budgets:
+                remaining = get_bucket(budget).remaining
+                if remaining is not None:
+                    yield Observation(remaining, {"upstream": budget.key})
+
+    return _callback
+
+
+meter.create_observable_gauge(
+    "upstream.ratelimit.remaining_tokens",
+    callbacks=[_observe(lambda budget: budget.tokens)],
+    description="Estimated remaining token budget of the upstream deployment",
+)
+meter.create_observable_gauge(
+    "upstream.ratelimit.remaining_requests",
+    callbacks=[_observe(lambda budget: budget.requests)],
+    description="Estimated remaining request budget of the upstream deployment",
+)
@@ -177,8 +177,22 @@ class MultiModalTokenizer(BaseTokenizer[MultiModalMessage]):
     def __init__(self, model: str, image_tokenizer: ImageTokenizer):
         super().__init__(model)
         self.image_tokenizer = image_tokenizer
+        self._tokens_key = (
+            model,
+            image_tokenizer.low_detail_tokens,
+            image_tokenizer.tokens_per_tile,
+        )
 
     def tokenize_request_message(self, message: MultiModalMessage) -> int:
+        # The history messages are tokenized once per conversation
+        tokens = message._tokens.get(self._tokens_key)
+        if tokens is None:
+            tokens = message._tokens[self._tokens_key] = (
+                self._tokenize_request_message(message)
+            )
+        return tokens
+
+    def _tokenize_request_message(self, message: MultiModalMessage) -> int:
         tokens = self._tokens_per_request_message
         raw_message = message.raw_message
 
@@ -0,0 +1,69 @@
+"""
+Scope of the upstream request within the handling of the adapter request.
+
+The concurrency limiter, the circuit breakers and the load balancer
+judge the upstream by the outcome and the latency of its requests.
+Before the upstream request, the handlers download the images,
+tokenize the prompt and wait for the rate limit budget, and the errors
+raised on the way say nothing about the upstream.
+So the guards are registered for the whole handling, but they are only
+acquired and observed around the upstream request itself,
+which the handlers make with `call_upstream_request`.
+"""
+
+from contextvars import ContextVar
+from typing import Awaitable, Callable, List, Tuple, TypeVar
+
+from aidial_adapter_openai.utils.outcome import (
+    Outcome,
+    OutcomeCallback,
+    observe_call,
+)
+
+T = TypeVar("T")
+
+# Admits the upstream request or raises an error,
+# and returns the callback to report the outcome of the request to
+UpstreamGuard = Callable[[], Awaitable[OutcomeCallback]]
+
+_guards: ContextVar[Tuple[UpstreamGuard, ...]] = ContextVar(
+    "upstream_guards", default=()
+)
+
+
+async def guard_upstream_requests(
+    guard: UpstreamGuard, call: Callable[[], Awaitable[T]]
+) -> T:
+    """
+    Runs the handling of the request with its upstream requests
+    guarded by the guard after the ones registered before.
+    """
+
+    token = _guards.set((*_guards.get(), guard))
+    try:
+        return await call()
+    finally:
+        _guards.reset(token)
+
+
+async def call_upstream_request(call: Callable[[], Awaitable[T]]) -> T:
+    """
+    Makes the upstream request once all the guards admit it
+    and reports its outcome and latency to them.
+    """
+
+    callbacks: List[OutcomeCallback] = []
+    try:
+        for guard in _guards.get():
+            callbacks.append(await guard())
+    except BaseException:
+        # The request rejected by a guard isn't a failure of the upstream
+        for callback in callbacks:
+            callback(Outcome.IGNORE, 0.0)
+        raise
+
+    def _on_done(outcome: Outcome, latency: float) -> None:
+        for callback in callbacks:
+            callback(outcome, latency)
+
+    return await observe_call(call, _on_done)
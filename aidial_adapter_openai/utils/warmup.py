@@ -0,0 +1,127 @@
+"""
+Prewarming of the upstream connections.
+
+The first requests to an upstream after a deployment pay for DNS resolution,
+TCP and TLS handshakes. The warmer opens keep-alive connections
+to the known upstreams before the application reports readiness
+and periodically reuses them, so that they aren't reaped as idle.
+
+Only the connections of the shared httpx client are warmed up:
+the multimodal GPT-4, DALL-E 3 and Azure AI Vision calls
+open their own aiohttp sessions.
+"""
+
+import asyncio
+from typing import List, Optional
+
+import httpx
+
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.http_client import (
+    WARMUP_EXTENSION,
+    get_http_client,
+)
+from aidial_adapter_openai.utils.log_config import logger
+
+# Warm-up requests shouldn't delay the startup for too long
+WARMUP_TIMEOUT = httpx.Timeout(10)
+
+
+def get_warmup_urls(app_config: ApplicationConfig) -> List[str]:
+    hosts = [
+        *app_config.HTTP2_UPSTREAM_HOSTS,
+        *(
+            host
+            for pool in app_config.UPSTREAM_CONNECTION_POOLS.values()
+            for host in pool.hosts
+        ),
+    ]
+
+    urls = list(app_config.UPSTREAM_WARMUP_URLS)
+    for host in hosts:
+        if "*" in host:
+            continue
+        url = host if "://" in host else f"https://{host}"
+        if url not in urls:
+            urls.append(url)
+
+    return urls
+
+
+class ConnectionWarmer:
+    urls: List[str]
+    connections: int
+    refresh_interval: float
+
+    _refresh_task: Optional[asyncio.Task] = None
+
+    def __init__(
+        self, urls: List[str], connections: int, refresh_interval: float
+    ) -> None:
+        self.urls = urls
+        self.connections = connections
+        self.refresh_interval = refresh_interval
+
+    @classmethod
+    def from_config(cls, app_config: ApplicationConfig) -> "ConnectionWarmer":
+        return cls(
+            urls=get_warmup_urls(app_config),
+            connections=app_config.UPSTREAM_WARMUP_CONNECTIONS,
+            refresh_interval=app_config.UPSTREAM_WARMUP_REFRESH_INTERVAL,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.connections > 0 and len(self.urls) > 0
+
+    async def _ping(self, url: str) -> None:
+        try:
+            # Any response will do: the goal is to establish the connection
+            response = await get_http_client().head(
+                url,
+                timeout=WARMUP_TIMEOUT,
+                extensions={WARMUP_EXTENSION: True},
+            )
+            await response.aclose()
+        except Exception as e:
+            logger.warning(f"Failed to warm up a connection to {url}: {e!r}")
+
+    async def warm_up(self) -> None:
+        """
+        Sends concurrent requests to every upstream,
+        so the connection pool opens that many connections
+        and keeps them alive afterwards.
+        """
+        await asyncio.gather(
+            *(
+                self._ping(url)
+                for url in self.urls
+                for _ in range(self.connections)
+            )
+        )
+
+    async def _refresh(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.warm_up()
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+
+        logger.info(
+            f"Warming up {self.connections} connection(s) to {self.urls}"
+        )
+        await self.warm_up()
+
+        if self.refresh_interval > 0:
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
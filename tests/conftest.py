@@ -3,7 +3,9 @@ import pytest
 from httpx import ASGITransport
 from openai import AsyncAzureOpenAI
 
-from aidial_adapter_openai.app import create_app
+from aidial_adapter_openai.app import configure_app, create_app
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.gpt4_multi_modal.transformation import message_cache
 from aidial_adapter_openai.utils.http_client import DEFAULT_TIMEOUT
 from aidial_adapter_openai.utils.request import get_app_config
 from tests.integration_tests.base import DeploymentConfig
@@ -28,6 +30,32 @@ async def test_app(_app_instance):
         yield client
 
 
+@pytest.fixture(autouse=True)
+def _clear_message_cache():
+    # The same messages are sent with different images by the tests
+    if message_cache is not None:
+        message_cache.clear()
+
+
+@pytest.fixture
+def configure_test_app(_app_instance):
+    """
+    Overrides the settings of the application for the test.
+    The state of the upstream calls is created anew for the settings.
+    """
+
+    app_config = get_app_config(_app_instance)
+
+    def _configure(**settings) -> None:
+        configure_app(
+            _app_instance,
+            ApplicationConfig(**{**app_config.dict(), **settings}),
+        )
+
+    yield _configure
+    configure_app(_app_instance, app_config)
+
+
 @pytest.fixture
 def eliminate_empty_choices(_app_instance):
     app_config = get_app_config(_app_instance)
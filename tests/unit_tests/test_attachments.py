@@ -211,3 +211,42 @@ async def test_download_attachment_image(attachment: dict, expected_result):
     )
     processor = ResourceProcessor(file_storage=MockFileStorage())
     assert await processor.try_download_resource(resource) == expected_result
+
+
+def test_base64_resource_is_decoded_on_demand():
+    resource = Resource.from_base64("image/png", pic_1_1.data_base64)
+
+    assert resource.to_data_url() == data_url(pic_1_1)
+    assert resource._data is None
+
+    assert resource == Resource(type="image/png", data=pic_1_1.data)
+    assert resource._data is not None
+
+
+@pytest.mark.parametrize("data_base64", ["abc", "ab=c", "ab c", "ab\ncd"])
+def test_invalid_base64_resource(data_base64: str):
+    with pytest.raises(ValueError, match="Invalid base64 data"):
+        Resource.from_base64("image/png", data_base64)
+
+
+async def test_attachment_image_is_sent_as_is():
+    data_base64 = Resource(type="image/png", data=pic_1_1.data).data_base64
+    processor = ResourceProcessor(file_storage=None)
+
+    result = await processor.transform_messages(
+        [
+            {
+                "role": "user",
+                "content": "",
+                "custom_content": {
+                    "attachments": [{"type": "image/png", "data": data_base64}]
+                },
+            }
+        ]
+    )
+
+    assert isinstance(result, list)
+    image = result[0].image_metadatas[0].image
+    assert image is not None and image._data is None
+    assert image.to_data_url() == "data:image/png;base64," + data_base64
+    assert result[0].raw_message["content"][1]["image_url"]["url"] is image
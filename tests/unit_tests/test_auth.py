@@ -0,0 +1,105 @@
+import asyncio
+import time
+from typing import List
+
+import pytest
+from aidial_sdk.exceptions import HTTPException as DialException
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ClientAuthenticationError
+
+from aidial_adapter_openai.utils.auth import (
+    EXPIRATION_WINDOW_IN_SEC,
+    REFRESH_WINDOW_IN_SEC,
+    AccessTokenManager,
+)
+
+
+class MockCredential:
+    def __init__(self, lifetime: int = 3600, delay: float = 0.05):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.calls: List[str] = []
+        self.fail = False
+
+    async def get_token(self, *scopes: str) -> AccessToken:
+        [scope] = scopes
+        self.calls.append(scope)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ClientAuthenticationError("failed")
+        return AccessToken(
+            f"{scope}-{len(self.calls)}", int(time.time()) + self.lifetime
+        )
+
+
+async def test_concurrent_requests_share_refresh():
+    credential = MockCredential()
+    manager = AccessTokenManager(credential)
+
+    tokens = await asyncio.gather(
+        *(manager.get_token("scope") for _ in range(10))
+    )
+
+    assert set(tokens) == {"scope-1"}
+    assert credential.calls == ["scope"]
+
+
+async def test_scopes_are_cached_separately():
+    credential = MockCredential()
+    manager = AccessTokenManager(credential)
+
+    assert await manager.get_token("openai") == "openai-1"
+    assert await manager.get_token("vision") == "vision-2"
+    assert await manager.get_token("openai") == "openai-1"
+    assert credential.calls == ["openai", "vision"]
+
+
+async def test_refresh_ahead_serves_cached_token():
+    # The token enters the refresh window, but is still valid
+    credential = MockCredential(
+        lifetime=(REFRESH_WINDOW_IN_SEC + EXPIRATION_WINDOW_IN_SEC) // 2
+    )
+    manager = AccessTokenManager(credential)
+
+    assert await manager.get_token("scope") == "scope-1"
+    assert await manager.get_token("scope") == "scope-1"
+    assert await manager.get_token("scope") == "scope-1"
+    await asyncio.sleep(0)
+    assert len(credential.calls) == 2
+
+    await asyncio.sleep(credential.delay * 2)
+    assert await manager.get_token("scope") == "scope-2"
+
+
+async def test_expired_token_is_refreshed_inline():
+    credential = MockCredential(lifetime=EXPIRATION_WINDOW_IN_SEC - 1)
+    manager = AccessTokenManager(credential)
+
+    assert await manager.get_token("scope") == "scope-1"
+    assert await manager.get_token("scope") == "scope-2"
+
+
+async def test_failed_refresh():
+    credential = MockCredential()
+    credential.fail = True
+    manager = AccessTokenManager(credential)
+
+    with pytest.raises(DialException) as exc_info:
+        await manager.get_token("scope")
+    assert exc_info.value.status_code == 401
+
+    # The failed refresh isn't cached
+    credential.fail = False
+    assert await manager.get_token("scope") == "scope-2"
+
+
+async def test_cancelled_request_does_not_cancel_refresh():
+    credential = MockCredential()
+    manager = AccessTokenManager(credential)
+
+    request = asyncio.create_task(manager.get_token("scope"))
+    await asyncio.sleep(0)
+    request.cancel()
+
+    assert await manager.get_token("scope") == "scope-1"
+    assert credential.calls == ["scope"]
@@ -0,0 +1,159 @@
+import time
+
+import httpx
+import pytest
+import respx
+from aidial_sdk.exceptions import HTTPException as DialException
+from fastapi import FastAPI
+
+from aidial_adapter_openai.app import configure_app
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakers,
+    CircuitState,
+    get_circuit_breakers,
+)
+from aidial_adapter_openai.utils.outcome import Outcome
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
+
+
+def create_breaker() -> CircuitBreaker:
+    return CircuitBreaker(
+        "east/gpt-4",
+        failure_threshold=2,
+        recovery_time=30,
+        half_open_requests=1,
+    )
+
+
+def test_opens_after_consecutive_failures():
+    breaker = create_breaker()
+
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+    breaker.acquire()(Outcome.SUCCESS, 0.1)
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+    breaker.acquire()(Outcome.IGNORE, 0.1)
+    assert breaker.state == CircuitState.CLOSED
+
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+    assert breaker.state == CircuitState.OPEN
+
+    with pytest.raises(DialException) as exc_info:
+        breaker.acquire()
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "30"}
+
+
+def test_throttling_is_not_a_failure():
+    breaker = create_breaker()
+
+    for _ in range(3):
+        breaker.acquire()(Outcome.THROTTLED, 0.1)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_half_open_probe_closes_circuit():
+    breaker = create_breaker()
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+
+    breaker.opened_at = time.monotonic() - 30
+    assert breaker.state == CircuitState.HALF_OPEN
+
+    on_done = breaker.acquire()
+    # Only one probe at a time
+    with pytest.raises(DialException):
+        breaker.acquire()
+
+    on_done(Outcome.SUCCESS, 0.1)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_failed_probe_reopens_circuit():
+    breaker = create_breaker()
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+
+    breaker.opened_at = time.monotonic() - 30
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+    assert breaker.state == CircuitState.OPEN
+
+
+def test_applications_have_own_breakers():
+    apps = [FastAPI(), FastAPI()]
+    for app in apps:
+        configure_app(
+            app, ApplicationConfig(CIRCUIT_BREAKER_FAILURE_THRESHOLD=1)
+        )
+
+    url = "http://east/openai/deployments/gpt-4/chat/completions"
+    breaker = get_circuit_breakers(apps[0]).get(url)
+    assert breaker is not None
+    breaker.acquire()(Outcome.OVERLOAD, 0.1)
+
+    assert get_circuit_breakers(apps[0]).is_open(url)
+    assert not get_circuit_breakers(apps[1]).is_open(url)
+
+
+async def test_adapter_errors_are_not_failures():
+    breakers = CircuitBreakers(
+        failure_threshold=2, recovery_time=30, half_open_requests=1
+    )
+    url = "http://east/openai/deployments/gpt-4/chat/completions"
+
+    async def upstream_request():
+        raise DialException(status_code=500, message="Internal error")
+
+    async def handle(local_error: int | None):
+        if local_error is not None:
+            # E.g. the deadline has expired or the rate limit budget is short
+            raise DialException(status_code=local_error, message="Error")
+        return await call_upstream_request(upstream_request)
+
+    for status_code in [504, 429, 504]:
+        with pytest.raises(DialException):
+            await breakers.call(url, lambda: handle(status_code))
+    assert not breakers.is_open(url)
+
+    for _ in range(2):
+        with pytest.raises(DialException):
+            await breakers.call(url, lambda: handle(None))
+    assert breakers.is_open(url)
+
+
+@pytest.fixture
+def circuit_breakers(configure_test_app):
+    configure_test_app(CIRCUIT_BREAKER_FAILURE_THRESHOLD=2)
+
+
+@respx.mock
+async def test_open_circuit_fails_fast(
+    test_app: httpx.AsyncClient, circuit_breakers
+):
+    upstream = respx.post(url__startswith="http://east/").respond(
+        status_code=500, json={"error": {"message": "Internal error"}}
+    )
+
+    statuses = [
+        (
+            await test_app.post(
+                "/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview",
+                json={"messages": [{"role": "user", "content": "Hello"}]},
+                headers={
+                    "X-UPSTREAM-KEY": "TEST_API_KEY",
+                    "X-UPSTREAM-ENDPOINT": "http://east/openai/deployments/gpt-4/chat/completions",
+                },
+            )
+        ).status_code
+        for _ in range(4)
+    ]
+
+    assert statuses == [500, 500, 503, 503]
+    assert upstream.call_count == 2
+
+    health = await test_app.get("/health")
+    assert health.json() == {
+        "status": "ok",
+        "circuit_breakers": {"east/gpt-4": "open"},
+    }
@@ -0,0 +1,65 @@
+import pytest
+
+from aidial_adapter_openai.utils.client_cache import (
+    _clients,
+    clear_client_cache,
+)
+from aidial_adapter_openai.utils.parsers import (
+    AzureOpenAIEndpoint,
+    OpenAIEndpoint,
+)
+
+azure_endpoint = AzureOpenAIEndpoint(
+    azure_endpoint="https://test.com", azure_deployment="gpt-4"
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    clear_client_cache()
+    yield
+    clear_client_cache()
+
+
+def test_client_is_reused():
+    params = {"api_key": "key", "api_version": "2024-02-01"}
+    client1 = azure_endpoint.get_client(params)
+    client2 = azure_endpoint.get_client(params)
+    assert client1 is client2
+
+
+def test_client_per_api_key_and_version():
+    client1 = azure_endpoint.get_client(
+        {"api_key": "key1", "api_version": "2024-02-01"}
+    )
+    client2 = azure_endpoint.get_client(
+        {"api_key": "key2", "api_version": "2024-02-01"}
+    )
+    client3 = azure_endpoint.get_client(
+        {"api_key": "key1", "api_version": "2024-06-01"}
+    )
+    assert len({id(client1), id(client2), id(client3)}) == 3
+    assert client2.api_key == "key2"
+    assert len(_clients) == 3
+
+
+def test_client_per_azure_ad_token():
+    params = {"api_version": "2024-02-01"}
+    client1 = azure_endpoint.get_client({"azure_ad_token": "token1", **params})
+    client2 = azure_endpoint.get_client({"azure_ad_token": "token2", **params})
+
+    # Concurrent requests with different tokens don't evict each other
+    assert client1 is not client2
+    assert client2._azure_ad_token == "token2"
+    assert (
+        azure_endpoint.get_client({"azure_ad_token": "token1", **params})
+        is client1
+    )
+    assert len(_clients) == 2
+
+
+def test_openai_client_is_reused():
+    endpoint = OpenAIEndpoint(base_url="https://test.com/v1")
+    assert endpoint.get_client({"api_key": "key"}) is endpoint.get_client(
+        {"api_key": "key"}
+    )
@@ -0,0 +1,180 @@
+import asyncio
+
+import pytest
+from aidial_sdk.exceptions import HTTPException as DialException
+
+from aidial_adapter_openai.app_config import ConcurrencyLimitConfig
+from aidial_adapter_openai.utils.concurrency_limiter import (
+    AdaptiveConcurrencyLimiter,
+    call_with_limiter,
+)
+from aidial_adapter_openai.utils.outcome import Outcome
+from aidial_adapter_openai.utils.upstream_request import call_upstream_request
+
+
+def create_limiter(**kwargs) -> AdaptiveConcurrencyLimiter:
+    return AdaptiveConcurrencyLimiter("test", ConcurrencyLimitConfig(**kwargs))
+
+
+async def test_excess_requests_wait_in_queue():
+    limiter = create_limiter(initial_limit=2)
+
+    permits = [await limiter.acquire(), await limiter.acquire()]
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+
+    assert limiter.in_flight == 2
+    assert limiter.queue_depth == 1
+
+    limiter.release(permits[0], Outcome.IGNORE)
+    permit = await waiter
+
+    assert limiter.in_flight == 2
+    assert limiter.queue_depth == 0
+
+    limiter.release(permits[1], Outcome.IGNORE)
+    limiter.release(permit, Outcome.IGNORE)
+    assert limiter.in_flight == 0
+
+
+async def test_queue_timeout():
+    limiter = create_limiter(initial_limit=1, queue_timeout=0.05)
+    await limiter.acquire()
+
+    with pytest.raises(DialException) as exc_info:
+        await limiter.acquire()
+
+    assert exc_info.value.status_code == 429
+    assert limiter.queue_depth == 0
+
+
+async def test_queue_overflow():
+    limiter = create_limiter(initial_limit=1, max_queue_size=1)
+    await limiter.acquire()
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+
+    with pytest.raises(DialException) as exc_info:
+        await limiter.acquire()
+
+    assert exc_info.value.status_code == 429
+    waiter.cancel()
+
+
+async def test_cancelled_waiter_leaves_queue():
+    limiter = create_limiter(initial_limit=1)
+    permit = await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    await asyncio.sleep(0.01)
+
+    assert limiter.queue_depth == 0
+    limiter.release(permit, Outcome.IGNORE)
+    assert limiter.in_flight == 0
+
+
+async def test_burst_of_overloads_cuts_limit_once():
+    limiter = create_limiter(initial_limit=10, backoff_ratio=0.5)
+    permits = [await limiter.acquire() for _ in range(5)]
+
+    for permit in permits:
+        limiter.release(permit, Outcome.OVERLOAD)
+
+    assert limiter.limit == 5
+
+    limiter.release(await limiter.acquire(), Outcome.OVERLOAD)
+    assert limiter.limit == 2.5
+
+
+async def test_limit_grows_under_load():
+    limiter = create_limiter(initial_limit=4, max_limit=5)
+
+    for _ in range(20):
+        permits = [await limiter.acquire() for _ in range(int(limiter.limit))]
+        for permit in permits:
+            limiter.release(permit, Outcome.SUCCESS)
+
+    assert limiter.limit == 5
+
+
+async def test_limit_doesnt_grow_when_idle():
+    limiter = create_limiter(initial_limit=4)
+
+    for _ in range(20):
+        limiter.release(await limiter.acquire(), Outcome.SUCCESS)
+
+    assert limiter.limit == 4
+
+
+async def test_rising_latency_cuts_limit():
+    limiter = create_limiter(initial_limit=10, latency_tolerance=2.0)
+
+    for latency in [0.1] * 5 + [1.0]:
+        permit = await limiter.acquire()
+        permit.latency = latency
+        limiter.release(permit, Outcome.SUCCESS)
+
+    assert limiter.limit < 10
+
+
+async def test_stream_holds_permit_until_closed():
+    limiter = create_limiter(initial_limit=1)
+
+    async def stream():
+        yield 1
+        yield 2
+
+    async def call():
+        return stream()
+
+    response = await call_with_limiter(
+        limiter, lambda: call_upstream_request(call)
+    )
+    assert limiter.in_flight == 1
+
+    assert [chunk async for chunk in response] == [1, 2]
+    assert limiter.in_flight == 0
+
+
+async def test_upstream_error_releases_permit():
+    limiter = create_limiter(initial_limit=4)
+
+    async def call():
+        raise DialException(status_code=429, message="Rate limit")
+
+    with pytest.raises(DialException):
+        await call_with_limiter(limiter, lambda: call_upstream_request(call))
+
+    assert limiter.in_flight == 0
+    assert limiter.limit == 2
+
+
+async def test_only_upstream_request_is_limited():
+    limiter = create_limiter(initial_limit=4)
+    permits = []
+
+    async def call():
+        permits.append(limiter.in_flight)
+        return "response"
+
+    async def handle(fail: bool):
+        # The images are downloaded and the prompt is tokenized
+        await asyncio.sleep(0.05)
+        assert limiter.in_flight == 0
+        if fail:
+            raise DialException(status_code=504, message="Deadline exceeded")
+        return await call_upstream_request(call)
+
+    with pytest.raises(DialException):
+        await call_with_limiter(limiter, lambda: handle(fail=True))
+    assert await call_with_limiter(limiter, lambda: handle(fail=False)) == (
+        "response"
+    )
+
+    assert permits == [1]
+    assert limiter.in_flight == 0
+    assert limiter.limit == 4
+    assert limiter._long_latency is not None
+    assert limiter._long_latency < 0.05
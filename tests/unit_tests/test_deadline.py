@@ -0,0 +1,163 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterable
+
+import httpx
+import pytest
+import respx
+from aiohttp import web
+
+from aidial_adapter_openai.dial_api.storage import (
+    close_storage_session,
+    download_file,
+)
+from aidial_adapter_openai.utils.deadline import Deadline, _deadline
+
+UPSTREAM_ENDPOINT = (
+    "http://localhost:5001/openai/deployments/gpt-4/chat/completions"
+)
+
+RESPONSE = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "Hi"},
+        }
+    ],
+}
+
+
+def test_timeouts_are_derived_from_remaining_time():
+    deadline = Deadline.after(30)
+    timeout = deadline.get_timeout()
+    assert 29 < timeout.read <= 30
+    assert timeout.connect == 10
+
+    deadline = Deadline.after(2)
+    assert deadline.get_timeout().connect <= 2
+    assert deadline.get_aiohttp_timeout().total <= 2
+
+
+def test_deadline_from_timestamp():
+    assert Deadline.at(time.time() - 1).expired
+    assert Deadline.at(time.time() - 1).remaining() == 0
+    assert not Deadline.at(time.time() + 10).expired
+
+
+async def post(test_app: httpx.AsyncClient, headers: dict = {}):
+    return await test_app.post(
+        "/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview",
+        json={"messages": [{"role": "user", "content": "Hello"}]},
+        headers={
+            "X-UPSTREAM-KEY": "TEST_API_KEY",
+            "X-UPSTREAM-ENDPOINT": UPSTREAM_ENDPOINT,
+            **headers,
+        },
+    )
+
+
+@respx.mock
+async def test_expired_request_is_not_sent(test_app: httpx.AsyncClient):
+    route = respx.post(url__startswith=UPSTREAM_ENDPOINT).respond(json=RESPONSE)
+
+    response = await post(
+        test_app, {"X-REQUEST-DEADLINE": str(time.time() - 1)}
+    )
+
+    assert response.status_code == 504
+    assert response.json()["error"]["type"] == "timeout"
+    assert not route.called
+
+
+@respx.mock
+async def test_deadline_caps_upstream_timeouts(test_app: httpx.AsyncClient):
+    route = respx.post(url__startswith=UPSTREAM_ENDPOINT).respond(json=RESPONSE)
+
+    response = await post(
+        test_app, {"X-REQUEST-DEADLINE": str(time.time() + 5)}
+    )
+
+    assert response.status_code == 200
+    timeout = route.calls.last.request.extensions["timeout"]
+    assert 0 < timeout["read"] <= 5
+    assert 0 < timeout["connect"] <= 5
+
+
+@respx.mock
+async def test_no_deadline(test_app: httpx.AsyncClient):
+    route = respx.post(url__startswith=UPSTREAM_ENDPOINT).respond(json=RESPONSE)
+
+    response = await post(test_app, {"X-REQUEST-DEADLINE": "invalid"})
+
+    assert response.status_code == 200
+    timeout = route.calls.last.request.extensions["timeout"]
+    assert timeout["read"] is None or timeout["read"] > 5
+
+
+@respx.mock
+async def test_deadline_stops_streaming_response(test_app: httpx.AsyncClient):
+    async def stream_chunks() -> AsyncIterable[bytes]:
+        for idx in range(20):
+            chunk = {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "gpt-4",
+                "choices": [{"index": 0, "delta": {"content": str(idx)}}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+            await asyncio.sleep(0.1)
+        yield b"data: [DONE]\n\n"
+
+    respx.post(url__startswith=UPSTREAM_ENDPOINT).respond(
+        content_type="text/event-stream", content=stream_chunks()
+    )
+
+    started_at = time.monotonic()
+    response = await test_app.post(
+        "/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview",
+        json={
+            "stream": True,
+            "messages": [{"role": "user", "content": "Hello"}],
+        },
+        headers={
+            "X-UPSTREAM-KEY": "TEST_API_KEY",
+            "X-UPSTREAM-ENDPOINT": UPSTREAM_ENDPOINT,
+            "X-REQUEST-DEADLINE": str(time.time() + 0.5),
+        },
+    )
+
+    assert time.monotonic() - started_at < 1.5
+    assert response.status_code == 200
+    assert '"error"' in response.text
+    assert response.text.endswith("data: [DONE]\n\n")
+
+
+async def test_deadline_caps_file_downloads():
+    async def get_file(request: web.Request) -> web.Response:
+        await asyncio.sleep(2)
+        return web.Response(body=b"data")
+
+    app = web.Application()
+    app.router.add_get("/file", get_file)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    _deadline.set(Deadline.after(0.2))
+    started_at = time.monotonic()
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await download_file(f"http://127.0.0.1:{port}/file")
+        assert time.monotonic() - started_at < 1
+    finally:
+        await close_storage_session()
+        await runner.cleanup()
@@ -0,0 +1,181 @@
+import asyncio
+from typing import AsyncIterator, Tuple
+
+import pytest
+from aiohttp import web
+
+import aidial_adapter_openai.dial_api.storage as storage
+from aidial_adapter_openai.dial_api.download_cache import (
+    CachedDownload,
+    DiskCache,
+    DownloadCache,
+    MemoryCache,
+)
+from aidial_adapter_openai.dial_api.storage import (
+    close_storage_session,
+    download_resource,
+    get_cached_resource,
+)
+from aidial_adapter_openai.utils.image import ImageMetadata
+from aidial_adapter_openai.utils.resource import Resource
+from tests.utils.images import pic_2_2
+
+
+def create_entry(data: bytes, etag: str = '"1"') -> CachedDownload:
+    return CachedDownload(Resource(type="image/png", data=data), etag)
+
+
+def test_memory_cache_is_bounded_by_size():
+    cache = MemoryCache(max_size=10)
+    cache.put("a", create_entry(b"1234"))
+    cache.put("b", create_entry(b"1234"))
+    cache.get("a")
+    cache.put("c", create_entry(b"1234"))
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.size == 8
+
+    cache.put("d", create_entry(b"12345678901"))
+    assert cache.get("d") is None
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=10)
+    cache.put("a", create_entry(b"1234", '"a"'))
+    cache.put("b", create_entry(b"1234", '"b"'))
+
+    # The files are picked up after a restart
+    cache = DiskCache(str(tmp_path), max_size=10)
+    entry = cache.get("a")
+    assert entry is not None
+    assert entry.resource == Resource(type="image/png", data=b"1234")
+    assert entry.etag == '"a"'
+
+    cache.put("c", create_entry(b"1234"))
+    assert cache.get("b") is None
+    assert len(list(tmp_path.iterdir())) == 4
+
+
+class FileServerStub:
+    content: bytes
+    etag: str
+    downloads: int
+    revalidations: int
+
+    def __init__(self):
+        self.content = pic_2_2.data
+        self.etag = '"v1"'
+        self.downloads = 0
+        self.revalidations = 0
+
+    async def get_file(self, request: web.Request) -> web.Response:
+        if request.headers.get("api-key") == "forbidden":
+            return web.Response(status=403)
+        if request.headers.get("If-None-Match") == self.etag:
+            self.revalidations += 1
+            return web.Response(status=304)
+        self.downloads += 1
+        return web.Response(body=self.content, headers={"ETag": self.etag})
+
+
+@pytest.fixture
+async def file_server(
+    tmp_path, monkeypatch
+) -> AsyncIterator[Tuple[FileServerStub, str]]:
+    monkeypatch.setattr(
+        storage,
+        "download_cache",
+        DownloadCache(MemoryCache(1024 * 1024), DiskCache(str(tmp_path), 1024)),
+    )
+
+    stub = FileServerStub()
+    app = web.Application()
+    app.router.add_get("/image.png", stub.get_file)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    yield stub, f"http://127.0.0.1:{port}/image.png"
+
+    await close_storage_session()
+    await runner.cleanup()
+
+
+async def test_cached_file_is_revalidated(file_server):
+    stub, url = file_server
+
+    first = await download_resource(url, "image/png")
+    metadata = ImageMetadata.from_resource(first, "auto")
+    second = await download_resource(url, "image/png")
+
+    assert (stub.downloads, stub.revalidations) == (1, 1)
+    # The resource and the image size derived from it are reused
+    assert second is first
+    assert second._image_size == (metadata.width, metadata.height)
+
+
+async def test_modified_file_is_downloaded_again(file_server):
+    stub, url = file_server
+
+    await download_resource(url, "image/png")
+    stub.content, stub.etag = b"new content", '"v2"'
+
+    resource = await download_resource(url, "image/png")
+    assert resource.data == b"new content"
+    assert stub.downloads == 2
+
+
+async def test_concurrent_downloads_share_transfer(file_server):
+    stub, url = file_server
+
+    resources = await asyncio.gather(
+        *(download_resource(url, "image/png") for _ in range(5))
+    )
+
+    assert stub.downloads == 1
+    assert all(resource is resources[0] for resource in resources)
+
+
+async def test_concurrent_downloads_are_not_shared_by_callers(file_server):
+    stub, url = file_server
+
+    allowed, forbidden = await asyncio.gather(
+        download_resource(url, "image/png", {"api-key": "key-1"}),
+        download_resource(url, "image/png", {"api-key": "forbidden"}),
+        return_exceptions=True,
+    )
+
+    assert isinstance(allowed, Resource)
+    assert isinstance(forbidden, Exception)
+
+
+async def test_cached_file_is_shared_by_callers(file_server):
+    stub, url = file_server
+
+    first = await download_resource(url, "image/png", {"api-key": "key-1"})
+    second = await download_resource(url, "image/png", {"api-key": "key-2"})
+
+    assert (stub.downloads, stub.revalidations) == (1, 1)
+    assert second is first
+
+    # The access is checked by the revalidation with the caller's credentials
+    with pytest.raises(Exception):
+        await download_resource(url, "image/png", {"api-key": "forbidden"})
+
+
+async def test_cached_file_is_revalidated_for_caller(file_server):
+    stub, url = file_server
+
+    assert await get_cached_resource(url, "image/png") is None
+    first = await download_resource(url, "image/png", {"api-key": "key-1"})
+
+    cached = await get_cached_resource(url, "image/png", {"api-key": "key-2"})
+    assert cached is first
+    assert stub.revalidations == 1
+
+    with pytest.raises(Exception):
+        await get_cached_resource(url, "image/png", {"api-key": "forbidden"})
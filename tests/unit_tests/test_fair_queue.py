@@ -0,0 +1,149 @@
+import asyncio
+from typing import Dict, List
+
+from fastapi import Request
+
+from aidial_adapter_openai.app_config import (
+    ApplicationConfig,
+    ConcurrencyLimitConfig,
+)
+from aidial_adapter_openai.utils.concurrency_limiter import (
+    AdaptiveConcurrencyLimiter,
+)
+from aidial_adapter_openai.utils.fair_queue import (
+    DEFAULT_TENANT,
+    OTHER_TENANT,
+    FairQueue,
+    Priority,
+    QueueTicket,
+    get_queue_ticket,
+)
+from aidial_adapter_openai.utils.outcome import Outcome
+
+
+def drain(queue: FairQueue[str]) -> List[str]:
+    return [queue.pop() for _ in range(len(queue))]
+
+
+def test_tenants_are_interleaved():
+    queue: FairQueue[str] = FairQueue()
+    for idx in range(4):
+        queue.push(f"a{idx}", QueueTicket(tenant="a"))
+    for idx in range(2):
+        queue.push(f"b{idx}", QueueTicket(tenant="b"))
+
+    assert drain(queue) == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_tenants_are_served_by_weight():
+    queue: FairQueue[str] = FairQueue()
+    for idx in range(4):
+        queue.push(f"a{idx}", QueueTicket(tenant="a", weight=2))
+        queue.push(f"b{idx}", QueueTicket(tenant="b", weight=1))
+
+    first = drain(queue)[:6]
+    assert sum(item.startswith("a") for item in first) == 4
+
+
+def test_priority_lanes():
+    queue: FairQueue[str] = FairQueue()
+    queue.push("bulk", QueueTicket(priority=Priority.LOW))
+    queue.push("normal", QueueTicket(tenant="b"))
+    queue.push("interactive", QueueTicket(priority=Priority.HIGH))
+
+    assert drain(queue) == ["interactive", "normal", "bulk"]
+
+
+def test_remove():
+    queue: FairQueue[str] = FairQueue()
+    for item in ["a", "b", "c"]:
+        queue.push(item, QueueTicket(tenant=item))
+    queue.remove("b")
+
+    assert drain(queue) == ["a", "c"]
+
+
+def create_request(headers: Dict[str, str]) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+    )
+
+
+def test_queue_ticket():
+    app_config = ApplicationConfig(
+        TENANT_HEADER="X-PROJECT", TENANT_WEIGHTS={"batch": 0.5}
+    )
+
+    ticket = get_queue_ticket(
+        create_request({"X-PROJECT": "batch", "X-REQUEST-PRIORITY": "low"}),
+        app_config,
+        Priority.HIGH,
+    )
+    assert ticket == QueueTicket("batch", 0.5, Priority.LOW, "batch")
+
+    ticket = get_queue_ticket(
+        create_request({"X-PROJECT": "adhoc"}), app_config, Priority.HIGH
+    )
+    assert ticket == QueueTicket("adhoc", 1.0, Priority.HIGH, OTHER_TENANT)
+
+    ticket = get_queue_ticket(create_request({}), app_config, Priority.HIGH)
+    assert ticket == QueueTicket(DEFAULT_TENANT, 1.0, Priority.HIGH)
+
+
+def test_priority_is_capped_per_tenant():
+    app_config = ApplicationConfig(
+        TENANT_HEADER="X-PROJECT",
+        TENANT_MAX_PRIORITIES={"chat": "high", "batch": "low"},
+    )
+
+    def get_priority(headers: Dict[str, str]) -> Priority:
+        request = create_request({"X-REQUEST-PRIORITY": "high", **headers})
+        return get_queue_ticket(request, app_config, Priority.NORMAL).priority
+
+    assert get_priority({"X-PROJECT": "adhoc"}) == Priority.NORMAL
+    assert get_priority({}) == Priority.NORMAL
+    assert get_priority({"X-PROJECT": "chat"}) == Priority.HIGH
+    assert get_priority({"X-PROJECT": "batch"}) == Priority.LOW
+    assert get_priority({"X-REQUEST-PRIORITY": "low"}) == Priority.LOW
+
+
+def test_credentials_are_not_used_as_tenant():
+    ticket = get_queue_ticket(
+        create_request({"api-key": "secret"}),
+        ApplicationConfig(),
+        Priority.NORMAL,
+    )
+    assert ticket == QueueTicket(DEFAULT_TENANT, 1.0, Priority.NORMAL)
+
+
+async def test_limiter_serves_tenants_fairly():
+    limiter = AdaptiveConcurrencyLimiter(
+        "test", ConcurrencyLimitConfig(initial_limit=1)
+    )
+    permit = await limiter.acquire()
+
+    served: List[str] = []
+
+    async def request(name: str, ticket: QueueTicket):
+        permit = await limiter.acquire(ticket)
+        served.append(name)
+        limiter.release(permit, Outcome.IGNORE)
+
+    tasks = [
+        asyncio.create_task(request(f"flood{idx}", QueueTicket("flood")))
+        for idx in range(5)
+    ]
+    await asyncio.sleep(0.01)
+    tasks.append(asyncio.create_task(request("user", QueueTicket("user"))))
+    await asyncio.sleep(0.01)
+
+    limiter.release(permit, Outcome.IGNORE)
+    await asyncio.gather(*tasks)
+
+    assert served.index("user") <= 1
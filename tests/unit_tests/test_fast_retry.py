@@ -0,0 +1,91 @@
+import httpx
+import pytest
+import respx
+
+from aidial_adapter_openai.utils.fast_retry import FastRetryPolicy
+from aidial_adapter_openai.utils.http_client import (
+    DEFAULT_CONNECTION_LIMITS,
+    UpstreamTransport,
+)
+
+
+def create_request(**kwargs) -> httpx.Request:
+    return httpx.Request("POST", "http://east/chat/completions", **kwargs)
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (httpx.ConnectError("Connection refused"), True),
+        (httpx.ConnectTimeout("Timeout"), True),
+        (
+            httpx.RemoteProtocolError(
+                "Server disconnected without sending a response."
+            ),
+            True,
+        ),
+        (httpx.RemoteProtocolError("Peer closed connection"), False),
+        (httpx.ReadTimeout("Timeout"), False),
+        (ValueError("Error"), False),
+    ],
+)
+def test_retryable_errors(error: Exception, expected: bool):
+    policy = FastRetryPolicy(max_retries=2, budget_ratio=0.1)
+    request = create_request(json={"messages": []})
+    assert policy.should_retry(request, error, 0) is expected
+
+
+def test_streamed_body_is_not_retried():
+    async def body():
+        yield b"{}"
+
+    policy = FastRetryPolicy(max_retries=2, budget_ratio=0.1)
+    request = create_request(content=body())
+    assert not policy.should_retry(request, httpx.ConnectError(""), 0)
+
+
+def test_retries_are_capped():
+    policy = FastRetryPolicy(max_retries=2, budget_ratio=0.1)
+    request = create_request(json={})
+    error = httpx.ConnectError("Connection refused")
+
+    assert not policy.should_retry(request, error, 2)
+
+    retries = 0
+    while policy.should_retry(request, error, 0):
+        retries += 1
+    assert retries == 10
+
+    for _ in range(15):
+        policy.on_request()
+    assert policy.should_retry(request, error, 0)
+    assert not policy.should_retry(request, error, 0)
+
+
+def test_backoff_is_sub_second():
+    for attempt in range(10):
+        assert 0 <= FastRetryPolicy.get_backoff(attempt) <= 0.5
+
+
+@respx.mock
+async def test_connection_error_is_retried():
+    route = respx.post("http://east/chat/completions").mock(
+        side_effect=[
+            httpx.ConnectError("Connection refused"),
+            httpx.Response(200, json={"result": "ok"}),
+        ]
+    )
+    transport = UpstreamTransport(
+        "test",
+        limits=DEFAULT_CONNECTION_LIMITS,
+        retry_policy=FastRetryPolicy(max_retries=2, budget_ratio=0.1),
+    )
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await client.post(
+            "http://east/chat/completions", json={"messages": []}
+        )
+
+    assert response.json() == {"result": "ok"}
+    assert route.call_count == 2
+    assert transport.active_streams == 0
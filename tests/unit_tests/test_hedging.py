@@ -0,0 +1,171 @@
+import asyncio
+from typing import List
+
+import pytest
+from fastapi.responses import JSONResponse
+
+from aidial_adapter_openai.app_config import HedgingConfig
+from aidial_adapter_openai.utils.hedging import HedgingPolicy
+
+
+def create_policy(**kwargs) -> HedgingPolicy:
+    policy = HedgingPolicy(
+        "test",
+        HedgingConfig(
+            **{"min_delay": 0.05, "min_samples": 20, "max_hedge_ratio": 1.0}
+            | kwargs
+        ),
+    )
+    for _ in range(20):
+        policy.record_latency(0.01)
+    return policy
+
+
+def respond(value, delay: float, calls: List[str]):
+    async def _call():
+        calls.append(value)
+        await asyncio.sleep(delay)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    return _call
+
+
+async def test_no_hedging_until_latencies_are_known():
+    policy = HedgingPolicy("test", HedgingConfig(max_hedge_ratio=1.0))
+    calls = []
+
+    result = await policy.run(
+        respond("primary", 0.1, calls), respond("hedge", 0, calls)
+    )
+    assert result == "primary"
+    assert calls == ["primary"]
+
+
+async def test_fast_response_is_not_hedged():
+    policy = create_policy()
+    calls = []
+
+    result = await policy.run(
+        respond("primary", 0, calls), respond("hedge", 0, calls)
+    )
+    assert result == "primary"
+    assert calls == ["primary"]
+
+
+async def test_slow_response_is_hedged():
+    policy = create_policy()
+    calls = []
+
+    result = await policy.run(
+        respond("primary", 1, calls), respond("hedge", 0, calls)
+    )
+    assert result == "hedge"
+    assert calls == ["primary", "hedge"]
+
+
+async def test_hedge_rate_is_capped():
+    policy = create_policy(max_hedge_ratio=0.5)
+    calls = []
+
+    for _ in range(4):
+        await policy.run(
+            respond("primary", 0.1, calls), respond("hedge", 0, calls)
+        )
+
+    assert calls.count("hedge") == 2
+
+
+async def test_cancelled_primary_latency_is_recorded():
+    policy = create_policy()
+    winners: List[str] = []
+    policy._count = winners.append
+
+    await policy.run(respond("primary", 1, []), respond("hedge", 0, []))
+
+    assert winners == ["hedge"]
+    assert len(policy._latencies) == 21
+    assert policy._latencies[-1] >= 0.05
+
+
+async def test_failed_hedge_falls_back_to_primary():
+    policy = create_policy()
+    calls = []
+
+    result = await policy.run(
+        respond("primary", 0.2, calls),
+        respond(JSONResponse({}, status_code=429), 0, calls),
+    )
+    assert result == "primary"
+
+
+async def test_both_failed():
+    policy = create_policy()
+    calls = []
+
+    winners: List[str] = []
+    policy._count = winners.append
+
+    with pytest.raises(ValueError, match="primary"):
+        await policy.run(
+            respond(ValueError("primary"), 0.1, calls),
+            respond(ValueError("hedge"), 0, calls),
+        )
+
+    assert winners == ["none"]
+    assert len(policy._latencies) == 20
+
+
+async def test_losing_stream_is_closed():
+    policy = create_policy()
+    closed = []
+
+    class Stream:
+        def __init__(self, name: str) -> None:
+            self.name = name
+
+        async def aclose(self) -> None:
+            closed.append(self.name)
+
+    ready = asyncio.Event()
+
+    async def primary():
+        await ready.wait()
+        return Stream("primary")
+
+    async def hedge():
+        ready.set()
+        await asyncio.sleep(0)
+        return Stream("hedge")
+
+    # Both responses arrive at once, the original one is preferred
+    result = await policy.run(primary, hedge)
+
+    assert result.name == "primary"
+    assert closed == ["hedge"]
+
+
+async def test_stalled_stream_is_hedged():
+    policy = create_policy()
+    closed = []
+
+    async def stream(name: str, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            yield f"{name}-1"
+            yield f"{name}-2"
+        finally:
+            closed.append(name)
+
+    async def primary():
+        # The headers arrive at once, but the content stalls
+        return stream("primary", 1)
+
+    async def hedge():
+        return stream("hedge", 0)
+
+    result = await policy.run(primary, hedge)
+
+    assert [chunk async for chunk in result] == ["hedge-1", "hedge-2"]
+    assert closed == ["primary", "hedge"]
@@ -0,0 +1,174 @@
+import asyncio
+from typing import List
+
+import httpx
+import pytest
+
+import aidial_adapter_openai.utils.http_client as http_client
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.http_client import (
+    configure_http_client,
+    get_http_client,
+    get_upstream_pools,
+)
+from tests.utils.servers import H2Server, H11Server
+
+CONCURRENT_REQUESTS = 20
+
+
+@pytest.fixture
+def configure():
+    saved_config = http_client._app_config
+
+    def _configure(**kwargs):
+        configure_http_client(ApplicationConfig(**kwargs))
+        return get_http_client()
+
+    yield _configure
+
+    configure_http_client(saved_config)
+
+
+class HistogramStub:
+    values: List[float]
+
+    def __init__(self):
+        self.values = []
+
+    def record(self, value: float, attributes: dict) -> None:
+        self.values.append(value)
+
+
+@pytest.fixture
+def streams_per_connection(monkeypatch) -> HistogramStub:
+    histogram = HistogramStub()
+    monkeypatch.setattr(http_client, "_streams_per_connection", histogram)
+    return histogram
+
+
+async def _send_concurrently(url: str):
+    client = get_http_client()
+    responses = await asyncio.gather(
+        *(client.post(url, json={}) for _ in range(CONCURRENT_REQUESTS))
+    )
+    assert all(r.status_code == 200 for r in responses)
+    return responses
+
+
+async def test_http2_multiplexes_streams_over_single_connection(
+    configure, streams_per_connection
+):
+    async with H2Server() as server:
+        client = configure(HTTP2_UPSTREAM_HOSTS=[server.url])
+        pool = next(p for p in get_upstream_pools() if p.http2)
+
+        await _send_concurrently(f"{server.url}/chat/completions")
+        assert pool.open_connections == 1
+
+        streams_per_connection.values.clear()
+        responses = await _send_concurrently(f"{server.url}/chat/completions")
+        assert max(streams_per_connection.values) > 1
+
+        await client.aclose()
+
+    assert {r.http_version for r in responses} == {"HTTP/2"}
+    assert server.connections == 1
+
+    assert pool.connections_opened == 1
+    assert pool.open_connections == 0
+    assert pool.active_streams == 0
+
+
+async def test_http11_opens_connection_per_concurrent_stream(
+    configure, streams_per_connection
+):
+    async with H11Server() as server:
+        client = configure()
+        [pool] = get_upstream_pools()
+
+        await _send_concurrently(f"{server.url}/chat/completions")
+        assert pool.open_connections == CONCURRENT_REQUESTS
+
+        streams_per_connection.values.clear()
+        responses = await _send_concurrently(f"{server.url}/chat/completions")
+        assert max(streams_per_connection.values) <= 1
+
+        await client.aclose()
+
+    assert {r.http_version for r in responses} == {"HTTP/1.1"}
+    assert server.connections == CONCURRENT_REQUESTS
+
+    assert pool.connections_opened == CONCURRENT_REQUESTS
+    assert pool.open_connections == 0
+    assert pool.active_streams == 0
+
+
+def test_http2_prior_knowledge_for_cleartext_hosts():
+    assert not http_client._HostPattern(
+        "my.openai.azure.com"
+    ).http2_prior_knowledge
+    assert http_client._HostPattern(
+        "http://localhost:8080"
+    ).http2_prior_knowledge
+
+
+def test_pool_routing(configure):
+    configure(
+        UPSTREAM_CONNECTION_POOLS={
+            "gpt-4-pool": {"deployments": ["gpt-4"]},
+            "azure-pool": {"hosts": ["*.openai.azure.com"]},
+            "local-pool": {"hosts": ["http://localhost:8080"]},
+        }
+    )
+    router = http_client._router
+    assert router is not None
+
+    def pool_name(url: str) -> str:
+        return router.get_pool(httpx.URL(url)).name
+
+    assert (
+        pool_name(
+            "https://a.openai.azure.com/openai/deployments/gpt-4/chat/completions"
+        )
+        == "gpt-4-pool"
+    )
+    assert (
+        pool_name(
+            "https://a.openai.azure.com/openai/deployments/gpt-35/chat/completions"
+        )
+        == "azure-pool"
+    )
+    assert pool_name("http://localhost:8080/chat/completions") == "local-pool"
+    assert pool_name("https://localhost:8080/chat/completions") == "default"
+    assert pool_name("https://openai.azure.com.evil/x") == "default"
+
+
+async def test_exhausted_pool_does_not_starve_other_deployments(configure):
+    async with H11Server(delay=0.5) as server:
+        client = configure(
+            UPSTREAM_CONNECTION_POOLS={
+                "slow": {
+                    "deployments": ["slow"],
+                    "max_connections": 1,
+                    "pool_timeout": 0.1,
+                }
+            }
+        )
+
+        slow_url = f"{server.url}/openai/deployments/slow/chat/completions"
+        fast_url = f"{server.url}/openai/deployments/fast/chat/completions"
+
+        hung = asyncio.create_task(client.post(slow_url))
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(httpx.PoolTimeout):
+            await client.post(slow_url)
+
+        assert (await client.post(fast_url)).status_code == 200
+        assert (await hung).status_code == 200
+        await client.aclose()
+
+    pools = {pool.name: pool for pool in get_upstream_pools()}
+    assert pools["slow"].waiting_requests == 0
+    assert pools["slow"].active_streams == 0
+    assert pools["default"].connections_opened == 1
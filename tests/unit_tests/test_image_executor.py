@@ -0,0 +1,38 @@
+import base64
+import os
+import threading
+
+import aidial_adapter_openai.utils.image_executor as image_executor
+from aidial_adapter_openai.utils.image_executor import (
+    IMAGE_INLINE_SIZE_LIMIT,
+    run_in_process,
+    run_in_thread,
+)
+from aidial_adapter_openai.utils.resource import Resource
+
+
+async def test_small_tasks_run_inline():
+    assert await run_in_thread(threading.get_ident, size=1) == (
+        threading.get_ident()
+    )
+    assert await run_in_process(os.getpid, size=1) == os.getpid()
+
+
+async def test_large_tasks_run_on_executors():
+    size = IMAGE_INLINE_SIZE_LIMIT
+
+    assert await run_in_thread(threading.get_ident, size=size) != (
+        threading.get_ident()
+    )
+    assert await run_in_process(os.getpid, size=size) != os.getpid()
+
+    for executor in image_executor._executors.values():
+        assert executor.in_flight == 0
+
+
+def test_base64_is_converted_in_chunks():
+    data = os.urandom(3 * 1024 * 1024 + 1)
+    data_base64 = base64.b64encode(data).decode()
+
+    assert Resource(type="image/png", data=data).data_base64 == data_base64
+    assert Resource.from_base64("image/png", data_base64).data == data
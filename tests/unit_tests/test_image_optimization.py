@@ -0,0 +1,104 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from aidial_adapter_openai.app_config import ImageOptimizationConfig
+from aidial_adapter_openai.gpt4_multi_modal.transformation import (
+    ResourceProcessor,
+)
+from aidial_adapter_openai.utils.image import optimize_image
+from aidial_adapter_openai.utils.image_tokenizer import (
+    GPT4O_IMAGE_TOKENIZER,
+    get_processed_size,
+)
+from aidial_adapter_openai.utils.resource import Resource
+from tests.utils.images import pic_2_2
+
+
+def create_image(format: str, size=(1600, 1200), mode="RGB") -> Resource:
+    buffer = BytesIO()
+    Image.effect_noise(size, 64).convert(mode).save(buffer, format)
+    return Resource(type=Image.MIME[format], data=buffer.getvalue())
+
+
+def get_size(image: Resource):
+    with Image.open(BytesIO(image.data)) as img:
+        return img.format, img.size, getattr(img, "n_frames", 1)
+
+
+@pytest.mark.parametrize(
+    "width,height",
+    [(3000, 2000), (2000, 3000), (4096, 1024), (1025, 769), (800, 600)],
+)
+def test_processed_size_keeps_tokens(width: int, height: int):
+    processed = get_processed_size(width, height, "high")
+    assert GPT4O_IMAGE_TOKENIZER.tokenize(
+        *processed, "high"
+    ) == GPT4O_IMAGE_TOKENIZER.tokenize(width, height, "high")
+
+
+@pytest.mark.parametrize(
+    "image,format,expected_format",
+    [
+        (create_image("PNG"), None, "PNG"),
+        (create_image("PNG", mode="RGBA"), "jpeg", "JPEG"),
+        (create_image("JPEG"), "webp", "WEBP"),
+    ],
+)
+def test_image_is_scaled_down(image: Resource, format, expected_format):
+    result = optimize_image(image, (1024, 768), format, 80)
+
+    assert result is not None
+    assert get_size(result) == (expected_format, (1024, 768), 1)
+    assert result.type == Image.MIME[expected_format]
+    assert len(result.data) < len(image.data)
+
+
+def test_animated_image_is_reduced_to_first_frame():
+    frames = [Image.new("RGB", (100, 100), color) for color in ("red", "blue")]
+    buffer = BytesIO()
+    frames[0].save(buffer, "GIF", save_all=True, append_images=frames[1:])
+    image = Resource(type="image/gif", data=buffer.getvalue())
+
+    result = optimize_image(image, (100, 100))
+
+    assert result is not None
+    assert get_size(result) == ("GIF", (100, 100), 1)
+
+
+def test_small_image_is_kept():
+    assert optimize_image(pic_2_2, (2, 2)) is None
+
+
+async def test_attached_images_are_optimized():
+    image = create_image("PNG")
+    processor = ResourceProcessor(
+        file_storage=None,
+        image_optimization=ImageOptimizationConfig(format="jpeg"),
+    )
+
+    result = await processor.transform_messages(
+        [
+            {
+                "role": "user",
+                "content": "Describe",
+                "custom_content": {
+                    "attachments": [
+                        {"type": "image/png", "data": image.data_base64}
+                    ]
+                },
+            }
+        ]
+    )
+
+    assert isinstance(result, list)
+    metadata = result[0].image_metadatas[0]
+    # The tokens are estimated by the original size
+    assert (metadata.width, metadata.height, metadata.detail) == (
+        1600,
+        1200,
+        "high",
+    )
+    assert metadata.image is not None
+    assert get_size(metadata.image) == ("JPEG", (1024, 768), 1)
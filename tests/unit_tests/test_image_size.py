@@ -0,0 +1,105 @@
+from io import BytesIO
+from typing import List
+
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from aidial_adapter_openai.dial_api.resource import (
+    AttachmentResource,
+    parse_attachment,
+)
+from aidial_adapter_openai.dial_api.storage import (
+    close_storage_session,
+    download_file_prefix,
+)
+from aidial_adapter_openai.gpt4_multi_modal.transformation import (
+    ImageReference,
+    ResourceProcessor,
+)
+from aidial_adapter_openai.utils.image_size import parse_image_size
+from aidial_adapter_openai.utils.resource import Resource
+
+
+def create_image(format: str, mode: str = "RGB", **params) -> bytes:
+    buffer = BytesIO()
+    Image.new(mode, (1234, 567)).save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize(
+    "image",
+    [
+        create_image("PNG"),
+        create_image("GIF", "P"),
+        create_image("JPEG"),
+        create_image("JPEG", progressive=True),
+        create_image("JPEG", exif=Image.Exif()),
+        create_image("WEBP"),
+        create_image("WEBP", lossless=True),
+        create_image("WEBP", "RGBA"),
+    ],
+)
+def test_image_size_is_read_from_header(image: bytes):
+    assert parse_image_size(image[:1024]) == (1234, 567)
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        b"",
+        b"not an image",
+        create_image("PNG")[:20],
+        create_image("JPEG")[:100],
+        create_image("WEBP")[:20],
+    ],
+)
+def test_unknown_image_size(header: bytes):
+    assert parse_image_size(header) is None
+
+
+async def test_attachment_data_is_probed_without_decoding():
+    image = Resource(type="image/png", data=create_image("PNG"))
+    dial_resource = AttachmentResource(
+        attachment=parse_attachment(
+            {"type": "image/png", "data": image.data_base64}
+        ),
+        supported_types=["image/png"],
+    )
+
+    result = await ResourceProcessor(file_storage=None).try_probe_resource(
+        dial_resource, "auto"
+    )
+
+    assert isinstance(result, ImageReference)
+    assert result.metadata.image is None
+    assert (result.metadata.width, result.metadata.height) == (1234, 567)
+
+
+@pytest.mark.parametrize("support_range", [True, False])
+async def test_file_prefix_is_downloaded(support_range: bool):
+    content = bytes(range(256)) * 100
+    ranges: List[str | None] = []
+
+    async def get_file(request: web.Request) -> web.StreamResponse:
+        ranges.append(request.headers.get("Range"))
+        if support_range:
+            return web.Response(status=206, body=content[:1000])
+        return web.Response(body=content)
+
+    app = web.Application()
+    app.router.add_get("/file", get_file)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    try:
+        data = await download_file_prefix(f"http://127.0.0.1:{port}/file", 1000)
+    finally:
+        await close_storage_session()
+        await runner.cleanup()
+
+    assert data == content[:1000]
+    assert ranges == ["bytes=0-999"]
@@ -0,0 +1,91 @@
+import json
+import os
+
+import pytest
+from aiohttp import web
+
+from aidial_adapter_openai.gpt4_multi_modal.chat_completion import (
+    predict_non_stream,
+)
+from aidial_adapter_openai.utils.json_body import JSONBody
+from aidial_adapter_openai.utils.resource import Resource
+
+DATA = os.urandom(200_000)
+
+
+def create_request(image: Resource) -> dict:
+    return {
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": 'Describe "it" ✓'},
+                    {"type": "image_url", "image_url": {"url": image}},
+                ],
+            }
+        ],
+        "max_tokens": None,
+        "temperature": 0.5,
+    }
+
+
+def expected_request(image: Resource) -> dict:
+    request = create_request(image)
+    request["messages"][0]["content"][1]["image_url"][
+        "url"
+    ] = image.to_data_url()
+    return request
+
+
+@pytest.mark.parametrize(
+    "image",
+    [
+        Resource(type="image/png", data=DATA),
+        Resource(
+            type="image/png",
+            data_base64=Resource(type="image/png", data=DATA).data_base64,
+        ),
+    ],
+)
+async def test_json_body(image: Resource):
+    body = JSONBody(create_request(image))
+
+    chunks = [chunk async for chunk in body]
+    data = b"".join(chunks)
+
+    assert json.loads(data) == expected_request(image)
+    assert body.size == len(data)
+    assert max(map(len, chunks)) <= 64 * 1024
+    assert image._data_base64 is None or image._data is None
+
+
+async def test_request_is_sent_with_json_body():
+    image = Resource(type="image/png", data=DATA)
+    requests = []
+
+    async def handler(request: web.Request) -> web.Response:
+        requests.append((request.headers, await request.json()))
+        return web.json_response({"choices": []})
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    try:
+        response = await predict_non_stream(
+            f"http://127.0.0.1:{port}/chat/completions",
+            {"api-key": "key"},
+            create_request(image),
+        )
+    finally:
+        await runner.cleanup()
+
+    assert response == {"choices": []}
+    headers, body = requests[0]
+    assert headers["Content-Type"] == "application/json"
+    assert "Transfer-Encoding" not in headers
+    assert body == expected_request(image)
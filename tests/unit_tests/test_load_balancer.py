@@ -0,0 +1,185 @@
+import time
+
+import httpx
+import pytest
+import respx
+
+from aidial_adapter_openai.app_config import UpstreamPoolConfig
+from aidial_adapter_openai.utils.load_balancer import UpstreamBalancer
+from aidial_adapter_openai.utils.outcome import Outcome
+from aidial_adapter_openai.utils.token_budget import get_token_budgets
+
+
+def create_balancer(**kwargs) -> UpstreamBalancer:
+    return UpstreamBalancer(
+        "gpt-4",
+        UpstreamPoolConfig(
+            upstreams=[
+                {"endpoint": "http://east", "key": "east-key"},
+                {"endpoint": "http://west"},
+            ],
+            **kwargs,
+        ),
+    )
+
+
+def test_least_requests():
+    balancer = create_balancer(strategy="least_requests")
+    east, west = balancer.members
+
+    balancer.acquire(east)
+    assert balancer.select() is west
+    balancer.acquire(west)
+    balancer.acquire(west)
+    assert balancer.select() is east
+
+
+def test_peak_ewma_prefers_faster_upstream():
+    balancer = create_balancer()
+    east, west = balancer.members
+
+    balancer.acquire(east)(Outcome.SUCCESS, 2.0)
+    balancer.acquire(west)(Outcome.SUCCESS, 0.5)
+    assert balancer.select() is west
+
+    # A latency spike is taken into account at once
+    balancer.acquire(west)(Outcome.SUCCESS, 5.0)
+    assert balancer.select() is east
+
+
+def test_throttled_upstream_is_ejected():
+    balancer = create_balancer()
+    east, west = balancer.members
+
+    balancer.acquire(east)(Outcome.THROTTLED, 0.1)
+    assert all(balancer.select() is west for _ in range(10))
+
+
+def test_failing_upstream_is_ejected_after_consecutive_failures():
+    balancer = create_balancer(max_failures=2, strategy="least_requests")
+    east, west = balancer.members
+
+    balancer.acquire(east)(Outcome.OVERLOAD, 0.1)
+    balancer.acquire(east)(Outcome.SUCCESS, 0.1)
+    balancer.acquire(east)(Outcome.OVERLOAD, 0.1)
+    assert not east.is_ejected(time.monotonic())
+
+    balancer.acquire(east)(Outcome.OVERLOAD, 0.1)
+    balancer.acquire(west)
+    assert balancer.select() is west
+
+
+def test_excluded_upstream():
+    balancer = create_balancer()
+    east, west = balancer.members
+
+    assert balancer.select(exclude=[east.endpoint]) is west
+
+    balancer.acquire(west)(Outcome.THROTTLED, 0.1)
+    assert balancer.select(exclude=[east.endpoint]) is east
+
+
+def test_ejected_upstream_is_used_as_last_resort():
+    balancer = create_balancer()
+    east, west = balancer.members
+
+    balancer.acquire(west)(Outcome.THROTTLED, 0.1)
+    balancer.acquire(east)(Outcome.THROTTLED, 0.1)
+    assert balancer.select() is west
+
+
+@pytest.fixture
+def upstream_pool(configure_test_app):
+    configure_test_app(
+        DEPLOYMENT_UPSTREAMS={
+            "gpt-4": {
+                "upstreams": [
+                    {
+                        "endpoint": "http://east/openai/deployments/gpt-4/chat/completions",
+                        "key": "east-key",
+                    },
+                    {
+                        "endpoint": "http://west/openai/deployments/gpt-4/chat/completions",
+                        "key": "west-key",
+                    },
+                ]
+            }
+        }
+    )
+
+
+@respx.mock
+async def test_requests_avoid_throttled_upstream(
+    test_app: httpx.AsyncClient, upstream_pool
+):
+    response = {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4",
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "Hi"},
+            }
+        ],
+    }
+    east = respx.post(url__startswith="http://east/").respond(
+        status_code=429, json={"error": {"message": "Rate limit"}}
+    )
+    west = respx.post(url__startswith="http://west/").respond(json=response)
+
+    statuses = [
+        (
+            await test_app.post(
+                "/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview",
+                json={"messages": [{"role": "user", "content": "Hello"}]},
+                headers={"X-UPSTREAM-ENDPOINT": "http://unused"},
+            )
+        ).status_code
+        for _ in range(6)
+    ]
+
+    assert east.call_count <= 1
+    assert statuses.count(200) == west.call_count >= 5
+    assert west.calls.last.request.headers["api-key"] == "west-key"
+
+
+@respx.mock
+async def test_adapter_rate_limit_does_not_eject_upstream(
+    _app_instance, test_app: httpx.AsyncClient, configure_test_app
+):
+    configure_test_app(
+        DEPLOYMENT_UPSTREAMS={
+            "gpt-4": {
+                "upstreams": [
+                    {
+                        "endpoint": "http://east/openai/deployments/gpt-4/chat/completions",
+                        "key": "east-key",
+                    }
+                ]
+            }
+        },
+        TOKEN_BUDGET_DEPLOYMENTS=["gpt-4"],
+        TOKEN_BUDGET_MAX_WAIT=0,
+    )
+    budget = get_token_budgets(_app_instance).get(
+        "http://east/openai/deployments/gpt-4/chat/completions"
+    )
+    budget.update({"x-ratelimit-remaining-tokens": "60"})
+    budget.update({"x-ratelimit-remaining-tokens": "0"})
+    upstream = respx.post(url__startswith="http://east/").respond(json={})
+
+    response = await test_app.post(
+        "/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview",
+        json={"messages": [{"role": "user", "content": "Hello"}]},
+        headers={"X-UPSTREAM-ENDPOINT": "http://unused"},
+    )
+
+    assert response.status_code == 429
+    assert upstream.call_count == 0
+
+    [east] = _app_instance.state.upstream_balancers["gpt-4"].members
+    assert not east.is_ejected(time.monotonic())
+    assert east.in_flight == 0
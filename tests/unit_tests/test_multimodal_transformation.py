@@ -1,13 +1,21 @@
+import asyncio
+from typing import List, Optional
+
 import pytest
 from aidial_sdk.exceptions import HTTPException as DialException
 
+from aidial_adapter_openai.dial_api.resource import ValidationError
 from aidial_adapter_openai.gpt4_multi_modal.transformation import (
+    IMAGE_DOWNLOAD_CONCURRENCY_PER_REQUEST,
     ResourceProcessor,
     TransformationError,
 )
+from aidial_adapter_openai.utils.auth import Auth
 from aidial_adapter_openai.utils.image import ImageMetadata
+from aidial_adapter_openai.utils.image_tokenizer import GPT4O_IMAGE_TOKENIZER
 from aidial_adapter_openai.utils.multi_modal_message import MultiModalMessage
 from aidial_adapter_openai.utils.resource import Resource
+from aidial_adapter_openai.utils.tokenizer import MultiModalTokenizer
 from tests.utils.images import data_url, pic_1_1, pic_2_2, pic_3_3
 from tests.utils.storage import MockFileStorage
 
@@ -19,7 +27,9 @@ def attachment(resource: Resource) -> dict:
     return {"type": resource.type, "data": resource.data_base64}
 
 
-def image_metadata(resource: Resource, w: int, h: int) -> ImageMetadata:
+def image_metadata(
+    resource: Optional[Resource], w: int, h: int
+) -> ImageMetadata:
     return ImageMetadata(width=w, height=h, detail="low", image=resource)
 
 
@@ -30,6 +40,14 @@ def image_url(resource: Resource) -> dict:
     }
 
 
+def image_part(resource: Resource) -> dict:
+    # The attached images are encoded when the request is sent
+    return {
+        "type": "image_url",
+        "image_url": {"url": resource, "detail": "low"},
+    }
+
+
 def text(text: str) -> dict:
     return {"type": "text", "text": text}
 
@@ -64,7 +82,7 @@ def mock_resource_processor():
             TOKENS_FOR_TEXT + TOKENS_FOR_IMAGE,
             [
                 text(""),
-                image_url(pic_1_1),
+                image_part(pic_1_1),
             ],
         ),
         # Message with multiple images
@@ -82,8 +100,8 @@ def mock_resource_processor():
             TOKENS_FOR_TEXT + 2 * TOKENS_FOR_IMAGE,
             [
                 text("test with multiple images"),
-                image_url(pic_1_1),
-                image_url(pic_2_2),
+                image_part(pic_1_1),
+                image_part(pic_2_2),
             ],
         ),
     ],
@@ -173,7 +191,7 @@ async def test_transform_message_with_error(mock_resource_processor):
                     image_metadatas=[image_metadata(pic_1_1, 1, 1)],
                     raw_message={
                         "role": "user",
-                        "content": [text(""), image_url(pic_1_1)],
+                        "content": [text(""), image_part(pic_1_1)],
                     },
                 ),
             ],
@@ -226,7 +244,8 @@ async def test_transform_message_with_error(mock_resource_processor):
             ],
             [
                 MultiModalMessage(
-                    image_metadatas=[image_metadata(pic_1_1, 1, 1)],
+                    # The content images are passed to the upstream as is
+                    image_metadatas=[image_metadata(None, 1, 1)],
                     raw_message={
                         "role": "user",
                         "content": [
@@ -257,7 +276,7 @@ async def test_transform_message_with_error(mock_resource_processor):
             [
                 MultiModalMessage(
                     image_metadatas=[
-                        image_metadata(pic_1_1, 1, 1),
+                        image_metadata(None, 1, 1),
                         image_metadata(pic_2_2, 2, 2),
                         image_metadata(pic_3_3, 3, 3),
                     ],
@@ -266,8 +285,8 @@ async def test_transform_message_with_error(mock_resource_processor):
                         "content": [
                             image_url(pic_1_1),
                             text("User"),
-                            image_url(pic_2_2),
-                            image_url(pic_3_3),
+                            image_part(pic_2_2),
+                            image_part(pic_3_3),
                         ],
                     },
                 )
@@ -282,3 +301,224 @@ async def test_transform_messages(
 ):
     result = await mock_resource_processor.transform_messages(messages)
     assert result == expected_transformations
+
+
+class SlowFileStorage(MockFileStorage):
+    """
+    Storage which serves the images named by their index,
+    the later images faster than the earlier ones.
+    """
+
+    active: int = 0
+    max_active: int = 0
+
+    async def download_resource(self, link: str, type: str) -> Resource:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            idx = int(link.rsplit("/", 1)[-1].removesuffix(".png"))
+            await asyncio.sleep(0.01 * (10 - idx))
+            if "not_found" in link:
+                raise ValidationError("File not found")
+            return [pic_1_1, pic_2_2, pic_3_3][idx % 3]
+        finally:
+            self.active -= 1
+
+
+def message_with_images(urls: List[str]) -> dict:
+    return {
+        "role": "user",
+        "content": "Hi",
+        "custom_content": {
+            "attachments": [{"type": "image/png", "url": url} for url in urls]
+        },
+    }
+
+
+async def test_images_are_downloaded_concurrently():
+    storage = SlowFileStorage()
+    processor = ResourceProcessor(file_storage=storage)
+    messages = [
+        message_with_images([f"http://dial-core/{i}.png" for i in range(5)]),
+        message_with_images(
+            [f"http://dial-core/{i}.png" for i in range(5, 10)]
+        ),
+    ]
+
+    result = await processor.transform_messages(messages)
+
+    assert not isinstance(result, DialException)
+    assert [
+        meta.width for message in result for meta in message.image_metadatas
+    ] == [1, 2, 3, 1, 2, 3, 1, 2, 3, 1]
+    assert 1 < storage.max_active <= IMAGE_DOWNLOAD_CONCURRENCY_PER_REQUEST
+
+
+async def test_concurrent_download_errors_are_aggregated():
+    processor = ResourceProcessor(file_storage=SlowFileStorage())
+    messages = [
+        message_with_images(
+            ["http://dial-core/1.png", "http://dial-core/not_found/2.png"]
+        ),
+        message_with_images(["http://dial-core/not_found/3.png"]),
+    ]
+
+    result = await processor.transform_messages(messages)
+
+    assert isinstance(result, DialException)
+    assert result.message == (
+        "The following files failed to process:\n"
+        "1. http://dial-core/not_found/2.png: file not found\n"
+        "2. http://dial-core/not_found/3.png: file not found"
+    )
+
+
+class CachingFileStorage(MockFileStorage):
+    """
+    The storage with the images downloaded earlier.
+    """
+
+    downloads: List[str] = []
+
+    async def get_cached_resource(self, link: str, type: str) -> Resource:
+        return pic_2_2
+
+    async def download_resource(self, link: str, type: str) -> Resource:
+        self.downloads.append(link)
+        return pic_2_2
+
+
+async def test_images_are_downloaded_only_for_kept_messages():
+    storage = CachingFileStorage()
+    processor = ResourceProcessor(file_storage=storage)
+    messages = [
+        message_with_images(["http://dial-core/1.png"]),
+        message_with_images(["http://dial-core/2.png"]),
+    ]
+
+    probe_result = await processor.probe_messages(messages)
+
+    assert not isinstance(probe_result, DialException)
+    assert storage.downloads == []
+    assert [
+        (meta.width, meta.image)
+        for message in probe_result
+        for meta in message.image_metadatas
+    ] == [(2, None), (2, None)]
+
+    result = await processor.load_messages(probe_result[1:])
+
+    assert not isinstance(result, DialException)
+    assert storage.downloads == ["http://dial-core/2.png"]
+    assert result[0].raw_message["content"] == [
+        text("Hi"),
+        image_part(pic_2_2),
+    ]
+
+
+class ProbingFileStorage(CachingFileStorage):
+    """
+    The storage counting the images probed.
+    """
+
+    probes: List[str] = []
+
+    async def get_cached_resource(self, link: str, type: str) -> Resource:
+        self.probes.append(link)
+        if "not_found" in link:
+            raise ValidationError("File not found")
+        return pic_2_2
+
+
+async def test_resent_messages_are_restored_from_cache():
+    storage = ProbingFileStorage()
+    message = message_with_images(["http://dial-core/cached.png"])
+    tokenizer = MultiModalTokenizer("gpt-4o", GPT4O_IMAGE_TOKENIZER)
+
+    first = await ResourceProcessor(file_storage=storage).probe_messages(
+        [message]
+    )
+    assert not isinstance(first, DialException)
+    tokens = tokenizer.tokenize_request_message(first[0])
+
+    processor = ResourceProcessor(file_storage=storage)
+    second = await processor.probe_messages(
+        [message, message_with_images(["http://dial-core/new.png"])]
+    )
+
+    assert not isinstance(second, DialException)
+    assert storage.probes == [
+        "http://dial-core/cached.png",
+        "http://dial-core/new.png",
+    ]
+    assert second[0] == first[0]
+    assert second[0]._tokens == {tokenizer._tokens_key: tokens}
+    assert second[0]._tokens is not first[0]._tokens
+
+    result = await processor.load_messages(second[:1])
+
+    assert not isinstance(result, DialException)
+    assert storage.downloads == ["http://dial-core/cached.png"]
+    assert result[0].raw_message["content"] == [
+        text("Hi"),
+        image_part(pic_2_2),
+    ]
+
+
+async def test_images_are_probed_again_for_another_api_key():
+    storage = ProbingFileStorage()
+    conversation = [message_with_images(["http://dial-core/history.png"])]
+
+    for api_key in ["key-1", "key-1", "key-2"]:
+        processor = ResourceProcessor(
+            file_storage=storage.copy(
+                update={"auth": Auth(name="api-key", value=api_key)}
+            )
+        )
+        result = await processor.probe_messages(conversation)
+        assert not isinstance(result, DialException)
+
+    assert storage.probes == ["http://dial-core/history.png"] * 2
+
+
+class ChangedFileStorage(ProbingFileStorage):
+    """
+    The storage with a stale copy of the image, which has changed since.
+    """
+
+    async def download_resource(self, link: str, type: str) -> Resource:
+        self.downloads.append(link)
+        return Resource(type=type, data=pic_3_3.data)
+
+
+async def test_changed_image_is_tokenized_anew():
+    storage = ChangedFileStorage()
+    message = message_with_images(["http://dial-core/changed.png"])
+
+    processor = ResourceProcessor(file_storage=storage)
+    probe_result = await processor.probe_messages([message])
+    assert not isinstance(probe_result, DialException)
+    assert probe_result[0].image_metadatas[0].width == 2
+
+    result = await processor.load_messages(probe_result)
+
+    assert not isinstance(result, DialException)
+    assert processor.images_changed
+    assert result[0].image_metadatas == [image_metadata(pic_3_3, 3, 3)]
+
+    # The stale size isn't restored from the cache on the next turn
+    await ResourceProcessor(file_storage=storage).probe_messages([message])
+    assert storage.probes == ["http://dial-core/changed.png"] * 2
+
+
+async def test_messages_with_errors_are_not_cached():
+    storage = ProbingFileStorage()
+    message = message_with_images(["http://dial-core/not_found/1.png"])
+
+    for _ in range(2):
+        result = await ResourceProcessor(file_storage=storage).probe_messages(
+            [message]
+        )
+        assert isinstance(result, DialException)
+
+    assert storage.probes == ["http://dial-core/not_found/1.png"] * 2
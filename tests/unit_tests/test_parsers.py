@@ -110,3 +110,18 @@ def test_completions_parser_normal(endpoint, parsed):
 def test_completions_parser_invalid(endpoint, parsed):
     result = completions_parser.parse(endpoint)
     assert result is None
+
+
+def test_parsed_endpoints_are_memoized():
+    endpoint = "https://test.com/openai/deployments/gpt-4/chat/completions"
+    assert chat_completions_parser.parse(
+        endpoint
+    ) is chat_completions_parser.parse(endpoint)
+
+
+def test_parser_hands_out_cached_client():
+    endpoint = "https://test.com/openai/deployments/gpt-4/chat/completions"
+    params = {"api_key": "key", "api_version": "2024-02-01"}
+    assert chat_completions_parser.get_client(
+        endpoint, params
+    ) is chat_completions_parser.get_client(endpoint, params)
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from aidial_adapter_openai.utils.single_flight import SingleFlight
+
+
+async def test_concurrent_calls_share_result():
+    flight: SingleFlight[str, int] = SingleFlight()
+    calls = 0
+
+    async def call() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(*(flight.run("key", call) for _ in range(5)))
+
+    assert results == [1] * 5
+    assert len(flight) == 0
+
+    # The subsequent call isn't deduplicated
+    assert await flight.run("key", call) == 2
+
+
+async def test_error_is_propagated_to_all_callers():
+    flight: SingleFlight[str, int] = SingleFlight()
+
+    async def call() -> int:
+        await asyncio.sleep(0.01)
+        raise ValueError("Download failed")
+
+    results = await asyncio.gather(
+        *(flight.run("key", call) for _ in range(3)), return_exceptions=True
+    )
+
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+async def test_call_is_cancelled_when_all_callers_leave():
+    flight: SingleFlight[str, int] = SingleFlight()
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def call() -> int:
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return 1
+
+    callers = [asyncio.create_task(flight.run("key", call)) for _ in range(2)]
+    await started.wait()
+
+    callers[0].cancel()
+    await asyncio.sleep(0)
+    assert not cancelled.is_set()
+
+    callers[1].cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
+
+    for caller in callers:
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+
+
+async def test_remaining_caller_gets_result():
+    flight: SingleFlight[str, int] = SingleFlight()
+
+    async def call() -> int:
+        await asyncio.sleep(0.01)
+        return 1
+
+    first = asyncio.create_task(flight.run("key", call))
+    second = asyncio.create_task(flight.run("key", call))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == 1
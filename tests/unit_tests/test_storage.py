@@ -0,0 +1,93 @@
+from typing import AsyncIterator, List, Tuple
+
+import pytest
+from aiohttp import web
+
+from aidial_adapter_openai.dial_api.storage import (
+    FileStorage,
+    close_storage_session,
+)
+from aidial_adapter_openai.utils.auth import Auth
+
+
+class DialCoreStub:
+    bucket_requests: List[str]
+    client_ports: set
+
+    def __init__(self):
+        self.bucket_requests = []
+        self.client_ports = set()
+
+    def _track(self, request: web.Request):
+        peer = request.transport and request.transport.get_extra_info(
+            "peername"
+        )
+        if peer:
+            self.client_ports.add(peer[1])
+
+    async def bucket(self, request: web.Request) -> web.Response:
+        self._track(request)
+        self.bucket_requests.append(request.headers["api-key"])
+        return web.json_response(
+            {"bucket": "APP_BUCKET", "appdata": "USER_BUCKET/appdata/app"}
+        )
+
+    async def upload(self, request: web.Request) -> web.Response:
+        self._track(request)
+        return web.json_response(
+            {
+                "name": "file.png",
+                "parentPath": "images",
+                "bucket": "APP_BUCKET",
+                "url": request.path.removeprefix("/v1/"),
+            }
+        )
+
+
+@pytest.fixture
+async def dial_core() -> AsyncIterator[Tuple[DialCoreStub, str]]:
+    stub = DialCoreStub()
+    app = web.Application()
+    app.router.add_get("/v1/bucket", stub.bucket)
+    app.router.add_put("/v1/files/{path:.*}", stub.upload)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    yield stub, f"http://127.0.0.1:{port}"
+
+    await close_storage_session()
+    await runner.cleanup()
+
+
+def create_storage(dial_url: str, api_key: str) -> FileStorage:
+    return FileStorage(
+        dial_url=dial_url,
+        upload_dir="images",
+        auth=Auth(name="api-key", value=api_key),
+    )
+
+
+async def test_bucket_is_reused_within_storage(dial_core):
+    stub, dial_url = dial_core
+
+    storage = create_storage(dial_url, "key-1")
+    for _ in range(3):
+        await storage.upload("file", "image/png", b"content")
+
+    await create_storage(dial_url, "key-2").upload("file", "image/png", b"x")
+
+    assert stub.bucket_requests == ["key-1", "key-2"]
+
+
+async def test_storage_connections_are_reused(dial_core):
+    stub, dial_url = dial_core
+
+    for _ in range(5):
+        storage = create_storage(dial_url, "key-1")
+        await storage.upload("file", "image/png", b"content")
+
+    assert len(stub.client_ports) == 1
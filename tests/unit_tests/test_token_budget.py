@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+import respx
+from aidial_sdk.exceptions import HTTPException as DialException
+
+from aidial_adapter_openai.utils.token_budget import (
+    TokenBudget,
+    get_upstream_key,
+)
+
+
+def test_upstream_key():
+    assert (
+        get_upstream_key(
+            "https://a.openai.azure.com/openai/deployments/gpt-4/chat/completions"
+        )
+        == "a.openai.azure.com/gpt-4"
+    )
+    assert get_upstream_key("https://api.openai.com/v1") == "api.openai.com"
+
+
+async def test_unknown_budget_admits_immediately():
+    budget = TokenBudget("test")
+    await budget.admit(tokens=10**6, max_wait=0)
+    assert budget.tokens.remaining is None
+
+
+async def test_request_waits_for_replenished_budget():
+    budget = TokenBudget("test")
+    budget.update({"x-ratelimit-remaining-tokens": "6000"})
+    budget.update({"x-ratelimit-remaining-tokens": "0"})
+
+    # 6000 tokens per minute are replenished at 100 tokens per second
+    started_at = time.monotonic()
+    await budget.admit(tokens=20, max_wait=1)
+    assert 0.15 < time.monotonic() - started_at < 0.5
+
+    with pytest.raises(DialException) as exc_info:
+        await budget.admit(tokens=1000, max_wait=1)
+    assert exc_info.value.status_code == 429
+
+
+async def test_waiting_request_does_not_block_smaller_ones():
+    budget = TokenBudget("test")
+    budget.update({"x-ratelimit-remaining-tokens": "6000"})
+    budget.update({"x-ratelimit-remaining-tokens": "50"})
+
+    large = asyncio.create_task(budget.admit(tokens=100, max_wait=1))
+    await asyncio.sleep(0)
+
+    started_at = time.monotonic()
+    await budget.admit(tokens=10, max_wait=0)
+    assert time.monotonic() - started_at < 0.1
+    assert not large.done()
+
+    await large
+
+
+async def test_request_budget():
+    budget = TokenBudget("test")
+    budget.update(
+        {
+            "x-ratelimit-remaining-tokens": "1000",
+            "x-ratelimit-remaining-requests": "1",
+        }
+    )
+
+    await budget.admit(tokens=10, max_wait=0)
+    with pytest.raises(DialException):
+        await budget.admit(tokens=10, max_wait=0)
+
+
+@pytest.fixture
+def token_budget_admission(configure_test_app):
+    configure_test_app(
+        TOKEN_BUDGET_DEPLOYMENTS=["gpt-4"], TOKEN_BUDGET_MAX_WAIT=0.1
+    )
+
+
+@respx.mock
+async def test_exhausted_budget_is_not_sent_upstream(
+    test_app: httpx.AsyncClient, token_budget_admission
+):
+    route = respx.post(
+        "http://localhost:5001/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview"
+    ).respond(
+        json={
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "Hi"},
+                }
+            ],
+        },
+        headers={"x-ratelimit-remaining-tokens": "0"},
+    )
+
+    async def send() -> httpx.Response:
+        return await test_app.post(
+            "/openai/deployments/gpt-4/chat/completions?api-version=2023-03-15-preview",
+            json={"messages": [{"role": "user", "content": "Hello"}]},
+            headers={
+                "X-UPSTREAM-KEY": "TEST_API_KEY",
+                "X-UPSTREAM-ENDPOINT": "http://localhost:5001/openai/deployments/gpt-4/chat/completions",
+            },
+        )
+
+    assert (await send()).status_code == 200
+    assert (await send()).status_code == 429
+    assert route.call_count == 1
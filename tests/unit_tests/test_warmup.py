@@ -0,0 +1,97 @@
+import pytest
+
+import aidial_adapter_openai.utils.http_client as http_client
+from aidial_adapter_openai.app_config import ApplicationConfig
+from aidial_adapter_openai.utils.http_client import (
+    configure_http_client,
+    get_http_client,
+    get_upstream_pools,
+)
+from aidial_adapter_openai.utils.warmup import ConnectionWarmer, get_warmup_urls
+from tests.utils.servers import H11Server
+
+WARM_CONNECTIONS = 3
+
+
+@pytest.fixture
+def restore_http_client():
+    saved_config = http_client._app_config
+    yield
+    configure_http_client(saved_config)
+
+
+def test_warmup_urls():
+    config = ApplicationConfig(
+        UPSTREAM_WARMUP_URLS=["https://a.openai.azure.com"],
+        HTTP2_UPSTREAM_HOSTS=["http://localhost:8080"],
+        UPSTREAM_CONNECTION_POOLS={
+            "azure": {
+                "hosts": [
+                    "*.openai.azure.com",
+                    "a.openai.azure.com",
+                    "b.openai.azure.com",
+                ]
+            }
+        },
+    )
+
+    assert get_warmup_urls(config) == [
+        "https://a.openai.azure.com",
+        "http://localhost:8080",
+        "https://b.openai.azure.com",
+    ]
+
+
+async def test_warm_connections_are_reused(restore_http_client):
+    async with H11Server(delay=0.05) as server:
+        config = ApplicationConfig(
+            UPSTREAM_WARMUP_URLS=[server.url],
+            UPSTREAM_WARMUP_CONNECTIONS=WARM_CONNECTIONS,
+        )
+        configure_http_client(config)
+        warmer = ConnectionWarmer.from_config(config)
+
+        await warmer.start()
+        assert server.connections == WARM_CONNECTIONS
+
+        [pool] = get_upstream_pools()
+        assert pool.connections_opened == WARM_CONNECTIONS
+
+        # Refreshing keeps using the same connections
+        await warmer.warm_up()
+        response = await get_http_client().post(f"{server.url}/chat")
+        assert response.status_code == 200
+        assert server.connections == WARM_CONNECTIONS
+
+        await warmer.stop()
+        await get_http_client().aclose()
+
+
+async def test_warmer_is_disabled_by_default():
+    warmer = ConnectionWarmer.from_config(ApplicationConfig())
+    assert not warmer.enabled
+
+    await warmer.start()
+    await warmer.stop()
+
+
+async def test_warmup_is_left_out_of_retry_budget(restore_http_client):
+    async with H11Server() as server:
+        config = ApplicationConfig(
+            UPSTREAM_WARMUP_URLS=[server.url],
+            UPSTREAM_WARMUP_CONNECTIONS=WARM_CONNECTIONS,
+            UPSTREAM_FAST_RETRIES=1,
+        )
+        configure_http_client(config)
+        warmer = ConnectionWarmer.from_config(config)
+
+        [pool] = get_upstream_pools()
+        assert pool.retry_policy is not None
+        pool.retry_policy._budget = 0
+
+        await warmer.warm_up()
+        assert server.connections == WARM_CONNECTIONS
+        assert pool.retry_policy._budget == 0
+        assert pool.active_streams == 0
+
+        await get_http_client().aclose()
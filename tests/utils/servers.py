@@ -0,0 +1,128 @@
+"""
+Local stand-ins for upstream servers which count the accepted connections.
+"""
+
+import asyncio
+import json
+from typing import Dict, Optional
+
+from aiohttp import web
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import RequestReceived, StreamEnded
+
+RESPONSE_BODY = json.dumps({"status": "ok"}).encode()
+
+
+class H2Server:
+    """
+    Cleartext HTTP/2 (h2c) server with prior knowledge,
+    which responds to every request after a delay.
+    """
+
+    connections: int
+    delay: float
+    port: int
+
+    def __init__(self, delay: float = 0.1):
+        self.connections = 0
+        self.delay = delay
+        self._server: Optional[asyncio.Server] = None
+
+    async def __aenter__(self) -> "H2Server":
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _H2Protocol(self), "127.0.0.1", 0
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        assert self._server is not None
+        self._server.close()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+class _H2Protocol(asyncio.Protocol):
+    def __init__(self, server: H2Server):
+        self.server = server
+        self.conn = H2Connection(H2Configuration(client_side=False))
+        self.transport: Optional[asyncio.Transport] = None
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def connection_made(self, transport):
+        self.server.connections += 1
+        self.transport = transport
+        self.conn.initiate_connection()
+        self._flush()
+
+    def data_received(self, data: bytes):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, RequestReceived) and event.stream_ended:
+                self._respond_later(event.stream_id)
+            elif isinstance(event, StreamEnded):
+                self._respond_later(event.stream_id)
+        self._flush()
+
+    def _respond_later(self, stream_id: int):
+        self.tasks[stream_id] = asyncio.create_task(self._respond(stream_id))
+
+    async def _respond(self, stream_id: int):
+        await asyncio.sleep(self.server.delay)
+        self.conn.send_headers(
+            stream_id,
+            [
+                (":status", "200"),
+                ("content-type", "application/json"),
+                ("content-length", str(len(RESPONSE_BODY))),
+            ],
+        )
+        self.conn.send_data(stream_id, RESPONSE_BODY, end_stream=True)
+        self._flush()
+
+    def _flush(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(self.conn.data_to_send())
+
+
+class H11Server:
+    """
+    HTTP/1.1 server which responds to every request after a delay.
+    """
+
+    connections: int
+    delay: float
+    port: int
+
+    def __init__(self, delay: float = 0.1):
+        self.connections = 0
+        self.delay = delay
+        self._peers = set()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if request.transport is not None:
+            peer = request.transport.get_extra_info("peername")
+            if peer not in self._peers:
+                self._peers.add(peer)
+                self.connections += 1
+        await asyncio.sleep(self.delay)
+        return web.Response(body=RESPONSE_BODY, content_type="application/json")
+
+    async def __aenter__(self) -> "H11Server":
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self._runner.cleanup()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
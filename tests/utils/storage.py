@@ -5,6 +5,7 @@ from typing_extensions import override
 from aidial_adapter_openai.dial_api.resource import ValidationError
 from aidial_adapter_openai.dial_api.storage import Bucket, FileStorage
 from aidial_adapter_openai.utils.auth import Auth
+from aidial_adapter_openai.utils.resource import Resource
 
 
 class MockFileStorage(FileStorage):
@@ -16,7 +17,7 @@ class MockFileStorage(FileStorage):
         )
 
     @override
-    async def _get_bucket(self, session) -> Bucket:
+    async def _get_bucket(self) -> Bucket:
         return {
             "bucket": "APP_BUCKET",
             "appdata": "USER_BUCKET/appdata/test-application",
@@ -30,3 +31,11 @@ class MockFileStorage(FileStorage):
         if not (parsed_url.scheme and parsed_url.netloc):
             raise ValidationError("Not a valid URL")
         return b"test-content"
+
+    @override
+    async def download_resource(self, link: str, type: str) -> Resource:
+        return Resource(type=type, data=await self.download_file(link))
+
+    @override
+    async def download_file_prefix(self, link: str, size: int) -> bytes:
+        return (await self.download_file(link))[:size]